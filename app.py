@@ -5,38 +5,127 @@ using the endpoints provided in this API.
 
 A Redis cache is used to store data about the images and users. We store the following keys in our cache:
 
-    images.all                  --  List of all image ids in the system
-    images.{img_id}.location    --  The filepath of this image on this machine
+    images.all                  --  Sorted set of all image ids in the system, scored by upload time
+    images.{img_id}.location    --  The storage key of the current variant of this image
+    images.{img_id}.original    --  The storage key of the image the current variant is rendered from: the upload,
+                                    which is never modified and is shared by all images with the same content, until
+                                    an image has had transcoder.MAX_STEPS operations applied, when its current variant
+                                    takes the upload's place
+    images.{img_id}.steps       --  JSON list of the operations applied to the original to get the current variant
+    images.{img_id}.variants    --  Hash of variant name to the storage key of every variant generated for this image
     images.{img_id}.last_job    --  The last job performed on this image
     images.{img_id}.actions     --  List of all actions that have been performed on this image
-    user.{user_id}.images       --  List of all image ID's associated with this user
+    images.{img_id}.sequence    --  Number of jobs that have been submitted for this image
+    images.{img_id}.pending     --  Number of jobs for this image that are queued or being processed
+    images.{img_id}.hash        --  Content hash of the original image
+    images.{img_id}.format      --  Format of the original image, e.g. "JPEG"
+    images.{img_id}.dimensions  --  Width and height of the original image in pixels, delimited by a comma
+    user.{user_id}.images       --  Sorted set of all image ID's associated with this user, scored by upload time
+    images.{img_id}.priority    --  Priority class of the image's most recently queued job
+    batches.{batch_id}.jobs     --  List of the IDs of the jobs submitted in a batch, which expires as long after
+                                    the batch is submitted as jobs do after they finish
+
+Jobs themselves are recorded by the jobs module.
 
 """
 import uuid
 import os
+import time
+import json
 import logging
+import mimetypes
 import threading
+import multiprocessing
+from Queue import Empty
 
 import werkzeug
-from flask import Flask, send_file
+from flask import Flask, Response, send_file, jsonify, request
 from flask_restful import Api, Resource, marshal_with, reqparse, fields, abort
-from werkzeug.utils import secure_filename
-from redis import StrictRedis
-
+from redis import WatchError
+from werkzeug.datastructures import ContentRange
+from werkzeug.exceptions import HTTPException, ServiceUnavailable, TooManyRequests
+import cache
+import jobs
+import metrics
+import notify
+import storage
+import uploads
 import transcoder
 
 TEST_HOST = 'localhost'
 TEST_PORT = 5000
-WORKER_THREAD_COUNT = 10
-ALLOWED_EXTENSIONS = ('jpg', 'jpeg', 'png', 'bmp')
+WORKER_PROCESS_COUNT = multiprocessing.cpu_count()
+
+# Number of threads the workers read originals and write results with (each)
+WORKER_IO_THREAD_COUNT = 2
+ALLOWED_EXTENSIONS = ('jpg', 'jpeg', 'png', 'bmp', 'webp')
+
+# Number of image IDs returned per page by the listing endpoints, by default and at most
+PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+
+# Maximum number of jobs that can be submitted in one batch
+MAX_BATCH_SIZE = 1000
+
+# Maximum number of sizes a renditions job can generate
+MAX_RENDITIONS = 16
+
+# Largest width or height that images can be resized to
+MAX_DIMENSION = 10000
+
+# Jobs are queued in one of the transcoder's priority classes: the one asked for, else the one their image's owner or
+# action is pinned to here, else the default. Once an image has jobs queued, its later jobs join the same class.
+USER_PRIORITIES = {}
+ACTION_PRIORITIES = {}
+
+# Admission control: jobs are turned away, with a Retry-After in seconds, when their priority class already holds this
+# many queued jobs (503) or this much estimated cost (429); see _job_cost for the units
+MAX_QUEUE_DEPTH = {'interactive': 1000, 'default': 10000, 'bulk': 100000}
+MAX_QUEUE_COST = {'interactive': 10 ** 4, 'default': 10 ** 5, 'bulk': 10 ** 6}
+RETRY_AFTER = 5
+
+# Longest a client may hold GET /job/<job_id>?wait= open, and how often job event streams send a keepalive (seconds).
+# Requests waiting on a job read its status again at each keepalive, in case they missed an update.
+MAX_WAIT = 60
+SSE_KEEPALIVE = 15
+
+# Number of threads that call the callback URLs of finished jobs
+CALLBACK_THREAD_COUNT = 2
+
+# When fronted by nginx, set this to an internal location that aliases the filesystem root (e.g. "/protected") so
+# that nginx sends image files itself with X-Accel-Redirect. Set app.use_x_sendfile instead for X-Sendfile servers.
+ACCEL_REDIRECT_PREFIX = None
 
 
 app = Flask(__name__)
+app.request_class = uploads.UploadRequest
+
+# Not every platform's MIME types know WebP
+mimetypes.add_type('image/webp', '.webp')
 
 _log = logging.getLogger(__name__)
 
 
-store = StrictRedis()
+store = metrics.CountingRedis()
+
+metrics.describe('transcoder_queue_depth', 'gauge', 'Jobs waiting on the queue, by priority class')
+metrics.describe('transcoder_queue_cost', 'gauge', 'Estimated cost of the jobs waiting on the queue, by priority class')
+metrics.describe('transcoder_jobs_in_flight', 'gauge', 'Jobs being processed, by worker')
+metrics.describe('transcoder_pixels_held', 'gauge', 'Pixels the workers hold from the pixel budget')
+metrics.describe('transcoder_workers', 'gauge', 'Worker processes with a live heartbeat')
+metrics.describe('transcoder_pool_size', 'gauge', 'Jobs each worker process renders at once, by worker')
+
+
+@app.before_request
+def reset_round_trips():
+    metrics.reset_round_trips()
+
+
+@app.after_request
+def record_round_trips(response):
+    """Report the number of Redis round trips made to serve the request"""
+    response.headers['X-Redis-Round-Trips'] = metrics.record_round_trips(request.endpoint)
+    return response
 
 
 @app.route('/')
@@ -44,11 +133,205 @@ def home():
     return 'I am up! Try uploading to "/images"'
 
 
+def _parse_size(value):
+    try:
+        size = value.split(',')
+        width, height = int(size[0]), int(size[1])
+    except (KeyError, TypeError, ValueError, AttributeError, IndexError):
+        abort(400, description='Invalid size. Specify width and height delimited by a comma: "50,50"')
+    if not (0 < width <= MAX_DIMENSION and 0 < height <= MAX_DIMENSION):
+        abort(400, description='Invalid size. Width and height must be between 1 and {}'.format(MAX_DIMENSION))
+    return width, height
+
+
+def _parse_box(value, size=None):
+    """
+    Parse a crop box of left, upper, right and lower edges
+
+    :param size: Width and height of the image the box is taken from, if known
+    """
+    try:
+        box = value.split(',')
+        left, upper, right, lower = int(box[0]), int(box[1]), int(box[2]), int(box[3])
+    except (KeyError, TypeError, ValueError, AttributeError, IndexError):
+        abort(400, description='Invalid bounding box. Specify box delimited by comma: "50,150,90,80"')
+    if not (0 <= left < right and 0 <= upper < lower):
+        abort(400, description='Invalid bounding box. Its left and upper edges must be within its right and lower ones')
+    if size and (right > size[0] or lower > size[1]):
+        abort(400, description='Invalid bounding box. The image is only {}x{}'.format(*size))
+    return left, upper, right, lower
+
+
+def _parse_extension(value):
+    if value not in ALLOWED_EXTENSIONS:
+        abort(400, description='Use valid extension: {}'.format(ALLOWED_EXTENSIONS))
+    return value
+
+
+def _parse_renditions(value):
+    """
+    Parse a list of renditions such as "1600x1200,800x600,400x300.webp" into [width, height, extension] triples; the
+    extension is None for renditions in the image's own format
+    """
+    renditions = []
+    try:
+        for rendition in value.split(','):
+            size, _, extension = rendition.strip().partition('.')
+            width, height = [int(v) for v in size.split('x')]
+            if not (0 < width <= MAX_DIMENSION and 0 < height <= MAX_DIMENSION):
+                raise ValueError(size)
+            renditions.append([width, height, _parse_extension(extension) if extension else None])
+    except (TypeError, ValueError, AttributeError):
+        abort(400, description='Invalid renditions. Specify sizes delimited by commas, each with an optional format: '
+                               '"800x600,400x300.webp"')
+    if len(renditions) > MAX_RENDITIONS:
+        abort(400, description='Renditions are limited to {} sizes'.format(MAX_RENDITIONS))
+    return renditions
+
+
+def _read_range(path, start, stop, chunk_size=64 * 1024):
+    with open(path, 'rb') as f:
+        f.seek(start)
+        remaining = stop - start
+        while remaining > 0:
+            chunk = f.read(min(chunk_size, remaining))
+            if not chunk:
+                break
+            remaining -= len(chunk)
+            yield chunk
+
+
+def _send_image(path, etag):
+    """
+    Send an image file with a strong ETag, answering conditional GETs with 304 and byte range requests with 206. When
+    the app is fronted by a server that can send files itself, the bytes are left to it.
+    """
+    stat = os.stat(path)
+    mimetype = mimetypes.guess_type(path)[0] or 'application/octet-stream'
+
+    # A range only applies to the representation the client already has part of
+    byte_range = request.range
+    if request.headers.get('If-Range') and request.if_range.etag != etag:
+        byte_range = None
+
+    if ACCEL_REDIRECT_PREFIX:
+        rv = Response(mimetype=mimetype)
+        rv.headers['X-Accel-Redirect'] = ACCEL_REDIRECT_PREFIX + path
+    elif byte_range and not app.use_x_sendfile and len(byte_range.ranges) == 1:
+        span = byte_range.range_for_length(stat.st_size)
+        if span is None:
+            rv = Response(status=416)
+            rv.content_range = ContentRange('bytes', None, None, stat.st_size)
+            return rv
+        start, stop = span
+        rv = Response(_read_range(path, start, stop), 206, mimetype=mimetype, direct_passthrough=True)
+        rv.content_range = ContentRange('bytes', start, stop, stat.st_size)
+        rv.content_length = stop - start
+    else:
+        rv = send_file(path, mimetype=mimetype, add_etags=False)
+
+    # Files are hard-linked from the derivative cache and between images with the same content, so their modification
+    # times say nothing about the image served. Clients revalidate with the ETag alone.
+    rv.accept_ranges = 'bytes'
+    rv.set_etag(etag)
+    rv.headers.pop('Last-Modified', None)
+    return rv.make_conditional(request)
+
+
 @app.route('/serve/<img_id>')
 def serve(img_id):
-    """Serve out the image"""
-    location = store.get('images.{img_id}.location'.format(img_id=img_id))
-    return send_file(location)
+    """
+    Serve out the image. A variant of the image can be requested with the "box", "size" and "format" query
+    parameters, which are applied in that order, and saved with the output "profile"; variants are generated on their
+    first request and kept from then on.
+    """
+    location, original, src_hash, applied, dimensions = store.mget(
+        *['images.{img_id}.{key}'.format(img_id=img_id, key=key)
+          for key in ('location', 'original', 'hash', 'steps', 'dimensions')])
+    if not location:
+        abort(404)
+    applied = json.loads(applied or '[]')
+
+    operations = []
+    if 'box' in request.args:
+        box = _parse_box(request.args['box'], transcoder.image_size(dimensions, applied))
+        operations.append(('crop', {'box': box}))
+    if 'size' in request.args:
+        operations.append(('resize', {'size': _parse_size(request.args['size'])}))
+    if 'format' in request.args:
+        operations.append(('transcode', {'extension': _parse_extension(request.args['format'])}))
+    if 'profile' in request.args:
+        if not operations or request.args['profile'] not in transcoder.PROFILES:
+            abort(400, description='Invalid profile. Use one of {} along with a box, size or format'.format(
+                ', '.join(sorted(transcoder.PROFILES))))
+        operations[-1][1]['profile'] = request.args['profile']
+
+    original = original or location
+    steps = applied + cache.operations(operations)
+
+    if not operations:
+        key = location
+    else:
+        name, key = transcoder.variant(img_id, original, steps)
+        if not store.hexists('images.{img_id}.variants'.format(img_id=img_id), name) or not storage.backend.exists(key):
+            if not transcoder.perform(original, key, steps, src_hash):
+                abort(500, description='Could not generate variant {}'.format(name))
+            pipe = store.pipeline()
+            pipe.hset('images.{img_id}.variants'.format(img_id=img_id), name, key)
+            pipe.hlen('images.{img_id}.variants'.format(img_id=img_id))
+            if pipe.execute()[-1] > transcoder.MAX_VARIANTS:
+                transcoder.trim_variants(img_id, location, key)
+
+    path = storage.backend.local_path(key)
+
+    # Variants are fully determined by the original's content and the operations applied to it
+    if src_hash:
+        etag = cache.key(src_hash, steps, os.path.splitext(key)[1])
+    else:
+        etag = cache.file_hash(path)
+
+    return _send_image(path, etag)
+
+
+@app.route('/stats/cache')
+def cache_stats():
+    """Hit, miss and eviction counters of the derivative cache"""
+    return jsonify(cache.stats())
+
+
+@app.route('/stats/redis')
+def redis_stats():
+    """Redis round trips per request for each endpoint served by this process"""
+    return jsonify(metrics.round_trip_stats())
+
+
+@app.route('/metrics')
+def prometheus_metrics():
+    """
+    Job metrics in the Prometheus text format
+    """
+    pipe = store.pipeline(transaction=False)
+    pipe.hgetall(metrics.COUNTERS)
+    pipe.hgetall(metrics.HISTOGRAMS)
+    pipe.hgetall(transcoder.queue.load)
+    pipe.hgetall(transcoder.INFLIGHT)
+    transcoder.budget.holds(pipe)
+    pipe.zcount(transcoder.queue.workers, time.time(), '+inf')
+    pipe.hgetall(transcoder.POOL)
+    counters, histograms, load, inflight, holds, workers, pools = pipe.execute()
+
+    gauges = []
+    for priority, (depth, cost) in sorted(transcoder.queue.backlog(load).items()):
+        gauges.append(('transcoder_queue_depth', {'priority': priority}, depth))
+        gauges.append(('transcoder_queue_cost', {'priority': priority}, cost))
+    for worker_id, count in sorted(inflight.items()):
+        gauges.append(('transcoder_jobs_in_flight', {'worker': worker_id}, int(count)))
+    gauges.append(('transcoder_pixels_held', {}, transcoder.budget.held(holds)))
+    gauges.append(('transcoder_workers', {}, workers))
+    for worker_id, size in sorted(pools.items()):
+        gauges.append(('transcoder_pool_size', {'worker': worker_id}, int(size)))
+
+    return Response(metrics.exposition(counters, histograms, gauges), mimetype='text/plain; version=0.0.4')
 
 
 @app.route('/debug/all-image-ids')
@@ -56,7 +339,7 @@ def all_image_ids():
     """Return all image IDs for debugging"""
     if not app.debug:
         abort(403)
-    return ',\n'.join(store.lrange('images.all', 0, -1))
+    return ',\n'.join(store.zrevrange('images.all', 0, -1))
 
 
 @app.route('/debug/dump-queue')
@@ -65,11 +348,207 @@ def dump_queue():
     if not app.debug:
         abort(403)
 
-    jobs = []
+    entries = []
     while not transcoder.queue.empty():
-        jobs.append(str(transcoder.queue.get(block=False)))
+        job = transcoder.queue.get(block=False)
+
+        # The job will never run, so it no longer holds back its image's later jobs
+        pipe = store.pipeline()
+        pipe.decr('images.{img_id}.pending'.format(img_id=job[1]['img_id']))
+        transcoder.queue.ack(job, pipe=pipe)
+        entries.append(str(job))
+
+    return ',\n'.join(entries) or 'Empty Queue!'
+
+
+def _list_page(key):
+    """
+    A page of image IDs from one of the sorted set indexes, newest first. The "cursor" query parameter continues from
+    the end of a previous page and "limit" sets the page size.
+    """
+    parser = reqparse.RequestParser()
+    parser.add_argument('cursor', type=str, required=False, location='args')
+    parser.add_argument('limit', type=int, required=False, default=PAGE_SIZE, location='args')
+    data = parser.parse_args()
+
+    limit = min(max(data['limit'], 1), MAX_PAGE_SIZE)
+
+    start = 0
+    if data['cursor']:
+        # Cursors are "<score>:<img_id>"; the score picks up where we left off if the image has since been deleted
+        try:
+            score, cursor_id = data['cursor'].split(':', 1)
+            score = float(score)
+        except ValueError:
+            abort(400, description='Invalid cursor')
+        rank = store.zrevrank(key, cursor_id)
+        if rank is None:
+            start = store.zcount(key, '({}'.format(repr(score)), '+inf')
+        else:
+            start = rank + 1
+
+    page = store.zrevrange(key, start, start + limit - 1, withscores=True)
+
+    next_cursor = None
+    if len(page) == limit:
+        last_id, last_score = page[-1]
+        next_cursor = '{}:{}'.format(repr(last_score), last_id)
+
+    return {'ids': [img_id for img_id, _ in page], 'next_cursor': next_cursor}
+
+
+def _job_params(img_id, job_id, data):
+    """
+    Validate an action on an image and build the params for its job
+
+    :type data: dict
+    :param data: The "action" with its "extension", "size", "box" or "renditions" argument, and an optional output
+        "profile" and "callback" URL, as given to Image.put
+    """
+    # Enqueue a transcode job
+    if data.get('action') == 'transcode':
+        if not data.get('extension'):
+            abort(400, description='Transcoding requires an extension')
+        params = {'extension': _parse_extension(data['extension'])}
+
+    # Enqueue a resize job
+    elif data.get('action') == 'resize':
+        params = {'size': _parse_size(data.get('size'))}
+
+    # Enqueue a crop job
+    elif data.get('action') == 'crop':
+        params = {'box': _parse_box(data.get('box'))}
+
+    # Enqueue a job that renders several sizes of the image at once, as variants, without changing it
+    elif data.get('action') == 'renditions':
+        params = {'renditions': _parse_renditions(data.get('renditions'))}
+
+    else:
+        abort(400, description='Invalid image action: {}'.format(data.get('action')))
+
+    # Save the result with the encoder settings of this profile
+    if data.get('profile'):
+        if data['profile'] not in transcoder.PROFILES:
+            abort(400, description='Invalid profile. Use one of: {}'.format(', '.join(sorted(transcoder.PROFILES))))
+        params['profile'] = data['profile']
+
+    # Have the job's status POSTed to this URL when it finishes
+    if data.get('callback'):
+        if not notify.callback_allowed(data['callback']):
+            abort(400, description='Callbacks must be http:// or https:// URLs of public hosts')
+        params['callback'] = data['callback']
+
+    params.update(job_id=job_id, img_id=img_id)
+    return params
+
+
+def _record_job(pipe, img_id, job_id, action, sequence):
+    """
+    Add a job to its image's history, numbering it so clients can tell where it is in the image's sequence of jobs
+
+    :param sequence: The job's number: one more than the image's "sequence" as read in the transaction of _transaction
+    """
+    pipe.set('images.{img_id}.sequence'.format(img_id=img_id), sequence)
+    pipe.hset(jobs.key(job_id), 'sequence', sequence)
+    pipe.set('images.{img_id}.last_job'.format(img_id=img_id), job_id)
+    pipe.lpush('images.{img_id}.actions'.format(img_id=img_id), action)
+
+
+def _job_priority(requested, current, pending, user_id, action):
+    """
+    Choose the priority class of a job
+
+    :param requested: The class the client asked for, if any
+    :param current: The class of the image's queued jobs, while any are pending
+    """
+    if requested and requested not in transcoder.PRIORITIES:
+        abort(400, description='Invalid priority. Use one of: {}'.format(', '.join(transcoder.PRIORITIES)))
+
+    # Jobs for the same image must stay in order, so they all go through the same class
+    if current and int(pending or 0) > 0:
+        return current
+    return requested or USER_PRIORITIES.get(user_id) or ACTION_PRIORITIES.get(action) or transcoder.DEFAULT_PRIORITY
+
+
+def _job_cost(dimensions, action, params):
+    """
+    Estimate the cost of a job from the megapixels of the original it is rendered from (every job decodes it) times one
+    plus the megapixels it outputs
+    """
+    width, height = [int(v) for v in (dimensions or '0,0').split(',')]
+    if action == 'resize':
+        output = params['size'][0] * params['size'][1]
+    elif action == 'crop':
+        output = abs(params['box'][2] - params['box'][0]) * abs(params['box'][3] - params['box'][1])
+    elif action == 'renditions':
+        output = sum(width * height for width, height, extension in params['renditions'])
+    else:
+        output = width * height
+    return round(width * height / 1e6 * (1 + output / 1e6), 3)
+
+
+def _reject(exception_class, description):
+    """
+    Turn a job away, telling the client when to try again
+    """
+    exception = exception_class(description)
+    exception.data = {'description': description}
+    get_headers = exception.get_headers
+    exception.get_headers = lambda environ=None: get_headers(environ) + [('Retry-After', str(RETRY_AFTER))]
+    raise exception
+
+
+def _admit(backlog, demand):
+    """
+    Turn jobs away if their priority classes cannot take them now
+
+    :param backlog: {priority: (depth, cost)} of the jobs already queued, as from transcoder.queue.backlog()
+    :param demand: {priority: (count, cost)} of the jobs to queue
+    """
+    for priority, (count, cost) in demand.items():
+        depth, queued = backlog[priority]
+        if depth + count > MAX_QUEUE_DEPTH[priority]:
+            _reject(ServiceUnavailable, 'The {} queue is full. Try again later.'.format(priority))
+
+        # An empty class takes any job, however costly
+        if queued > 0 and queued + cost > MAX_QUEUE_COST[priority]:
+            _reject(TooManyRequests, 'Too much {} work is queued. Try again later.'.format(priority))
 
-    return ',\n'.join(jobs) or 'Empty Queue!'
+
+def _transaction(img_ids, attempt):
+    """
+    Queue jobs for images in a transaction, which is tried again if any of the images' jobs are queued or finish in the
+    meantime. Jobs for the same image must stay in order, so they all go through the same class; watching the images'
+    pending jobs and their class from before they are read keeps concurrent requests from choosing different ones, and
+    watching their sequence keeps them from giving their jobs the same number.
+
+    :param attempt: Function of the pipeline that reads the images' state, then puts the pipeline in a transaction and
+                    adds the jobs to it, returning what the caller needs
+    :return: Tuple of what the successful attempt returned and the results of its transaction
+    """
+    pipe = store.pipeline()
+    try:
+        while True:
+            pipe.watch(*['images.{img_id}.{key}'.format(img_id=img_id, key=key) for img_id in set(img_ids)
+                         for key in ('pending', 'priority', 'sequence')])
+            rv = attempt(pipe)
+            try:
+                return rv, pipe.execute()
+            except WatchError:
+                continue
+    finally:
+        pipe.reset()
+
+
+def _enqueue(pipe, img_id, job_id, action, params):
+    """
+    Queue a job for the workers
+    """
+    params['queued'] = time.time()
+    pipe.incr('images.{img_id}.pending'.format(img_id=img_id))
+    pipe.set('images.{img_id}.priority'.format(img_id=img_id), params['priority'])
+    jobs.create(pipe, job_id, img_id, action, status='queued', queued=params['queued'])
+    transcoder.queue.put((action, params), pipe)
 
 
 class Image(Resource):
@@ -81,16 +560,25 @@ class Image(Resource):
         'id': fields.String,
         'actions': fields.List(fields.String),
         'location': fields.String,
+        'original': fields.String,
+        'variants': fields.List(fields.String),
         'last_job': fields.String,
         'last_job_state': fields.String
     })
     def get(self, img_id):
-        location = store.get('images.{img_id}.location'.format(img_id=img_id))
-        actions = store.lrange('images.{img_id}.actions'.format(img_id=img_id), 0, -1)
+        pipe = store.pipeline(transaction=False)
+        pipe.get('images.{img_id}.location'.format(img_id=img_id))
+        pipe.get('images.{img_id}.original'.format(img_id=img_id))
+        pipe.hkeys('images.{img_id}.variants'.format(img_id=img_id))
+        pipe.lrange('images.{img_id}.actions'.format(img_id=img_id), 0, -1)
+        pipe.get('images.{img_id}.last_job'.format(img_id=img_id))
+        location, original, variants, actions, last_job = pipe.execute()
+
+        original = original or location
+        variants.sort()
         actions.reverse()
-        last_job = store.get('images.{img_id}.last_job'.format(img_id=img_id))
         if last_job:
-            last_job_state = store.get(last_job)
+            last_job_state = store.hget(jobs.key(last_job), 'status') or jobs.EXPIRED
         else:
             last_job = 'none'
             last_job_state = 'none'
@@ -99,6 +587,8 @@ class Image(Resource):
             'id': img_id,
             'actions': actions,
             'location': location,
+            'original': original,
+            'variants': variants,
             'last_job': last_job,
             'last_job_state': last_job_state
         }
@@ -110,69 +600,106 @@ class Image(Resource):
         parser.add_argument('extension', type=str, required=False)
         parser.add_argument('size', type=str, required=False)
         parser.add_argument('box', type=str, required=False)
+        parser.add_argument('renditions', type=str, required=False)
+        parser.add_argument('profile', type=str, required=False)
+        parser.add_argument('callback', type=str, required=False)
+        parser.add_argument('priority', type=str, required=False)
 
         data = parser.parse_args()
-
-        job_id = 'job-{}'.format(uuid.uuid4())
-
-        src = store.get('images.{img_id}.location'.format(img_id=img_id))
-
-        if not src:
-            abort(404)
-
-        params = {}
-
-        # Enqueue a transcode job
-        if data['action'] == 'transcode':
-            if 'extension' not in data:
-                abort(400, description='Transcoding requires an extension')
-            if data['extension'] not in ALLOWED_EXTENSIONS:
-                abort(400, description='Use valid extension: {}'.format(ALLOWED_EXTENSIONS))
-            base, ext = os.path.splitext(src)
-            dest = os.path.join('/tmp', '.'.join([base, data['extension']]))
-
-            params = {'src': src, 'dest': dest, 'job_id': job_id, 'img_id': img_id}
-
-        # Enqueue a resize job
-        elif data['action'] == 'resize':
-            try:
-                size = data['size'].split(',')
-                size = (int(size[0]), int(size[1]))
-            except (KeyError, TypeError, ValueError, AttributeError, IndexError):
-                abort(400, description='Invalid size. Specify width and height delimited by a comma: "50,50"')
-            params = {'src': src, 'dest': src, 'size': size, 'job_id': job_id, 'img_id': img_id}
-
-        # Enqueue a crop job
-        elif data['action'] == 'crop':
-            try:
-                box = data['box'].split(',')
-                box = (int(box[0]), int(box[1]), int(box[2]), int(box[3]))
-            except (KeyError, TypeError, ValueError, AttributeError, IndexError):
-                abort(400, description='Invalid bounding box. Specify box delimited by comma: "50,150,90,80"')
-            params = {'src': src, 'dest': src, 'box': box, 'job_id': job_id, 'img_id': img_id}
-
-        else:
-            abort(400, description='Invalid image action: {}'.format(data['action']))
-
-        store.set(job_id, 'queued')
-        store.set('images.{img_id}.last_job'.format(img_id=img_id), job_id)
-        store.lpush('images.{img_id}.actions'.format(img_id=img_id), data['action'])
-        transcoder.queue.put((data['action'], params))
-
+        started = time.time()
+
+        def attempt(transaction):
+            pipe = store.pipeline(transaction=False)
+            pipe.mget(*['images.{img_id}.{key}'.format(img_id=img_id, key=key) for key in (
+                'location', 'original', 'hash', 'steps', 'pending', 'dimensions', 'priority', 'user', 'bytes',
+                'sequence')])
+            pipe.hgetall(transcoder.queue.load)
+            pipe.incr(jobs.COUNTER)
+            image, load, number = pipe.execute()
+            timings = {'started': started, 'fetched': time.time()}
+            src, original, src_hash, applied, pending, dimensions, current, user_id, source_bytes, sequence = image
+
+            if not src:
+                abort(404)
+
+            job_id = jobs.new_id(number)
+
+            params = _job_params(img_id, job_id, data)
+
+            # Complete the job straight from the derivative cache, unless earlier jobs still have to change the image or
+            # it is due to have its history snapshotted, which the workers do
+            cached = None
+            if src_hash and int(pending or 0) <= 0 and data['action'] != 'renditions':
+                steps = json.loads(applied or '[]') + cache.operations([(data['action'], params)])
+                name, dest = transcoder.variant(img_id, original or src, steps)
+                if len(steps) <= transcoder.MAX_STEPS:
+                    cached = cache.get(cache.key(src_hash, steps, os.path.splitext(dest)[1]), count_miss=False)
+
+            if cached and not cache.link(cached[0], dest):
+                # The derivative was evicted since it was looked up, so the job is rendered after all
+                cached = None
+
+            if cached:
+                path, content_hash, output_bytes = cached
+                timings['cached'] = time.time()
+
+                # Images stored before their size was recorded have it looked up
+                source_bytes = int(source_bytes) if source_bytes else storage.backend.size(original or src)
+            else:
+                params['priority'] = _job_priority(data['priority'], current, pending, user_id, data['action'])
+                params['cost'] = _job_cost(dimensions, data['action'], params)
+                _admit(transcoder.queue.backlog(load), {params['priority']: (1, params['cost'])})
+
+            transaction.multi()
+            _record_job(transaction, img_id, job_id, data['action'], int(sequence or 0) + 1)
+            if cached:
+                transaction.setnx('images.{img_id}.original'.format(img_id=img_id), original or src)
+                transaction.set('images.{img_id}.location'.format(img_id=img_id), dest)
+                transaction.set('images.{img_id}.steps'.format(img_id=img_id), json.dumps(steps))
+                transaction.hset('images.{img_id}.variants'.format(img_id=img_id), name, dest)
+                jobs.create(transaction, job_id, img_id, data['action'], output_bytes=output_bytes,
+                            bytes_saved=source_bytes - output_bytes)
+                jobs.set_status(transaction, job_id, 'done', params.get('callback'))
+
+                # The job was never queued, and is finished as soon as it is recorded
+                params['queued'] = started
+                transcoder.record_timings(transaction, [(data['action'], params)],
+                                          dict(timings, finished=time.time()), dest)
+            else:
+                _enqueue(transaction, img_id, job_id, data['action'], params)
+            return job_id
+
+        job_id = _transaction([img_id], attempt)[0]
         return {'job_id': job_id}
 
     @marshal_with({'success': fields.Boolean})
     def delete(self, img_id):
-        location = store.get('images.{img_id}.location'.format(img_id=img_id))
-        os.unlink(location)
-
-        user_id = store.get('images.{img_id}.user'.format(img_id=img_id))
+        pipe = store.pipeline(transaction=False)
+        pipe.get('images.{img_id}.location'.format(img_id=img_id))
+        pipe.get('images.{img_id}.original'.format(img_id=img_id))
+        pipe.hvals('images.{img_id}.variants'.format(img_id=img_id))
+        pipe.get('images.{img_id}.user'.format(img_id=img_id))
+        pipe.get('images.{img_id}.hash'.format(img_id=img_id))
+        location, original, variants, user_id, content_hash = pipe.execute()
+
+        # The original may be shared with other images that have the same content
+        keys = set([location, original] + variants)
+        if original and original.startswith(uploads.BLOB_PREFIX):
+            keys.discard(original)
+            uploads.release(content_hash, original)
+
+        for key in keys:
+            if key:
+                storage.backend.delete(key)
 
         # Delete all data associated with this image
-        store.delete('images.{img_id}.location'.format(img_id=img_id))
-        store.delete('images.{img_id}.actions'.format(img_id=img_id))
-        store.lrem('images.all', 0, img_id)
-        store.lrem('user.{user_id}.images'.format(user_id=user_id), 0, img_id)
+        pipe = store.pipeline()
+        pipe.delete(*['images.{img_id}.{key}'.format(img_id=img_id, key=key) for key in (
+            'location', 'original', 'steps', 'variants', 'actions', 'sequence', 'pending', 'hash', 'format',
+            'dimensions', 'bytes', 'priority')])
+        pipe.zrem('images.all', img_id)
+        pipe.zrem('user.{user_id}.images'.format(user_id=user_id), img_id)
+        pipe.execute()
 
         return {'success': True}
 
@@ -182,9 +709,19 @@ class Images(Resource):
     API Resource for images (list and post)
     """
 
+    @marshal_with({
+        'ids': fields.List(fields.String),
+        'next_cursor': fields.String
+    })
+    def get(self):
+        return _list_page('images.all')
+
     @marshal_with({
         'id': fields.String,
-        'location': fields.String
+        'location': fields.String,
+        'format': fields.String,
+        'width': fields.Integer,
+        'height': fields.Integer
     })
     def post(self):
         parser = reqparse.RequestParser()
@@ -194,60 +731,284 @@ class Images(Resource):
 
         img_id = str(uuid.uuid4())
         user_id = data['user_id']
+        uploaded = time.time()
 
-        filename = secure_filename(str(uuid.uuid4()) + os.path.splitext(data['file'].filename)[-1])
-        filename = os.path.join('/tmp', filename)
-
-        data['file'].save(filename)
+        # The file was streamed to disk, hashed and sniffed while the request was parsed
+        upload = data['file'].stream
+        upload.finish()
 
-        if os.path.getsize(filename) == 0:
-            _log.warn('File with no bytes uploaded by user {} (img # {})'.format(user_id, img_id))
+        # Images with the same content share one stored file
+        filename = uploads.keep(upload)
 
         # Store data about this image
-        store.set('images.{img_id}.location'.format(img_id=img_id), filename)
-        store.set('images.{img_id}.user'.format(img_id=img_id), user_id)
-        store.lpush('images.{img_id}.actions'.format(img_id=img_id), 'upload')
-        store.lpush('images.all', img_id)
-        store.lpush('user.{user_id}.images'.format(user_id=user_id), img_id)
+        pipe = store.pipeline()
+        pipe.set('images.{img_id}.location'.format(img_id=img_id), filename)
+        pipe.set('images.{img_id}.original'.format(img_id=img_id), filename)
+        pipe.set('images.{img_id}.hash'.format(img_id=img_id), upload.hexdigest())
+        pipe.set('images.{img_id}.format'.format(img_id=img_id), upload.format)
+        pipe.set('images.{img_id}.dimensions'.format(img_id=img_id), '{},{}'.format(*upload.dimensions))
+        pipe.set('images.{img_id}.bytes'.format(img_id=img_id), upload.size)
+        pipe.set('images.{img_id}.user'.format(img_id=img_id), user_id)
+        pipe.lpush('images.{img_id}.actions'.format(img_id=img_id), 'upload')
+        pipe.zadd('images.all', uploaded, img_id)
+        pipe.zadd('user.{user_id}.images'.format(user_id=user_id), uploaded, img_id)
+        pipe.execute()
 
         return {
             'id': img_id,
-            'location': filename
+            'location': filename,
+            'format': upload.format,
+            'width': upload.dimensions[0],
+            'height': upload.dimensions[1]
         }
 
 
+class UserImages(Resource):
+    """
+    API Resource for the images uploaded by a user
+    """
+
+    @marshal_with({
+        'ids': fields.List(fields.String),
+        'next_cursor': fields.String
+    })
+    def get(self, user_id):
+        return _list_page('user.{user_id}.images'.format(user_id=user_id))
+
+
+def _job_status(job_id):
+    """
+    A job's status as read from Redis, for when its updates may have been missed
+    """
+    job = jobs.parse(job_id, *jobs.fetch(store.pipeline(transaction=False), job_id).execute())
+    return job['status'] if job else jobs.EXPIRED
+
+
 class Job(Resource):
     """
     API resource for a transcode job
     """
 
-    @marshal_with({'status': fields.String})
+    @marshal_with({
+        'status': fields.String,
+        'action': fields.String,
+        'img_id': fields.String,
+        'sequence': fields.Integer,
+        'error': fields.String,
+        'output_bytes': fields.Integer(default=None),
+        'bytes_saved': fields.Integer(default=None),
+        'timings': fields.Raw
+    })
     def get(self, job_id):
-        status = store.get(job_id)
-        if not status:
+        """
+        A job's status, along with the size of its result and how many bytes smaller than its source that is, and the
+        times at which it reached each of its stages. Jobs that finished long enough ago to have had their records
+        expire have the status "expired".
+        """
+        parser = reqparse.RequestParser()
+        parser.add_argument('wait', type=float, default=0, location='args')
+        wait = min(max(parser.parse_args()['wait'], 0), MAX_WAIT)
+
+        # Long poll: hold the request until the job finishes or the wait is over
+        updates = notify.watch(job_id) if wait else None
+        try:
+            job = jobs.parse(job_id, *jobs.fetch(store.pipeline(transaction=False), job_id).execute())
+            if not job:
+                abort(404)
+
+            waited = False
+            status = job['status']
+            deadline = time.time() + wait
+            while updates and not notify.finished(status) and time.time() < deadline:
+                try:
+                    status = updates.get(timeout=max(0, min(deadline - time.time(), SSE_KEEPALIVE)))
+                except Empty:
+                    status = None
+                if status is None:
+                    status = _job_status(job_id)
+                waited = True
+        finally:
+            if updates:
+                notify.unwatch(job_id, updates)
+
+        if waited:
+            job = jobs.parse(job_id, *jobs.fetch(store.pipeline(transaction=False), job_id).execute()) or job
+
+        return dict(job, timings=jobs.timings(job))
+
+
+@app.route('/job/<job_id>/events')
+def job_events(job_id):
+    """
+    Stream a job's status changes as Server-Sent Events, until it finishes
+    """
+    updates = notify.watch(job_id)
+    job = jobs.parse(job_id, *jobs.fetch(store.pipeline(transaction=False), job_id).execute())
+    if not job:
+        notify.unwatch(job_id, updates)
+        abort(404)
+
+    def stream(status):
+        try:
+            yield 'event: status\ndata: {}\n\n'.format(json.dumps({'job_id': job_id, 'status': status}))
+            while not notify.finished(status):
+                try:
+                    update = updates.get(timeout=SSE_KEEPALIVE)
+                except Empty:
+                    # Comment lines keep proxies from closing an idle stream
+                    yield ': keepalive\n\n'
+                    update = None
+                if update is None:
+                    update = _job_status(job_id)
+                if update != status:
+                    status = update
+                    yield 'event: status\ndata: {}\n\n'.format(json.dumps({'job_id': job_id, 'status': status}))
+        finally:
+            notify.unwatch(job_id, updates)
+
+    return Response(stream(job['status']), mimetype='text/event-stream', headers={'Cache-Control': 'no-cache'})
+
+
+class Batches(Resource):
+    """
+    API resource for submitting many jobs at once
+    """
+
+    @marshal_with({
+        'batch_id': fields.String,
+        'job_ids': fields.List(fields.String)
+    })
+    def post(self):
+        """
+        Queue a list of jobs, given as JSON: {"jobs": [{"img_id": ..., "action": "resize", "size": "50,50"}, ...]}.
+        Either every job is queued or, if any of them is invalid, none are.
+        """
+        body = request.get_json(force=True, silent=True)
+        entries = body.get('jobs') if isinstance(body, dict) else None
+        if not isinstance(entries, list) or not entries or not all(isinstance(entry, dict) for entry in entries):
+            abort(400, description='Specify a list of jobs: {"jobs": [{"img_id": ..., "action": ...}, ...]}')
+        if len(entries) > MAX_BATCH_SIZE:
+            abort(400, description='Batches are limited to {} jobs'.format(MAX_BATCH_SIZE))
+
+        batch_id = 'batch-{}'.format(uuid.uuid4())
+
+        def attempt(transaction):
+            pipe = store.pipeline(transaction=False)
+            for entry in entries:
+                pipe.mget(*['images.{img_id}.{key}'.format(img_id=entry.get('img_id'), key=key) for key in (
+                    'location', 'dimensions', 'pending', 'priority', 'user', 'sequence')])
+            pipe.hgetall(transcoder.queue.load)
+            pipe.incrby(jobs.COUNTER, len(entries))
+            images = pipe.execute()
+            first = images.pop() - len(entries) + 1
+            load = images.pop()
+
+            batch = []
+            priorities = {}
+            sequences = {}
+            demand = {}
+            for i, (entry, (location, dimensions, pending, current, user_id, sequence)) in enumerate(
+                    zip(entries, images)):
+                if not location:
+                    abort(404, description='Job {}: image {} does not exist'.format(i, entry.get('img_id')))
+
+                # Sizes and boxes may also be given as JSON lists
+                entry = dict((key, ','.join(str(v) for v in value) if isinstance(value, list) else value)
+                             for key, value in entry.items())
+
+                job_id = jobs.new_id(first + i)
+                try:
+                    params = _job_params(entry['img_id'], job_id, entry)
+
+                    # Jobs queued earlier in the batch count as pending for their image
+                    params['priority'] = priorities.get(entry['img_id']) or _job_priority(
+                        entry.get('priority'), current, pending, user_id, entry['action'])
+                except HTTPException as e:
+                    abort(e.code, description='Job {}: {}'.format(i, getattr(e, 'data', {}).get('description', e)))
+                params['cost'] = _job_cost(dimensions, entry['action'], params)
+                priorities[entry['img_id']] = params['priority']
+                sequences[entry['img_id']] = sequences.get(entry['img_id'], int(sequence or 0)) + 1
+
+                count, cost = demand.get(params['priority'], (0, 0))
+                demand[params['priority']] = (count + 1, cost + params['cost'])
+                batch.append((entry['img_id'], job_id, entry['action'], params, sequences[entry['img_id']]))
+
+            _admit(transcoder.queue.backlog(load), demand)
+
+            transaction.multi()
+            for img_id, job_id, action, params, sequence in batch:
+                _record_job(transaction, img_id, job_id, action, sequence)
+                _enqueue(transaction, img_id, job_id, action, params)
+            transaction.rpush('batches.{batch_id}.jobs'.format(batch_id=batch_id),
+                              *[job_id for _, job_id, _, _, _ in batch])
+            transaction.expire('batches.{batch_id}.jobs'.format(batch_id=batch_id), jobs.JOB_TTL)
+            return [job_id for _, job_id, _, _, _ in batch]
+
+        job_ids = _transaction([entry.get('img_id') for entry in entries], attempt)[0]
+        return {'batch_id': batch_id, 'job_ids': job_ids}
+
+
+class Batch(Resource):
+    """
+    API resource for the progress of a batch of jobs
+    """
+
+    @marshal_with({
+        'batch_id': fields.String,
+        'total': fields.Integer,
+        'queued': fields.Integer,
+        'processing': fields.Integer,
+        'done': fields.Integer,
+        'error': fields.Integer,
+        'expired': fields.Integer,
+        'complete': fields.Boolean
+    })
+    def get(self, batch_id):
+        job_ids = store.lrange('batches.{batch_id}.jobs'.format(batch_id=batch_id), 0, -1)
+        if not job_ids:
             abort(404)
-        return {'status': status}
+
+        pipe = store.pipeline(transaction=False)
+        for job_id in job_ids:
+            pipe.hget(jobs.key(job_id), 'status')
+        counts = {'queued': 0, 'processing': 0, 'done': 0, 'error': 0, 'expired': 0}
+        for status in pipe.execute():
+            # A job with no record is one that finished and expired
+            status = status or jobs.EXPIRED
+            if status in counts:
+                counts[status] += 1
+
+        return dict(counts, batch_id=batch_id, total=len(job_ids),
+                    complete=counts['done'] + counts['error'] + counts['expired'] == len(job_ids))
 
 
 api = Api(app)
 api.add_resource(Images, '/images')
 api.add_resource(Image, '/image/<img_id>')
+api.add_resource(UserImages, '/user/<user_id>/images')
 api.add_resource(Job, '/job/<job_id>')
+api.add_resource(Batches, '/batches')
+api.add_resource(Batch, '/batch/<batch_id>')
 
 
-# Development mode
-if __name__ == '__main__':
-
-    # Start all of the worker threads to do the transcoding
-    for _ in xrange(WORKER_THREAD_COUNT):
-        t = threading.Thread(target=transcoder.worker)
+def start_workers():
+    """
+    Transcode in a pool of processes, fed by a staged worker that reads and writes the images on threads of its own,
+    and deliver the callbacks of finished jobs. This is for development; in production, run worker.py.
+    """
+    transcoder.executor = transcoder.ProcessExecutor(WORKER_PROCESS_COUNT)
+    transcoder.StagedWorker(fetchers=WORKER_IO_THREAD_COUNT, writers=WORKER_IO_THREAD_COUNT).start()
+    for _ in xrange(CALLBACK_THREAD_COUNT):
+        t = threading.Thread(target=notify.deliver_callbacks)
         t.daemon = True
         t.start()
 
-    app.run(TEST_HOST, TEST_PORT, debug=True)
 
-# Production mode
+# Development mode
+if __name__ == '__main__':
+    start_workers()
+    app.run(TEST_HOST, TEST_PORT, debug=True, threaded=True)
+
+# Production mode: the jobs are processed by worker.py
 else:
     app.debug = False
-
-
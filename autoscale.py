@@ -0,0 +1,85 @@
+"""
+Autoscaling of the workers' pools. Each worker process renders up to its pool's size of jobs at once, in as many
+processes; an Autoscaler decides that size from the queue, growing the pool as soon as the jobs waiting would miss
+their target wait and shrinking it once the pool has been larger than needed for a while.
+
+By Little's law, a pool of n workers that take S seconds a job clears a queue of D jobs in D * S / n seconds, so
+keeping the wait under a target W takes D * S / W workers on top of those busy with jobs already. The worker
+processes sharing the queue each take their share of that.
+"""
+import math
+import time
+
+# Seconds that jobs should wait on the queue at most
+TARGET_WAIT = 10
+
+# Seconds a job is assumed to take until some have been timed, and the weight of each new timing in the average
+SERVICE_TIME = 1.0
+SMOOTHING = 0.2
+
+# Seconds the pool must have been larger than needed before it shrinks
+COOLDOWN = 30
+
+
+class Autoscaler(object):
+    """
+    Decides the size of a worker process's pool, between a minimum and a maximum
+    """
+
+    def __init__(self, minimum, maximum, target_wait=TARGET_WAIT, service_time=SERVICE_TIME, smoothing=SMOOTHING,
+                 cooldown=COOLDOWN):
+        if not 1 <= minimum <= maximum:
+            raise ValueError('The pool size must be at least 1, and its minimum no more than its maximum')
+        self.minimum = minimum
+        self.maximum = maximum
+        self.target_wait = target_wait
+        self.smoothing = smoothing
+        self.cooldown = cooldown
+
+        # Moving average of the seconds each job takes
+        self.service_time = service_time
+        self.size = minimum
+
+        # When the pool was first found to be larger than needed, if it still is
+        self._surplus_since = None
+
+    def observe(self, seconds, jobs=1):
+        """
+        Add the time a task of fused jobs took to the average
+        """
+        self.service_time += self.smoothing * (float(seconds) / jobs - self.service_time)
+
+    def wanted(self, depth, busy, workers=1):
+        """
+        The pool size that keeps the jobs queued now within the target wait
+
+        :param depth: Jobs waiting on the queue, for all of the worker processes
+        :param busy: Jobs the pool is working on
+        :param workers: Number of worker processes sharing the queue
+        """
+        share = float(depth) * self.service_time / self.target_wait / max(workers, 1)
+        return min(max(int(math.ceil(busy + share)), self.minimum), self.maximum)
+
+    def decide(self, depth, busy, workers=1, now=None):
+        """
+        Resize the pool for the current load: up at once, and down only after the cooldown
+
+        :return: Tuple of the new size and the reason for it: "up", "down", or None if it is unchanged
+        """
+        now = now or time.time()
+        wanted = self.wanted(depth, busy, workers)
+        if wanted >= self.size:
+            self._surplus_since = None
+            if wanted > self.size:
+                self.size = wanted
+                return self.size, 'up'
+            return self.size, None
+
+        if self._surplus_since is None:
+            self._surplus_since = now
+        if now - self._surplus_since < self.cooldown:
+            return self.size, None
+
+        self._surplus_since = None
+        self.size = wanted
+        return self.size, 'down'
@@ -0,0 +1,324 @@
+"""
+Benchmarks for the image service, run on a corpus of generated images of several sizes and formats:
+
+    micro   --  transcoder.resize, crop and transcode, timed directly on each image
+    load    --  A load generator that submits jobs to the app over HTTP and waits for each to finish. The app, its
+                workers and an in-process Redis stand-in (fakeredis) all run in this process, so no servers are needed.
+
+Everything is seeded, so runs with the same options do the same work. Results are written as JSON so that runs can be
+compared for regressions:
+
+    python benchmark.py --output results.json
+    python benchmark.py --suite micro --sizes small,medium --repeat 10
+"""
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import logging
+import argparse
+import platform
+import resource
+import tempfile
+import threading
+import multiprocessing
+from Queue import Queue, Empty
+
+import PIL
+from PIL import Image, ImageDraw
+
+import transcoder
+
+# Width and height of the generated images
+SIZES = {
+    'small': (640, 480),
+    'medium': (2048, 1536),
+    'large': (6000, 4000),
+}
+FORMATS = ('JPEG', 'PNG', 'BMP')
+EXTENSIONS = {'JPEG': '.jpeg', 'PNG': '.png', 'BMP': '.bmp'}
+
+
+def generate_image(path, size, image_format, seed=0):
+    """
+    Write an image made of overlapping shapes and a little noise, which compresses roughly like a photo does
+    """
+    rng = random.Random(seed)
+    width, height = size
+    image = Image.new('RGB', size, tuple(rng.randrange(256) for _ in xrange(3)))
+    draw = ImageDraw.Draw(image)
+    for _ in xrange(64):
+        x, y = rng.randrange(width), rng.randrange(height)
+        w, h = rng.randrange(width // 2 + 1), rng.randrange(height // 2 + 1)
+        draw.ellipse((x - w, y - h, x + w, y + h), fill=tuple(rng.randrange(256) for _ in xrange(3)))
+
+    noise = Image.effect_noise(size, 16).convert('RGB')
+    Image.blend(image, noise, 0.1).save(path, image_format)
+
+
+def generate_corpus(directory, sizes, formats=FORMATS):
+    """
+    Generate one image for each size and format
+
+    :return: List of (size name, format, path)
+    """
+    corpus = []
+    for seed, name in enumerate(sorted(sizes)):
+        for image_format in formats:
+            path = os.path.join(directory, '{}{}'.format(name, EXTENSIONS[image_format]))
+            generate_image(path, SIZES[name], image_format, seed)
+            corpus.append((name, image_format, path))
+    return corpus
+
+
+def percentile(values, p):
+    """
+    The nearest-rank percentile of a list of values
+    """
+    values = sorted(values)
+    if not values:
+        return None
+    return values[max(0, min(len(values) - 1, int(round(p / 100.0 * len(values))) - 1))]
+
+
+def summarize(seconds):
+    return {
+        'runs': len(seconds),
+        'min': min(seconds),
+        'median': percentile(seconds, 50),
+        'mean': sum(seconds) / len(seconds),
+    }
+
+
+def run_micro(corpus, scratch, repeat=5):
+    """
+    Time transcoder.resize, crop and transcode on every image of the corpus
+
+    :return: A result for each operation on each image, with the timings in seconds
+    """
+    results = []
+    for name, image_format, path in corpus:
+        width, height = SIZES[name]
+        target = 'png' if image_format != 'PNG' else 'jpeg'
+        operations = [
+            ('resize', lambda src, dest: transcoder.resize(src, dest, (200, 150)), EXTENSIONS[image_format]),
+            ('crop', lambda src, dest: transcoder.crop(src, dest, (width // 4, height // 4, width * 3 // 4,
+                                                                   height * 3 // 4)), EXTENSIONS[image_format]),
+            ('transcode', transcoder.transcode, '.' + target),
+        ]
+
+        for operation, func, ext in operations:
+            seconds = []
+            for _ in xrange(repeat):
+                # transcode removes its source, so every run gets its own copy
+                src = os.path.join(scratch, 'src' + EXTENSIONS[image_format])
+                dest = os.path.join(scratch, 'dest' + ext)
+                shutil.copyfile(path, src)
+
+                start = time.time()
+                func(src, dest)
+                seconds.append(time.time() - start)
+
+            result = summarize(seconds)
+            result.update(operation=operation, size=name, format=image_format)
+            results.append(result)
+            print >> sys.stderr, '{operation} {size} {format}: {median:.4f}s'.format(**result)
+    return results
+
+
+def _use_fake_redis(directory):
+    """
+    Point the app's modules at a fresh in-process Redis, and their files at a directory of their own
+    """
+    try:
+        import fakeredis
+        from redis import ConnectionPool
+    except ImportError:
+        sys.exit('The load benchmark needs fakeredis: pip install -r requirements-dev.txt')
+
+    import app
+    import cache
+    import metrics
+    import notify
+    import storage
+    import uploads
+
+    pool = ConnectionPool(connection_class=fakeredis.FakeConnection, server=fakeredis.FakeServer())
+    for module in (app, cache, notify, transcoder, uploads):
+        module.store = metrics.CountingRedis(connection_pool=pool)
+
+    storage.backend = storage.LocalStorage(os.path.join(directory, 'storage'))
+    uploads.UPLOAD_DIR = os.path.join(directory, 'uploads')
+    os.makedirs(uploads.UPLOAD_DIR)
+    return app
+
+
+def _jobs(img_ids, count, seed=0):
+    """
+    A reproducible mix of actions on the uploaded images
+    """
+    rng = random.Random(seed)
+    jobs = []
+    for _ in xrange(count):
+        img_id, (width, height) = rng.choice(img_ids)
+        action = rng.choice(('resize', 'crop', 'transcode'))
+        if action == 'resize':
+            data = {'size': '{},{}'.format(rng.randrange(50, 800), rng.randrange(50, 600))}
+        elif action == 'crop':
+            x, y = rng.randrange(width // 2), rng.randrange(height // 2)
+            w, h = rng.randrange(1, width // 2), rng.randrange(1, height // 2)
+            data = {'box': '{},{},{},{}'.format(x, y, x + w, y + h)}
+        else:
+            data = {'extension': rng.choice(('jpeg', 'png', 'bmp'))}
+        data['action'] = action
+        jobs.append((img_id, data))
+    return jobs
+
+
+def run_load(corpus, scratch, jobs=200, clients=8, images=16, seed=0):
+    """
+    Submit jobs to the app from concurrent clients, each waiting for its job to finish before submitting the next
+
+    :return: Throughput, job latency percentiles (from submitting a job to seeing it done) and peak RSS
+    """
+    import requests
+    from werkzeug.serving import make_server
+
+    app = _use_fake_redis(scratch)
+    app.start_workers()
+
+    logging.getLogger('werkzeug').setLevel(logging.WARNING)
+
+    server = make_server('127.0.0.1', 0, app.app, threaded=True)
+    t = threading.Thread(target=server.serve_forever)
+    t.daemon = True
+    t.start()
+    hostname = 'http://127.0.0.1:{}'.format(server.server_port)
+
+    # Every image gets its own ID (and so its own queue lane), even where the content is the same
+    uploaded = []
+    for i in xrange(images):
+        name, image_format, path = corpus[i % len(corpus)]
+        with open(path, 'rb') as f:
+            resp = requests.post(hostname + '/images', data={'user_id': 'benchmark'},
+                                 files={'file': (os.path.basename(path), f)})
+        uploaded.append((resp.json()['id'], SIZES[name]))
+
+    pending = Queue()
+    for job in _jobs(uploaded, jobs, seed):
+        pending.put(job)
+
+    latencies = []
+    errors = []
+
+    def client():
+        session = requests.Session()
+        while True:
+            try:
+                img_id, data = pending.get(block=False)
+            except Empty:
+                return
+
+            submitted = time.time()
+            resp = session.put(hostname + '/image/{}'.format(img_id), data=data)
+            if resp.status_code != 200:
+                errors.append('{}: {}'.format(resp.status_code, resp.text))
+                continue
+
+            url = hostname + '/job/{}'.format(resp.json()['job_id'])
+            status = None
+            while status not in ('done',) and not (status or '').startswith('error'):
+                status = session.get(url, params={'wait': app.MAX_WAIT}).json()['status']
+            if status == 'done':
+                latencies.append(time.time() - submitted)
+            else:
+                errors.append(status)
+
+    start = time.time()
+    threads = [threading.Thread(target=client) for _ in xrange(clients)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    seconds = time.time() - start
+    server.shutdown()
+
+    # ru_maxrss is in kilobytes on Linux; the worker processes count too
+    peak_rss = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+                   resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+
+    result = {
+        'jobs': jobs,
+        'clients': clients,
+        'images': images,
+        'completed': len(latencies),
+        'errors': len(errors),
+        'seconds': seconds,
+        'throughput': len(latencies) / seconds,
+        'latency': dict(('p{}'.format(p), percentile(latencies, p)) for p in (50, 95, 99)),
+        'peak_rss_mb': peak_rss / 1024.0,
+    }
+    result['latency']['max'] = max(latencies) if latencies else None
+    print >> sys.stderr, '{completed} jobs in {seconds:.2f}s: {throughput:.1f} jobs/s'.format(**result)
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the image service')
+    parser.add_argument('--suite', choices=('all', 'micro', 'load'), default='all')
+    parser.add_argument('--sizes', default='small,medium,large',
+                        help='Comma-delimited image sizes to generate: {}'.format(', '.join(sorted(SIZES))))
+    parser.add_argument('--repeat', type=int, default=5, help='Runs of each micro-benchmark')
+    parser.add_argument('--jobs', type=int, default=200, help='Jobs submitted by the load generator')
+    parser.add_argument('--clients', type=int, default=8, help='Concurrent clients of the load generator')
+    parser.add_argument('--images', type=int, default=16, help='Images uploaded for the load generator to work on')
+    parser.add_argument('--load-size', default='medium', help='Size of the images the load generator works on')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help='File to write the results to, instead of stdout')
+    args = parser.parse_args()
+
+    sizes = args.sizes.split(',')
+    if set(sizes + [args.load_size]) - set(SIZES):
+        parser.error('Sizes must be among: {}'.format(', '.join(sorted(SIZES))))
+
+    results = {
+        'started': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'environment': {
+            'python': platform.python_version(),
+            'pillow': getattr(PIL, 'PILLOW_VERSION', None),
+            'platform': platform.platform(),
+            'cpus': multiprocessing.cpu_count(),
+        },
+        'options': vars(args),
+    }
+
+    directory = tempfile.mkdtemp(prefix='benchmark-')
+    try:
+        if args.suite in ('all', 'micro'):
+            corpus_dir = os.path.join(directory, 'corpus')
+            os.makedirs(corpus_dir)
+            os.makedirs(os.path.join(directory, 'micro'))
+            corpus = generate_corpus(corpus_dir, sizes)
+            results['micro'] = run_micro(corpus, os.path.join(directory, 'micro'), args.repeat)
+
+        if args.suite in ('all', 'load'):
+            corpus_dir = os.path.join(directory, 'load-corpus')
+            os.makedirs(corpus_dir)
+            corpus = generate_corpus(corpus_dir, [args.load_size])
+            results['load'] = run_load(corpus, os.path.join(directory, 'load'), args.jobs, args.clients, args.images,
+                                       args.seed)
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+    output = json.dumps(results, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+    else:
+        print output
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,184 @@
+"""
+A content-addressed cache of derived images. Results of resize, crop and transcode jobs are stored on disk under a key
+made from a hash of the source image's bytes and the operations applied to it, so identical requests on identical
+images are never computed twice, no matter which image or user they come from.
+
+The files are kept in storage under keys starting with CACHE_PREFIX, and are indexed in Redis under these keys:
+
+    cache.derivatives.lru       --  Sorted set of cache keys scored by when they were last used
+    cache.derivatives.sizes     --  Hash of cache key to the size in bytes of its file
+    cache.derivatives.hashes    --  Hash of cache key to the content hash of its file
+    cache.derivatives.bytes     --  Total size in bytes of all cached files
+    cache.derivatives.stats     --  Hash of "hits", "misses" and "evictions" counters
+
+Cached files are never modified in place, so they can be copied (or hard linked) to their destinations.
+"""
+import json
+import time
+import hashlib
+import logging
+
+import metrics
+import storage
+
+_log = logging.getLogger(__name__)
+
+store = metrics.CountingRedis()
+
+CACHE_PREFIX = 'derivatives/'
+
+# The least recently used derivatives are evicted once the cache grows past this many bytes
+CACHE_MAX_BYTES = 1024 * 1024 * 1024
+
+# The job params that affect the output of each action; everything else is bookkeeping
+OPERATION_PARAMS = {
+    'transcode': ('extension', 'profile'),
+    'resize': ('size', 'profile'),
+    'crop': ('box', 'profile'),
+}
+
+LRU = 'cache.derivatives.lru'
+SIZES = 'cache.derivatives.sizes'
+HASHES = 'cache.derivatives.hashes'
+BYTES = 'cache.derivatives.bytes'
+STATS = 'cache.derivatives.stats'
+
+
+def file_hash(path):
+    """
+    The hex SHA-1 of a file's contents
+    """
+    digest = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(64 * 1024), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def operations(steps):
+    """
+    Strip a sequence of actions down to the params that affect their output
+
+    :type steps: list
+    :param steps: List of (action, params) pairs as they were put on the queue
+    :return: List of [action, params] pairs
+    """
+    return [[action, dict((name, params[name]) for name in OPERATION_PARAMS.get(action, ()) if name in params)]
+            for action, params in steps]
+
+
+def key(src_hash, steps, extension):
+    """
+    The cache key for the result of applying a sequence of actions to an image
+
+    :param src_hash: Content hash of the source image
+    :type steps: list
+    :param steps: List of (action, params) pairs as they were put on the queue
+    :param extension: The extension of the output file, e.g. ".png"
+    """
+    canonical = json.dumps([src_hash, operations(steps), extension.lower()], sort_keys=True)
+    return hashlib.sha1(canonical).hexdigest()
+
+
+def _path(cache_key):
+    return CACHE_PREFIX + cache_key
+
+
+def link(src, dest):
+    """
+    Store a file under a new key as well, replacing the destination atomically
+
+    :return: Whether the file was there to link; a cached file looked up with get() is gone if it was evicted since
+    """
+    return storage.backend.copy(src, dest)
+
+
+def get(cache_key, count_miss=True):
+    """
+    Look up a derivative in the cache
+
+    :param cache_key: The key from key()
+    :param count_miss: Whether a miss counts towards the stats; turn this off if the lookup will be retried later
+    :return: A tuple of the cached file's storage key, content hash and size in bytes, or None on a miss
+    """
+    path = _path(cache_key)
+    pipe = store.pipeline(transaction=False)
+    pipe.hget(HASHES, cache_key)
+    pipe.hget(SIZES, cache_key)
+    content_hash, size = pipe.execute()
+    if content_hash is None or not storage.backend.exists(path):
+        if count_miss:
+            store.hincrby(STATS, 'misses')
+        return None
+
+    pipe = store.pipeline()
+    pipe.zadd(LRU, time.time(), cache_key)
+    pipe.hincrby(STATS, 'hits')
+    pipe.execute()
+    return path, content_hash, int(size) if size is not None else storage.backend.size(path)
+
+
+def put(cache_key, src, content_hash, size=None):
+    """
+    Add a derivative to the cache, evicting the least recently used ones if the cache is full
+
+    :param cache_key: The key from key()
+    :param src: The storage key of the derivative
+    :param content_hash: Content hash of the derivative
+    :param size: Size in bytes of the derivative, if known
+    """
+    link(src, _path(cache_key))
+    size = storage.backend.size(src) if size is None else size
+
+    pipe = store.pipeline()
+    pipe.hget(SIZES, cache_key)
+    pipe.zadd(LRU, time.time(), cache_key)
+    pipe.hset(SIZES, cache_key, size)
+    pipe.hset(HASHES, cache_key, content_hash)
+    replaced = pipe.execute()[0]
+    total = store.incrby(BYTES, size - int(replaced or 0))
+
+    while total > CACHE_MAX_BYTES:
+        oldest = store.zrange(LRU, 0, 0)
+        if not oldest:
+            break
+        total = evict(oldest[0])
+
+
+def evict(cache_key):
+    """
+    Remove a derivative from the cache
+
+    :return: The total size of the cache after the eviction
+    """
+    # Only the process that removes the key from the index gets to delete the file
+    if not store.zrem(LRU, cache_key):
+        return int(store.get(BYTES) or 0)
+
+    pipe = store.pipeline()
+    pipe.hget(SIZES, cache_key)
+    pipe.hdel(SIZES, cache_key)
+    pipe.hdel(HASHES, cache_key)
+    pipe.hincrby(STATS, 'evictions')
+    size = pipe.execute()[0]
+
+    storage.backend.delete(_path(cache_key))
+    return store.decr(BYTES, int(size or 0))
+
+
+def stats():
+    """
+    Hit, miss and eviction counts along with the current size of the cache
+    """
+    pipe = store.pipeline()
+    pipe.hgetall(STATS)
+    pipe.zcard(LRU)
+    pipe.get(BYTES)
+    counters, entries, size = pipe.execute()
+    return {
+        'hits': int(counters.get('hits', 0)),
+        'misses': int(counters.get('misses', 0)),
+        'evictions': int(counters.get('evictions', 0)),
+        'entries': entries,
+        'bytes': int(size or 0),
+    }
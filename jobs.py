@@ -0,0 +1,124 @@
+"""
+Job records. Each job is a small Redis hash that expires some time after the job finishes, so that the records of
+finished jobs do not pile up. A bitmap of the jobs that have finished, indexed by the number in each job's ID, still
+tells an expired job from one that never existed, at one bit per job:
+
+    jobs.{job_id}       --  Hash of a job's "status", "action", "img_id", "sequence" (its position in its image's
+                            sequence of jobs), "error", the size of its result ("output_bytes") and how much smaller
+                            that is than its source ("bytes_saved"), and the times at which it reached each of its
+                            stages
+    jobs.counter        --  Number of jobs ever created
+    jobs.finished       --  Bitmap of the numbers of the jobs that have finished
+"""
+import re
+import uuid
+
+import notify
+
+COUNTER = 'jobs.counter'
+FINISHED = 'jobs.finished'
+
+# Seconds the record of a job is kept after it finishes
+JOB_TTL = 7 * 24 * 60 * 60
+
+# Status reported for jobs whose record has expired
+EXPIRED = 'expired'
+
+# Fields of a job's record other than the times at which it reached its stages
+FIELDS = ('status', 'action', 'img_id', 'sequence', 'error', 'output_bytes', 'bytes_saved')
+
+_job_id = re.compile(r'^job-(\d+)-[0-9a-f]+$')
+
+
+def key(job_id):
+    return 'jobs.{}'.format(job_id)
+
+
+def new_id(number):
+    """
+    The ID of a new job
+
+    :param number: The job's number, from incrementing COUNTER
+    """
+    return 'job-{}-{}'.format(number, uuid.uuid4().hex)
+
+
+def number(job_id):
+    """
+    The number of a job, or None for IDs that have none (those of jobs from before job numbers)
+    """
+    match = _job_id.match(job_id or '')
+    return int(match.group(1)) if match else None
+
+
+def create(pipe, job_id, img_id, action, **fields):
+    """
+    Record a new job
+
+    :param pipe: The pipeline to record the job with; it is left to the caller to execute
+    :param fields: Other fields of the job, such as the time it was "queued"
+    """
+    fields.update(img_id=img_id, action=action)
+    pipe.hmset(key(job_id), fields)
+    return pipe
+
+
+def status_fields(status):
+    """
+    The fields of a job's record that hold a status
+
+    :param status: "queued", "processing", "done", or "error: " followed by the error
+    """
+    if status.startswith('error'):
+        return {'status': 'error', 'error': status[len('error: '):]}
+    return {'status': status}
+
+
+def set_status(pipe, job_id, status, callback=None):
+    """
+    Change the status of a job and announce it. Jobs that finish start to expire.
+
+    :param status: As for status_fields()
+    :param callback: The job's callback URL, if it has one
+    """
+    pipe.hmset(key(job_id), status_fields(status))
+    if notify.finished(status):
+        pipe.expire(key(job_id), JOB_TTL)
+        if number(job_id) is not None:
+            pipe.setbit(FINISHED, number(job_id), 1)
+
+    notify.publish(pipe, job_id, status.split(':')[0], callback)
+    return pipe
+
+
+def fetch(pipe, job_id):
+    """
+    Read a job's record, along with whether it expired; pass the results to parse()
+
+    :param pipe: The pipeline to read the job with; it is left to the caller to execute
+    """
+    pipe.hgetall(key(job_id))
+
+    # Jobs are numbered from 1, so bit 0 is never set
+    pipe.getbit(FINISHED, number(job_id) or 0)
+    return pipe
+
+
+def parse(job_id, record, finished):
+    """
+    The record of a job, as read by fetch()
+
+    :return: The job's fields, with a "status" of EXPIRED if it finished and expired; None if there is no such job
+    """
+    if record:
+        return record
+    if finished:
+        return {'status': EXPIRED}
+    return None
+
+
+def timings(record):
+    """
+    The times at which a job reached each of its stages, from its record
+    """
+    return dict((stage, float(value)) for stage, value in record.items() if stage not in FIELDS)
@@ -0,0 +1,179 @@
+"""
+Instrumentation for the service. Redis round trips are counted per thread by CountingRedis, so each HTTP request or
+job can record how many it made; the totals are kept per process.
+
+Counters and histograms are kept in Redis, so that those of every process and machine add up, and are exposed in the
+Prometheus text format:
+
+    metrics.counters        --  Hash of counter values, by series
+    metrics.histograms      --  Hash of the number of observations in each histogram bucket, and their sum, by series
+"""
+import json
+import threading
+from collections import defaultdict
+
+from redis import StrictRedis
+from redis.client import StrictPipeline
+
+_local = threading.local()
+_lock = threading.Lock()
+
+# Name (an endpoint, or "worker") -> [number of times recorded, total round trips]
+_round_trips = defaultdict(lambda: [0, 0])
+
+COUNTERS = 'metrics.counters'
+HISTOGRAMS = 'metrics.histograms'
+
+# Upper bounds of the histogram buckets, in seconds
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300)
+
+# Metric name -> (type, help text)
+_descriptions = {}
+
+
+def _count():
+    _local.round_trips = getattr(_local, 'round_trips', 0) + 1
+
+
+class CountingPipeline(StrictPipeline):
+    """
+    A pipeline that counts as a single round trip when executed, plus one for each command it sends on its own: WATCH,
+    and the reads made while watching, before MULTI
+    """
+
+    def execute(self, raise_on_error=True):
+        _count()
+        return super(CountingPipeline, self).execute(raise_on_error)
+
+    def immediate_execute_command(self, *args, **options):
+        _count()
+        return super(CountingPipeline, self).immediate_execute_command(*args, **options)
+
+
+class CountingRedis(StrictRedis):
+    """
+    A Redis client that counts the round trips made by the current thread
+    """
+
+    def execute_command(self, *args, **options):
+        _count()
+        return super(CountingRedis, self).execute_command(*args, **options)
+
+    def pipeline(self, transaction=True, shard_hint=None):
+        return CountingPipeline(self.connection_pool, self.response_callbacks, transaction, shard_hint)
+
+
+def round_trips():
+    """
+    The number of round trips the current thread has made since it last recorded them
+    """
+    return getattr(_local, 'round_trips', 0)
+
+
+def reset_round_trips():
+    _local.round_trips = 0
+
+
+def record_round_trips(name):
+    """
+    Add the current thread's round trips to the totals for a name, and start counting again
+    """
+    count = round_trips()
+    reset_round_trips()
+    with _lock:
+        totals = _round_trips[name]
+        totals[0] += 1
+        totals[1] += count
+    return count
+
+
+def round_trip_stats():
+    """
+    Round trip totals and averages per name
+    """
+    with _lock:
+        return dict((name, {'count': count, 'round_trips': total, 'average': float(total) / count})
+                    for name, (count, total) in _round_trips.items() if count)
+
+
+def describe(name, kind, description):
+    """
+    Register a metric to expose, with its Prometheus type ("counter", "gauge" or "histogram") and help text
+    """
+    _descriptions[name] = (kind, description)
+
+
+def _series(name, labels):
+    return json.dumps([name, sorted(labels.items())])
+
+
+def increment(pipe, name, amount=1, **labels):
+    """
+    Add to a counter
+
+    :param pipe: The pipeline to update the counter with; it is left to the caller to execute
+    """
+    pipe.hincrby(COUNTERS, _series(name, labels), amount)
+    return pipe
+
+
+def observe(pipe, name, value, **labels):
+    """
+    Add an observation to a histogram
+
+    :param pipe: The pipeline to update the histogram with; it is left to the caller to execute
+    """
+    series = _series(name, labels)
+    bucket = next((str(bound) for bound in BUCKETS if value <= bound), '+Inf')
+    pipe.hincrby(HISTOGRAMS, json.dumps([series, bucket]), 1)
+    pipe.hincrbyfloat(HISTOGRAMS, json.dumps([series, 'sum']), value)
+    return pipe
+
+
+def _format(name, labels, value):
+    if labels:
+        name += '{{{}}}'.format(','.join('{}="{}"'.format(key, str(label).replace('\\', '\\\\').replace('"', '\\"'))
+                                         for key, label in labels))
+    return '{} {}'.format(name, repr(float(value)) if isinstance(value, float) else value)
+
+
+def exposition(counters, histograms, gauges=()):
+    """
+    Render metrics in the Prometheus text format
+
+    :param counters: The hash stored under COUNTERS
+    :param histograms: The hash stored under HISTOGRAMS
+    :param gauges: List of (name, labels, value) of the current values of gauges, where labels is a dict
+    :return: The exposition as a string
+    """
+    samples = defaultdict(list)
+
+    for series, value in sorted((counters or {}).items()):
+        name, labels = json.loads(series)
+        samples[name].append(_format(name, labels, int(value)))
+
+    for name, labels, value in gauges:
+        samples[name].append(_format(name, sorted(labels.items()), value))
+
+    # Buckets are stored by their own count; Prometheus expects each to include the smaller ones
+    buckets = defaultdict(dict)
+    for field, value in (histograms or {}).items():
+        series, bucket = json.loads(field)
+        buckets[series][bucket] = float(value) if bucket == 'sum' else int(value)
+    for series, counts in sorted(buckets.items()):
+        name, labels = json.loads(series)
+        total = 0
+        for bound in [str(bound) for bound in BUCKETS] + ['+Inf']:
+            total += counts.get(bound, 0)
+            samples[name].append(_format(name + '_bucket', labels + [['le', bound]], total))
+        samples[name].append(_format(name + '_sum', labels, counts.get('sum', 0.0)))
+        samples[name].append(_format(name + '_count', labels, total))
+
+    lines = []
+    for name in sorted(set(samples) | set(_descriptions)):
+        if name in _descriptions:
+            kind, description = _descriptions[name]
+            lines.append('# HELP {} {}'.format(name, description))
+            lines.append('# TYPE {} {}'.format(name, kind))
+        lines.extend(samples[name])
+    return '\n'.join(lines) + '\n'
@@ -0,0 +1,201 @@
+"""
+Data migrations for the Redis store. Run this against a store written by an older version of the app before starting
+the new version:
+
+    python migrate.py
+
+Migrations are idempotent, so it is safe to run again.
+"""
+import json
+import time
+import logging
+
+from redis import StrictRedis, WatchError
+
+import jobs
+import notify
+import transcoder
+
+_log = logging.getLogger(__name__)
+
+store = StrictRedis()
+
+
+def list_to_sorted_set(key, now=None):
+    """
+    Convert a list of image IDs, newest first, into a sorted set scored so that the order is kept. The list is replaced
+    atomically; nothing happens if the key is not a list.
+
+    :return: Number of image IDs migrated
+    """
+    now = now or time.time()
+    tmp = '{}.migrating'.format(key)
+
+    pipe = store.pipeline()
+    try:
+        pipe.watch(key)
+        if pipe.type(key) != 'list':
+            return 0
+
+        img_ids = pipe.lrange(key, 0, -1)
+
+        pipe.multi()
+        pipe.delete(tmp)
+        # Older entries sit further down the list; score them a millisecond apart back from now
+        for i, img_id in enumerate(img_ids):
+            pipe.zadd(tmp, now - i / 1000.0, img_id)
+        pipe.rename(tmp, key)
+        pipe.execute()
+    finally:
+        pipe.reset()
+
+    return len(img_ids)
+
+
+def migrate_image_indexes():
+    """
+    Move images.all and user.{user_id}.images from lists to sorted sets
+    """
+    keys = ['images.all'] + list(store.scan_iter('user.*.images'))
+    for key in keys:
+        migrated = list_to_sorted_set(key)
+        if migrated:
+            _log.info('Migrated {} image IDs in {}'.format(migrated, key))
+
+
+def migrate_queue_lanes(lanes=transcoder.LANE_COUNT):
+    """
+    Move the jobs in the transcoder's lanes from before it had priority classes into the default class. This must run
+    while no workers are running: jobs that were being processed are queued again, ahead of the pending ones.
+
+    :return: Number of jobs migrated
+    """
+    migrated = 0
+    for n in xrange(lanes):
+        old = '{}.{}'.format(transcoder.queue.name, n)
+        new = transcoder.queue.classes[transcoder.DEFAULT_PRIORITY][n].name
+        processing = '{}.processing'.format(old)
+
+        pipe = store.pipeline()
+        try:
+            pipe.watch(old, processing)
+            entries = pipe.lrange(old, 0, -1) + pipe.lrange(processing, 0, -1)
+            if not entries:
+                continue
+
+            # Both lists are newest first; appending them keeps the oldest jobs at the end that is taken from
+            pipe.multi()
+            pipe.rpush(new, *entries)
+            pipe.delete(old, processing, '{}.deadlines'.format(old))
+            pipe.hincrby(transcoder.queue.load, '{}.depth'.format(transcoder.DEFAULT_PRIORITY), len(entries))
+            pipe.execute()
+        finally:
+            pipe.reset()
+
+        migrated += len(entries)
+    return migrated
+
+
+def sweep_legacy_jobs():
+    """
+    Move the jobs from before job records, which kept their status, sequence and timings in keys of their own that
+    never expired ("{job_id}", "{job_id}.sequence" and "{job_id}.timings"), into job records, which start to expire as
+    they are moved. That includes the records of jobs that were queued or being processed: only those still on the
+    queue when migrate_queue_lanes runs are ever finished, at which point their records start to expire again. This
+    must run while no workers are running.
+
+    :return: Number of jobs migrated
+    """
+    migrated = 0
+
+    # The keys are deleted as they are moved, so they are all listed first rather than while scanning
+    for job_id in list(store.scan_iter('job-*')):
+        if '.' in job_id:
+            continue
+        sequence = '{}.sequence'.format(job_id)
+        timings = '{}.timings'.format(job_id)
+
+        pipe = store.pipeline()
+        try:
+            pipe.watch(job_id, sequence, timings)
+            if pipe.type(job_id) != 'string':
+                continue
+
+            record = pipe.hgetall(timings)
+            record.update(jobs.status_fields(pipe.get(job_id)))
+            if pipe.exists(sequence):
+                record['sequence'] = pipe.get(sequence)
+
+            # Anything already in the job's record is newer
+            record.update(pipe.hgetall(jobs.key(job_id)))
+
+            pipe.multi()
+            pipe.hmset(jobs.key(job_id), record)
+            pipe.expire(jobs.key(job_id), jobs.JOB_TTL)
+            if notify.finished(record['status']) and jobs.number(job_id) is not None:
+                pipe.setbit(jobs.FINISHED, jobs.number(job_id), 1)
+            pipe.delete(job_id, sequence, timings)
+            pipe.execute()
+        finally:
+            pipe.reset()
+
+        migrated += 1
+    return migrated
+
+
+def backfill_originals():
+    """
+    Record the location of images stored before originals were recorded as their original, so that jobs are rendered
+    from it rather than from whatever variant the image last pointed at. Images that have had steps applied since
+    without an original recorded cannot be recovered, and are left as they are.
+
+    :return: Number of images migrated
+    """
+    migrated = 0
+    for img_id in store.zrange('images.all', 0, -1):
+        location = 'images.{img_id}.location'.format(img_id=img_id)
+        original = 'images.{img_id}.original'.format(img_id=img_id)
+        steps = 'images.{img_id}.steps'.format(img_id=img_id)
+
+        pipe = store.pipeline()
+        try:
+            pipe.watch(location, original, steps)
+            current = pipe.get(location)
+            if pipe.exists(original) or not current:
+                continue
+            if json.loads(pipe.get(steps) or '[]'):
+                _log.warn('Image {} has had steps applied without an original; leaving it'.format(img_id))
+                continue
+
+            pipe.multi()
+            pipe.set(original, current)
+            pipe.execute()
+        except WatchError:
+            # A job moved the image on in the meantime, and recorded its original as it did
+            continue
+        finally:
+            pipe.reset()
+
+        migrated += 1
+    return migrated
+
+
+def main():
+    logging.basicConfig(level=logging.INFO)
+    migrate_image_indexes()
+
+    migrated = backfill_originals()
+    if migrated:
+        _log.info('Recorded the originals of {} images'.format(migrated))
+
+    migrated = sweep_legacy_jobs()
+    if migrated:
+        _log.info('Moved {} jobs into job records'.format(migrated))
+
+    migrated = migrate_queue_lanes()
+    if migrated:
+        _log.info('Moved {} queued jobs into the {} priority class'.format(migrated, transcoder.DEFAULT_PRIORITY))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,302 @@
+"""
+Job status notifications, so that clients do not have to poll for their jobs. Whenever a job changes status it is
+published on a channel that each app process subscribes to once, waking up the requests that are waiting on the job
+(long polls and event streams). Jobs submitted with a callback URL are also pushed onto a list when they finish, from
+which the callback threads POST them. A callback thread moves each one onto a processing list while it calls it, so
+that callbacks a thread was calling when its process died are put back on the list once their visibility timeout
+passes:
+
+    jobs.status                         --  Pub/sub channel of {"job_id": ..., "status": ...} messages
+    jobs.callbacks                      --  List of finished jobs whose callback URL has yet to be called
+    jobs.callbacks.processing           --  List of the callbacks being called
+    jobs.callbacks.deadlines            --  Sorted set of the callbacks being called, scored by when they are put back
+                                            on the list
+
+Callback URLs must be http:// or https:// URLs of hosts on public addresses, so that jobs cannot be used to reach
+the internal network; hosts listed in CALLBACK_ALLOWED_HOSTS are exempt from the latter.
+"""
+import json
+import time
+import socket
+import struct
+import logging
+import urlparse
+import threading
+from Queue import Queue
+from collections import defaultdict
+
+import requests
+from redis import ConnectionError
+
+import metrics
+
+_log = logging.getLogger(__name__)
+
+store = metrics.CountingRedis()
+
+STATUS_CHANNEL = 'jobs.status'
+CALLBACKS = 'jobs.callbacks'
+CALLBACKS_PROCESSING = 'jobs.callbacks.processing'
+CALLBACK_DEADLINES = 'jobs.callbacks.deadlines'
+
+# Seconds to wait for a callback URL to respond, and how many times to try it before giving up
+CALLBACK_TIMEOUT = 5
+CALLBACK_ATTEMPTS = 3
+
+# Seconds watch() waits for the status subscription to be in place before the caller reads the job's status
+SUBSCRIBE_TIMEOUT = 1
+
+# Seconds the callback threads wait for a finished job before checking whether they have been told to stop, which is
+# also how often they put back callbacks whose visibility timeout has passed
+CALLBACK_POLL = 5
+
+# Seconds a callback may be in progress before it is considered abandoned and put back on the list; this is well over
+# the time all its attempts take
+CALLBACK_VISIBILITY_TIMEOUT = 120
+
+# Schemes callback URLs may use, and hosts they may reach even if those are on private, loopback or link-local
+# addresses (e.g. services on the internal network that are meant to be called back)
+CALLBACK_SCHEMES = ('http', 'https')
+CALLBACK_ALLOWED_HOSTS = ()
+
+# IPv4 networks callbacks may not reach: "this" network, private, shared, loopback, link-local, multicast and reserved
+_INTERNAL_NETWORKS = ('0.0.0.0/8', '10.0.0.0/8', '100.64.0.0/10', '127.0.0.0/8', '169.254.0.0/16', '172.16.0.0/12',
+                      '192.168.0.0/16', '224.0.0.0/4', '240.0.0.0/4')
+
+_lock = threading.Lock()
+_listener = None
+
+# Set while the listener is subscribed to the status channel
+_subscribed = threading.Event()
+
+# Job ID -> queues of the requests waiting on it in this process
+_waiters = defaultdict(set)
+
+
+def finished(status):
+    """
+    Whether a job with this status will not change any more
+    """
+    return status in ('done', 'expired') or bool(status and status.startswith('error'))
+
+
+def publish(pipe, job_id, status, callback=None):
+    """
+    Announce a job's new status, and schedule its callback if it has finished
+
+    :param pipe: The pipeline that sets the status
+    """
+    message = json.dumps({'job_id': job_id, 'status': status})
+    pipe.publish(STATUS_CHANNEL, message)
+    if callback and finished(status):
+        pipe.lpush(CALLBACKS, json.dumps({'job_id': job_id, 'status': status, 'url': callback}))
+    return pipe
+
+
+def _listen():
+    while True:
+        try:
+            pubsub = store.pubsub()
+            pubsub.subscribe(STATUS_CHANNEL)
+            for message in pubsub.listen():
+                if message['type'] == 'subscribe':
+                    # Updates published before the subscription was in place are lost, so every waiter has to read its
+                    # job's status again
+                    _subscribed.set()
+                    with _lock:
+                        waiters = [waiter for queues in _waiters.values() for waiter in queues]
+                    for waiter in waiters:
+                        waiter.put(None)
+                    continue
+                if message['type'] != 'message':
+                    continue
+                update = json.loads(message['data'])
+                with _lock:
+                    waiters = list(_waiters.get(update['job_id'], ()))
+                for waiter in waiters:
+                    waiter.put(update['status'])
+        except ConnectionError, e:
+            _subscribed.clear()
+            _log.warn('Lost the job status subscription: {}'.format(e))
+            time.sleep(1)
+
+
+def watch(job_id):
+    """
+    Start receiving a job's status updates. Read the job's current status only after calling this, so no update in
+    between is missed. Updates are also missed while the subscription is down, which is why None is put on the queue
+    once it is back; read the job's status again then, and now and again in any case.
+
+    :return: A Queue that each new status of the job, or None, is put on
+    """
+    global _listener
+    updates = Queue()
+    with _lock:
+        if _listener is None:
+            _listener = threading.Thread(target=_listen)
+            _listener.daemon = True
+            _listener.start()
+        _waiters[job_id].add(updates)
+    _subscribed.wait(SUBSCRIBE_TIMEOUT)
+    return updates
+
+
+def unwatch(job_id, updates):
+    with _lock:
+        _waiters[job_id].discard(updates)
+        if not _waiters[job_id]:
+            del _waiters[job_id]
+
+
+def _internal(address):
+    """
+    Whether an IP address is one that callbacks may not reach
+    """
+    if ':' in address:
+        packed = socket.inet_pton(socket.AF_INET6, address.split('%')[0])
+        if packed.startswith('\0' * 10 + '\xff\xff'):
+            # An IPv4-mapped address
+            return _internal(socket.inet_ntoa(packed[12:]))
+        first, second = ord(packed[0]), ord(packed[1])
+        # Unspecified, loopback, unique local, link-local and multicast addresses
+        return (packed.lstrip('\0') in ('', '\x01') or first & 0xfe == 0xfc or (first, second & 0xc0) == (0xfe, 0x80)
+                or first == 0xff)
+
+    value = struct.unpack('!I', socket.inet_aton(address))[0]
+    for network in _INTERNAL_NETWORKS:
+        base, bits = network.split('/')
+        mask = (0xffffffff << (32 - int(bits))) & 0xffffffff
+        if value & mask == struct.unpack('!I', socket.inet_aton(base))[0]:
+            return True
+    return False
+
+
+def callback_allowed(url):
+    """
+    Whether a callback URL may be called: it must use one of CALLBACK_SCHEMES, and its host must be one of
+    CALLBACK_ALLOWED_HOSTS or resolve to public addresses only
+    """
+    try:
+        parts = urlparse.urlsplit(url)
+        if parts.scheme not in CALLBACK_SCHEMES or not parts.hostname:
+            return False
+        if parts.hostname in CALLBACK_ALLOWED_HOSTS:
+            return True
+        addresses = socket.getaddrinfo(parts.hostname, parts.port or 80, 0, socket.SOCK_STREAM)
+        return not any(_internal(address[4][0]) for address in addresses)
+    except (ValueError, socket.error):
+        return False
+
+
+def _take_callback():
+    """
+    Move the next finished job's callback onto the processing list, along with when it is put back if it is not
+    acknowledged by then
+
+    :return: The callback as it is stored, or None if none came in
+    """
+    payload = store.brpoplpush(CALLBACKS, CALLBACKS_PROCESSING, timeout=CALLBACK_POLL)
+    if payload is not None:
+        store.zadd(CALLBACK_DEADLINES, time.time() + CALLBACK_VISIBILITY_TIMEOUT, payload)
+    return payload
+
+
+def _ack_callback(payload):
+    """
+    Remove a callback taken with _take_callback(), once it has been called or given up on
+    """
+    pipe = store.pipeline()
+    pipe.lrem(CALLBACKS_PROCESSING, 1, payload)
+    pipe.zrem(CALLBACK_DEADLINES, payload)
+    pipe.execute()
+
+
+def requeue_callbacks():
+    """
+    Put callbacks whose visibility timeout has passed back on the list
+
+    :return: The number of callbacks put back
+    """
+    now = time.time()
+
+    # A thread that died between taking a callback and setting its deadline leaves a callback with no deadline
+    taken = store.lrange(CALLBACKS_PROCESSING, 0, -1)
+    if taken:
+        pipe = store.pipeline()
+        for payload in taken:
+            pipe.zscore(CALLBACK_DEADLINES, payload)
+        for payload, deadline in zip(taken, pipe.execute()):
+            if deadline is None:
+                store.zadd(CALLBACK_DEADLINES, now + CALLBACK_VISIBILITY_TIMEOUT, payload)
+
+    requeued = 0
+    for payload in store.zrangebyscore(CALLBACK_DEADLINES, 0, now):
+        # Only the thread that removes the deadline gets to put the callback back
+        if not store.zrem(CALLBACK_DEADLINES, payload):
+            continue
+        pipe = store.pipeline()
+        pipe.lrem(CALLBACKS_PROCESSING, 1, payload)
+        pipe.rpush(CALLBACKS, payload)
+        removed, _ = pipe.execute()
+        if not removed:
+            # The callback was acknowledged in the meantime
+            store.lrem(CALLBACKS, -1, payload)
+            continue
+        _log.warn('Requeued abandoned callback {}'.format(payload))
+        requeued += 1
+    return requeued
+
+
+def _call(callback):
+    """
+    POST a job's status to its callback URL, retrying with a backoff when that fails
+
+    :return: Whether the callback was called
+    """
+    if not callback_allowed(callback['url']):
+        _log.error('Refused the callback for job {} to {}'.format(callback['job_id'], callback['url']))
+        return False
+
+    for attempt in xrange(CALLBACK_ATTEMPTS):
+        if attempt:
+            time.sleep(2 ** attempt)
+        try:
+            # Redirects are not followed, as they could lead anywhere
+            resp = requests.post(callback['url'], timeout=CALLBACK_TIMEOUT, allow_redirects=False,
+                                 data=json.dumps({'job_id': callback['job_id'], 'status': callback['status']}),
+                                 headers={'Content-Type': 'application/json'})
+            resp.raise_for_status()
+            return True
+        except requests.RequestException, e:
+            _log.warn('Callback for job {} to {} failed: {}'.format(callback['job_id'], callback['url'], e))
+
+    _log.error('Gave up on the callback for job {} to {}'.format(callback['job_id'], callback['url']))
+    return False
+
+
+def deliver_callbacks(stopping=None):
+    """
+    Call the callback URLs of finished jobs as they come in, putting back those that other threads abandoned
+
+    :type stopping: threading.Event
+    :param stopping: Once this is set, return after the callback in progress, if any
+    """
+    next_requeue = 0
+    while stopping is None or not stopping.is_set():
+        try:
+            if time.time() >= next_requeue:
+                next_requeue = time.time() + CALLBACK_POLL
+                requeue_callbacks()
+
+            payload = _take_callback()
+            if payload is None:
+                continue
+
+            _call(json.loads(payload))
+            _ack_callback(payload)
+        except Exception, e:
+            # The callback, if one was taken, stays on the processing list until its visibility timeout passes
+            _log.warn('Could not deliver a callback: {}'.format(e))
+            time.sleep(1)
+
+        metrics.record_round_trips('callbacks')
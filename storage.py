@@ -0,0 +1,352 @@
+"""
+Where the image files are kept. Files are named by keys such as "blobs/{hash}.jpeg" or "variants/{img_id}/{name}.png",
+which is what the app stores in Redis as the locations of images, and are never rewritten with different content: a
+key is only ever written again with the same bytes, or deleted.
+
+The files go to `backend`, which is one of:
+
+    LocalStorage    --  A directory on this machine, sharded into two levels of subdirectories by a hash of each key,
+                        so that no directory holds more than a small share of the files
+    S3Storage       --  A bucket of an S3-compatible object store (this needs boto3), which every machine can reach
+
+Machines working from a remote backend wrap it in a ReadCache, which keeps the files they read on local disk, up to a
+size, so that hot images are not fetched again for every job:
+
+    storage.backend = storage.ReadCache(storage.S3Storage('images'), '/var/cache/images')
+
+An S3Storage that is not wrapped downloads the files it is asked for a local path of into a temporary directory, which
+is bounded the same way but starts out empty with every process.
+
+Keys that are absolute paths are the locations of files stored before there were backends; LocalStorage reads and
+deletes them where they are.
+"""
+import os
+import uuid
+import errno
+import shutil
+import hashlib
+import tempfile
+import threading
+from collections import OrderedDict
+
+try:
+    import boto3
+    from botocore.exceptions import ClientError
+except ImportError:
+    boto3 = None
+
+# Files are kept under this directory by the default backend: the images directory next to this module, which, unlike
+# a temporary directory, survives reboots
+STORAGE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'images')
+
+# Bytes of remote files each machine keeps in its read cache, by default
+READ_CACHE_MAX_BYTES = 10 * 1024 * 1024 * 1024
+
+# Bytes of objects an S3Storage that is not wrapped in a ReadCache keeps downloaded
+DOWNLOAD_MAX_BYTES = 1024 * 1024 * 1024
+
+
+def _makedirs(dirname):
+    try:
+        os.makedirs(dirname)
+    except OSError as e:
+        if e.errno != errno.EEXIST or not os.path.isdir(dirname):
+            raise
+
+
+class LocalStorage(object):
+    """
+    Files in a directory on this machine, at "{root}/{ab}/{cd}/{key}", where "abcd" starts the MD5 of the key
+    """
+
+    def __init__(self, root, depth=2):
+        """
+        :param depth: Levels of subdirectories to shard the files into, each of 256
+        """
+        self.root = root
+        self.depth = depth
+
+    def path(self, key):
+        """
+        The file holding a key; this is always on local disk
+        """
+        if os.path.isabs(key):
+            return key
+        digest = hashlib.md5(key).hexdigest()
+        shards = [digest[2 * i:2 * i + 2] for i in xrange(self.depth)]
+        return os.path.join(self.root, *(shards + key.split('/')))
+
+    local_path = path
+
+    def exists(self, key):
+        return os.path.exists(self.path(key))
+
+    def size(self, key):
+        return os.path.getsize(self.path(key))
+
+    def read(self, key):
+        with open(self.path(key), 'rb') as f:
+            return f.read()
+
+    def put(self, key, data):
+        """
+        Store bytes under a key, replacing what was there atomically
+        """
+        path = self.path(key)
+        _makedirs(os.path.dirname(path))
+        tmp = '{}.tmp-{}'.format(path, uuid.uuid4())
+        with open(tmp, 'wb') as f:
+            f.write(data)
+        os.rename(tmp, path)
+
+    def put_file(self, key, src, move=True):
+        """
+        Store a local file under a key, replacing what was there atomically
+
+        :param move: Whether the file may be moved into place rather than copied
+        """
+        path = self.path(key)
+        _makedirs(os.path.dirname(path))
+        tmp = '{}.tmp-{}'.format(path, uuid.uuid4())
+        moved = False
+        if move:
+            try:
+                os.rename(src, tmp)
+                moved = True
+            except OSError as e:
+                # Files on other filesystems are copied
+                if e.errno != errno.EXDEV:
+                    raise
+        if not moved:
+            shutil.copyfile(src, tmp)
+            if move:
+                os.unlink(src)
+        os.rename(tmp, path)
+
+    def copy(self, src, dest):
+        """
+        Store the contents of one key under another, hard linking the file where possible
+
+        :return: Whether there was anything to copy
+        """
+        path = self.path(dest)
+        _makedirs(os.path.dirname(path))
+        tmp = '{}.tmp-{}'.format(path, uuid.uuid4())
+        try:
+            try:
+                os.link(self.path(src), tmp)
+            except OSError as e:
+                if e.errno != errno.EXDEV:
+                    raise
+                shutil.copyfile(self.path(src), tmp)
+        except (OSError, IOError) as e:
+            if e.errno != errno.ENOENT:
+                raise
+            return False
+        os.rename(tmp, path)
+        return True
+
+    def rename(self, src, dest):
+        """
+        Move the contents of one key to another
+
+        :return: Whether there was anything to move
+        """
+        path = self.path(dest)
+        _makedirs(os.path.dirname(path))
+        try:
+            os.rename(self.path(src), path)
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+            return False
+        return True
+
+    def delete(self, key):
+        try:
+            os.unlink(self.path(key))
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+
+
+class S3Storage(object):
+    """
+    Objects in a bucket of an S3-compatible object store, named "{prefix}{key}"
+    """
+
+    def __init__(self, bucket, prefix='', client=None, **client_args):
+        """
+        :param client: A boto3 S3 client; one is made from client_args (e.g. endpoint_url for MinIO) if not given
+        """
+        if client is None:
+            if boto3 is None:
+                raise ImportError('S3Storage needs boto3: pip install boto3')
+            client = boto3.client('s3', **client_args)
+        self.bucket = bucket
+        self.prefix = prefix
+        self.client = client
+
+        # The ReadCache that local_path() downloads to, made on first use
+        self._downloads = None
+        self._lock = threading.Lock()
+
+    def _head(self, key):
+        try:
+            return self.client.head_object(Bucket=self.bucket, Key=self.prefix + key)
+        except ClientError as e:
+            if e.response['Error']['Code'] in ('404', 'NoSuchKey'):
+                return None
+            raise
+
+    def local_path(self, key):
+        """
+        A local file holding a key, downloaded to a temporary directory if it has not been already
+        """
+        with self._lock:
+            if self._downloads is None:
+                self._downloads = ReadCache(self, tempfile.mkdtemp(prefix='s3-downloads-'), DOWNLOAD_MAX_BYTES)
+        return self._downloads.local_path(key)
+
+    def exists(self, key):
+        return self._head(key) is not None
+
+    def size(self, key):
+        head = self._head(key)
+        if head is None:
+            raise IOError(errno.ENOENT, 'No such object', key)
+        return head['ContentLength']
+
+    def read(self, key):
+        try:
+            return self.client.get_object(Bucket=self.bucket, Key=self.prefix + key)['Body'].read()
+        except ClientError as e:
+            if e.response['Error']['Code'] in ('404', 'NoSuchKey'):
+                raise IOError(errno.ENOENT, 'No such object', key)
+            raise
+
+    def put(self, key, data):
+        self.client.put_object(Bucket=self.bucket, Key=self.prefix + key, Body=data)
+
+    def put_file(self, key, src, move=True):
+        self.client.upload_file(src, self.bucket, self.prefix + key)
+        if move:
+            os.unlink(src)
+
+    def copy(self, src, dest):
+        try:
+            self.client.copy_object(Bucket=self.bucket, Key=self.prefix + dest,
+                                    CopySource={'Bucket': self.bucket, 'Key': self.prefix + src})
+        except ClientError as e:
+            if e.response['Error']['Code'] in ('404', 'NoSuchKey'):
+                return False
+            raise
+        return True
+
+    def rename(self, src, dest):
+        if not self.copy(src, dest):
+            return False
+        self.delete(src)
+        return True
+
+    def delete(self, key):
+        self.client.delete_object(Bucket=self.bucket, Key=self.prefix + key)
+
+
+class ReadCache(object):
+    """
+    A bounded local copy of the files of another backend. Files are fetched into the cache the first time they are read
+    and kept as they are written, and the least recently used ones are dropped once the cache grows past its size.
+    Since keys are never rewritten with different content, the copies never go stale.
+    """
+
+    def __init__(self, backend, directory, max_bytes=READ_CACHE_MAX_BYTES):
+        self.backend = backend
+        self.local = LocalStorage(directory)
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+
+        # Key -> size of the files in the cache, least recently used first
+        self._entries = OrderedDict()
+        self._bytes = 0
+
+        # Pick up the files cached before a restart, oldest first
+        found = []
+        for dirpath, dirnames, filenames in os.walk(directory):
+            for filename in filenames:
+                if '.tmp-' in filename:
+                    continue
+                path = os.path.join(dirpath, filename)
+                key = '/'.join(os.path.relpath(path, directory).split(os.sep)[self.local.depth:])
+                found.append((os.path.getmtime(path), key, os.path.getsize(path)))
+        for mtime, key, size in sorted(found):
+            self._entries[key] = size
+            self._bytes += size
+
+    def _used(self, key, size):
+        """
+        Note that a key was used, dropping the least recently used keys if the cache is now too big
+        """
+        evicted = []
+        with self._lock:
+            self._bytes += size - self._entries.pop(key, 0)
+            self._entries[key] = size
+            while self._bytes > self.max_bytes and len(self._entries) > 1:
+                oldest, oldest_size = self._entries.popitem(last=False)
+                self._bytes -= oldest_size
+                evicted.append(oldest)
+
+        for oldest in evicted:
+            self.local.delete(oldest)
+
+    def _forget(self, key):
+        with self._lock:
+            self._bytes -= self._entries.pop(key, 0)
+        self.local.delete(key)
+
+    def local_path(self, key):
+        """
+        A local file holding a key, fetched from the backend if it is not in the cache
+        """
+        path = self.local.path(key)
+        if not os.path.exists(path):
+            self.local.put(key, self.backend.read(key))
+        self._used(key, os.path.getsize(path))
+        return path
+
+    def exists(self, key):
+        return self.local.exists(key) or self.backend.exists(key)
+
+    def size(self, key):
+        if self.local.exists(key):
+            return self.local.size(key)
+        return self.backend.size(key)
+
+    def read(self, key):
+        with open(self.local_path(key), 'rb') as f:
+            return f.read()
+
+    def put(self, key, data):
+        self.backend.put(key, data)
+        self.local.put(key, data)
+        self._used(key, len(data))
+
+    def put_file(self, key, src, move=True):
+        self.local.put_file(key, src, move)
+        self.backend.put_file(key, self.local.path(key), move=False)
+        self._used(key, self.local.size(key))
+
+    def copy(self, src, dest):
+        return self.backend.copy(src, dest)
+
+    def rename(self, src, dest):
+        self._forget(src)
+        return self.backend.rename(src, dest)
+
+    def delete(self, key):
+        self._forget(key)
+        self.backend.delete(key)
+
+
+# The backend the files are stored in; see the top of this module for sharing files between machines
+backend = LocalStorage(STORAGE_DIR)
@@ -3,6 +3,8 @@ This module is used by pytest to generate the fixtures at runtime
 """
 import pytest
 import os
+import random
+from PIL import Image
 from app import TEST_HOST, TEST_PORT
 
 # Use this hostname for all tests
@@ -16,4 +18,17 @@ def hostname(*args, **kwargs):
 
 @pytest.fixture
 def large_file(*args, **kwargs):
-    return os.path.join(os.path.dirname(os.path.abspath(__file__)), 'bridge.jpeg')
\ No newline at end of file
+    return os.path.join(os.path.dirname(os.path.abspath(__file__)), 'bridge.jpeg')
+
+
+@pytest.fixture
+def unique_file(tmpdir, large_file):
+    """
+    A copy of the large file with a corner painted a random colour, so that its content (and so everything derived
+    from it) has never been stored or cached before
+    """
+    image = Image.open(large_file)
+    image.paste(tuple(random.randrange(256) for _ in xrange(3)), (0, 0, 16, 16))
+    path = str(tmpdir.join('bridge.jpeg'))
+    image.save(path, 'JPEG')
+    return path
@@ -0,0 +1,69 @@
+import pytest
+
+from autoscale import Autoscaler
+
+
+def simulate(autoscaler, arrivals, service_time):
+    """
+    Run a pool against a synthetic load, a second at a time
+
+    :param arrivals: Jobs queued in each second
+    :param service_time: Seconds each job takes
+    :return: List of (pool size, seconds the queued jobs will wait) after each second, and the resizes
+    """
+    depth = 0.0
+    history = []
+    resizes = []
+    for second, count in enumerate(arrivals):
+        depth += count
+        done = min(depth, autoscaler.size / service_time)
+        depth -= done
+
+        # By Little's law, the jobs done in a second kept this many workers busy
+        busy = done * service_time
+        for _ in xrange(int(done)):
+            autoscaler.observe(service_time)
+
+        size, direction = autoscaler.decide(depth, busy, now=second)
+        if direction:
+            resizes.append((second, direction))
+        history.append((size, depth * service_time / size))
+    return history, resizes
+
+
+def test_autoscaler_follows_a_burst():
+    """
+    Test that the pool grows at once in a burst of jobs, keeps their wait under the target, and only shrinks, to what
+    the load needs, once it has been larger than needed for a cooldown
+    """
+    autoscaler = Autoscaler(1, 16, target_wait=5, cooldown=30)
+    arrivals = [0] * 10 + [20] * 60 + [0] * 60
+    history, resizes = simulate(autoscaler, arrivals, service_time=0.5)
+
+    # Idle at first, then 20 jobs a second that take half a second need 10 workers
+    assert all(size == 1 for size, wait in history[:10])
+    assert history[10][0] > 1
+    assert all(size >= 10 for size, wait in history[12:70])
+    assert all(wait <= 5 for size, wait in history[12:70])
+
+    # Once the backlog is cleared, the pool settles at the 10 workers the burst needs, a cooldown later
+    assert history[69][0] == 10
+    assert [direction for second, direction in resizes if second > 13] == ['down', 'down']
+
+    # It shrinks back to its minimum only a cooldown after the burst
+    assert all(size == 10 for size, wait in history[70:99])
+    assert history[-1][0] == 1
+
+
+def test_autoscaler_shares_the_queue():
+    """
+    Test that worker processes sharing a queue each take a share of its jobs, within their bounds
+    """
+    autoscaler = Autoscaler(2, 8, target_wait=10, service_time=1.0)
+    assert autoscaler.wanted(depth=0, busy=0) == 2
+    assert autoscaler.wanted(depth=40, busy=1) == 5
+    assert autoscaler.wanted(depth=40, busy=1, workers=4) == 2
+    assert autoscaler.wanted(depth=1000, busy=8) == 8
+
+    with pytest.raises(ValueError):
+        Autoscaler(4, 2)
@@ -0,0 +1,62 @@
+import time
+import uuid
+
+import requests
+
+
+def test_batch_jobs(hostname, large_file):
+    """
+    Test that a batch of jobs is queued in one request and that its progress can be followed
+
+    :param hostname: The hostname under test (this fixture is automatically injected by pytest)
+    :param large_file: A large-ish filename (this fixture is automatically injected by pytest)
+    """
+    img_ids = []
+    for _ in range(2):
+        with open(large_file, 'r') as f:
+            resp = requests.post(hostname + '/images',
+                                 data={'user_id': 'test-user-{}'.format(uuid.uuid4())},
+                                 files={'file': ('bridge.jpeg', f)})
+        img_ids.append(resp.json()['id'])
+
+    resp = requests.post(hostname + '/batches', json={'jobs': [
+        {'img_id': img_ids[0], 'action': 'resize', 'size': '100,100'},
+        {'img_id': img_ids[0], 'action': 'transcode', 'extension': 'png'},
+        {'img_id': img_ids[1], 'action': 'crop', 'box': [0, 0, 50, 50]},
+    ]})
+    assert resp.status_code == 200
+    batch_id = resp.json()['batch_id']
+    job_ids = resp.json()['job_ids']
+    assert len(job_ids) == 3
+
+    # Wait for the batch to complete
+    for _ in range(100):
+        progress = requests.get(hostname + '/batch/{}'.format(batch_id)).json()
+        if progress['complete']:
+            break
+        time.sleep(0.1)
+
+    assert progress['total'] == 3
+    assert progress['done'] == 3
+
+    # Each job can still be followed on its own
+    assert requests.get(hostname + '/job/{}'.format(job_ids[1])).json()['sequence'] == 2
+
+    resp = requests.get(hostname + '/image/{}'.format(img_ids[0]))
+    assert resp.json()['location'].endswith('.png')
+    actions = resp.json()['actions']
+
+    # A batch with an invalid job queues nothing
+    resp = requests.post(hostname + '/batches', json={'jobs': [
+        {'img_id': img_ids[0], 'action': 'resize', 'size': '100,100'},
+        {'img_id': img_ids[0], 'action': 'resize', 'size': '100'},
+    ]})
+    assert resp.status_code == 400
+    assert 'Job 1' in resp.json()['description']
+
+    resp = requests.get(hostname + '/image/{}'.format(img_ids[0]))
+    assert resp.json()['actions'] == actions
+
+    # Clean up the data
+    for img_id in img_ids:
+        requests.delete(hostname + '/image/{}'.format(img_id))
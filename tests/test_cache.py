@@ -0,0 +1,107 @@
+import uuid
+from io import BytesIO
+
+import pytest
+import requests
+from PIL import Image
+
+import cache
+import storage
+
+
+@pytest.fixture
+def derivatives(tmpdir, monkeypatch):
+    """
+    The derivative cache, with its files and index kept apart from the app's and room for 25 bytes
+
+    :param tmpdir: A temporary directory (this fixture is automatically injected by pytest)
+    :param monkeypatch: Patches the cache's settings (this fixture is automatically injected by pytest)
+    """
+    monkeypatch.setattr(storage, 'backend', storage.LocalStorage(str(tmpdir)))
+    prefix = 'test.derivatives.{}'.format(uuid.uuid4())
+    for name in ('LRU', 'SIZES', 'HASHES', 'BYTES', 'STATS'):
+        monkeypatch.setattr(cache, name, '{}.{}'.format(prefix, name.lower()))
+    monkeypatch.setattr(cache, 'CACHE_MAX_BYTES', 25)
+    return cache
+
+
+def test_cache_key():
+    """
+    Test that cache keys depend only on the source, the params that affect the output, and the output format
+    """
+    steps = [('resize', {'size': [50, 50], 'img_id': 'img-1', 'job_id': 'job-1'})]
+    key = cache.key('abc', steps, '.png')
+    assert key == cache.key('abc', [('resize', {'size': [50, 50], 'img_id': 'img-2', 'job_id': 'job-2'})], '.PNG')
+
+    assert key != cache.key('abd', steps, '.png')
+    assert key != cache.key('abc', steps, '.jpeg')
+    assert key != cache.key('abc', [('resize', {'size': [50, 51]})], '.png')
+    assert key != cache.key('abc', [('resize', {'size': [50, 50], 'profile': 'web-small'})], '.png')
+
+
+def test_cache_hits_and_evicts(derivatives):
+    """
+    Test that cached derivatives are found with their hash and size, and the least recently used evicted once it is
+    full
+
+    :param derivatives: The derivative cache (this fixture is automatically injected by pytest)
+    """
+    for name in 'abc':
+        storage.backend.put('variants/{}.png'.format(name), name * 10)
+
+    assert derivatives.get('a') is None
+    derivatives.put('a', 'variants/a.png', 'hash-a')
+    derivatives.put('b', 'variants/b.png', 'hash-b', size=10)
+
+    path, content_hash, size = derivatives.get('a')
+    assert storage.backend.read(path) == 'a' * 10
+    assert (content_hash, size) == ('hash-a', 10)
+
+    # "b" is the least recently used, so it makes room for "c"
+    derivatives.put('c', 'variants/c.png', 'hash-c')
+    assert derivatives.get('b') is None
+    assert derivatives.get('c')[1] == 'hash-c'
+    assert derivatives.get('a')[1] == 'hash-a'
+
+    assert derivatives.stats() == {'hits': 3, 'misses': 2, 'evictions': 1, 'entries': 2, 'bytes': 20}
+
+
+def test_evicted_derivatives_are_rendered(hostname, unique_file, monkeypatch):
+    """
+    Test that a job whose derivative is evicted between looking it up and linking it into place is rendered instead
+
+    :param hostname: The hostname under test (this fixture is automatically injected by pytest)
+    :param unique_file: A large-ish file never uploaded before (this fixture is automatically injected by pytest)
+    :param monkeypatch: Evicts derivatives as they are looked up (this fixture is automatically injected by pytest)
+    """
+    img_ids = []
+    for _ in xrange(2):
+        with open(unique_file, 'r') as f:
+            resp = requests.post(hostname + '/images',
+                                 data={'user_id': 'test-user-{}'.format(uuid.uuid4())},
+                                 files={'file': ('bridge.jpeg', f)})
+        img_ids.append(resp.json()['id'])
+
+        resp = requests.put(hostname + '/image/{}'.format(img_ids[-1]), data={'action': 'resize', 'size': '64,48'})
+        resp = requests.get(hostname + '/job/{}'.format(resp.json()['job_id']), params={'wait': 10})
+        assert resp.json()['status'] == 'done'
+
+        if len(img_ids) == 1:
+            # The first image's derivative is cached; have it evicted as soon as it is found
+            lookup = cache.get
+
+            def get(cache_key, count_miss=True):
+                cached = lookup(cache_key, count_miss)
+                if cached:
+                    storage.backend.delete(cached[0])
+                return cached
+            monkeypatch.setattr(cache, 'get', get)
+
+    assert 'cached' not in resp.json()['timings']
+    download = requests.get(hostname + '/serve/{}'.format(img_ids[-1]))
+    assert download.status_code == 200
+    assert Image.open(BytesIO(download.content)).size == (64, 48)
+
+    # Clean up the data
+    for img_id in img_ids:
+        requests.delete(hostname + '/image/{}'.format(img_id))
@@ -1,5 +1,8 @@
-import requests
 import uuid
+from io import BytesIO
+
+import requests
+from PIL import Image
 
 
 def test_crop_validation(hostname, large_file):
@@ -28,3 +31,35 @@ def test_crop_validation(hostname, large_file):
 
     # Clean up test data and delete the image
     requests.delete(hostname + '/image/{}'.format(img_id))
+
+
+def test_crop_bitmap(hostname, large_file):
+    """
+    Test cropping an uncompressed image, of which only the rows that are kept are decoded
+
+    :param hostname: The hostname under test (this fixture is automatically injected by pytest)
+    :param large_file: A large-ish filename (this fixture is automatically injected by pytest)
+    """
+    bitmap = BytesIO()
+    Image.open(large_file).save(bitmap, 'BMP')
+    bitmap.seek(0)
+
+    resp = requests.post(hostname + '/images',
+                         data={'user_id': 'test-user-{}'.format(uuid.uuid4())},
+                         files={'file': ('bridge.bmp', bitmap)})
+
+    img_id = resp.json()['id']
+
+    resp = requests.put(hostname + '/image/{}'.format(img_id), data={'action': 'crop', 'box': '25,25,900,200'})
+    resp = requests.get(hostname + '/job/{}'.format(resp.json()['job_id']), params={'wait': 10})
+    assert resp.json()['status'] == 'done'
+
+    # The band of rows is cropped exactly as the whole image would have been
+    download = requests.get(hostname + '/serve/{}'.format(img_id))
+    cropped = Image.open(BytesIO(download.content))
+    assert cropped.size == (875, 175)
+    expected = Image.open(large_file).crop((25, 25, 900, 200))
+    assert list(cropped.convert('RGB').getdata()) == list(expected.convert('RGB').getdata())
+
+    # Clean up test data and delete the image
+    requests.delete(hostname + '/image/{}'.format(img_id))
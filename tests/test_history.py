@@ -0,0 +1,83 @@
+import json
+import uuid
+from io import BytesIO
+
+import requests
+from PIL import Image
+
+import app
+import storage
+import transcoder
+
+
+def _upload(hostname, filename):
+    with open(filename, 'r') as f:
+        resp = requests.post(hostname + '/images',
+                             data={'user_id': 'test-user-{}'.format(uuid.uuid4())},
+                             files={'file': ('bridge.jpeg', f)})
+    return resp.json()['id']
+
+
+def test_history_is_snapshotted(hostname, unique_file, monkeypatch):
+    """
+    Test that once an image has had MAX_STEPS operations applied, its current variant becomes its original, and the
+    upload and the variants of it are let go
+
+    :param hostname: The hostname under test (this fixture is automatically injected by pytest)
+    :param unique_file: A large-ish file never uploaded before (this fixture is automatically injected by pytest)
+    :param monkeypatch: Patches the history limit (this fixture is automatically injected by pytest)
+    """
+    monkeypatch.setattr(transcoder, 'MAX_STEPS', 2)
+    img_id = _upload(hostname, unique_file)
+    upload = app.store.get('images.{img_id}.original'.format(img_id=img_id))
+
+    for size in ('500,400', '400,300', '300,200'):
+        resp = requests.put(hostname + '/image/{}'.format(img_id), data={'action': 'resize', 'size': size})
+        resp = requests.get(hostname + '/job/{}'.format(resp.json()['job_id']), params={'wait': 10})
+        assert resp.json()['status'] == 'done'
+
+    location, original, steps, dimensions = app.store.mget(
+        *['images.{img_id}.{key}'.format(img_id=img_id, key=key)
+          for key in ('location', 'original', 'steps', 'dimensions')])
+    assert original == location
+    assert json.loads(steps) == []
+    assert dimensions == '300,200'
+    assert not app.store.hlen('images.{img_id}.variants'.format(img_id=img_id))
+    assert not storage.backend.exists(upload)
+
+    # Jobs go on from the snapshot
+    resp = requests.put(hostname + '/image/{}'.format(img_id), data={'action': 'crop', 'box': '0,0,100,50'})
+    resp = requests.get(hostname + '/job/{}'.format(resp.json()['job_id']), params={'wait': 10})
+    assert resp.json()['status'] == 'done'
+    served = Image.open(BytesIO(requests.get(hostname + '/serve/{}'.format(img_id)).content))
+    assert served.size == (100, 50)
+
+    # Clean up the data
+    requests.delete(hostname + '/image/{}'.format(img_id))
+    assert not storage.backend.exists(original)
+
+
+def test_variants_are_capped(hostname, large_file, monkeypatch):
+    """
+    Test that an image keeps no more than MAX_VARIANTS variants, and that those removed are deleted from storage
+
+    :param hostname: The hostname under test (this fixture is automatically injected by pytest)
+    :param large_file: A large-ish filename (this fixture is automatically injected by pytest)
+    :param monkeypatch: Patches the variant limit (this fixture is automatically injected by pytest)
+    """
+    monkeypatch.setattr(transcoder, 'MAX_VARIANTS', 2)
+    img_id = _upload(hostname, large_file)
+
+    generated = set()
+    for width in xrange(10, 60, 10):
+        resp = requests.get(hostname + '/serve/{}'.format(img_id), params={'size': '{},{}'.format(width, width)})
+        assert resp.status_code == 200
+        generated.update(app.store.hvals('images.{img_id}.variants'.format(img_id=img_id)))
+
+    variants = app.store.hvals('images.{img_id}.variants'.format(img_id=img_id))
+    assert len(variants) == 2
+    assert len(generated) == 5
+    assert sorted(key for key in generated if storage.backend.exists(key)) == sorted(variants)
+
+    # Clean up the data
+    requests.delete(hostname + '/image/{}'.format(img_id))
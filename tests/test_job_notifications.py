@@ -0,0 +1,165 @@
+import json
+import time
+import uuid
+import threading
+from Queue import Queue
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+
+import pytest
+import polling
+import requests
+
+import app
+import jobs
+import notify
+
+
+def _upload(hostname, large_file):
+    with open(large_file, 'r') as f:
+        resp = requests.post(hostname + '/images',
+                             data={'user_id': 'test-user-{}'.format(uuid.uuid4())},
+                             files={'file': ('bridge.jpeg', f)})
+    return resp.json()['id']
+
+
+def test_job_long_poll(hostname, large_file):
+    """
+    Test that a job can be waited on with a single request instead of polling
+
+    :param hostname: The hostname under test (this fixture is automatically injected by pytest)
+    :param large_file: A large-ish filename (this fixture is automatically injected by pytest)
+    """
+    img_id = _upload(hostname, large_file)
+
+    resp = requests.put(hostname + '/image/{}'.format(img_id), data={'action': 'resize', 'size': '50,50'})
+    job_id = resp.json()['job_id']
+
+    resp = requests.get(hostname + '/job/{}'.format(job_id), params={'wait': 10})
+    assert resp.json()['status'] == 'done'
+
+    # Clean up the data
+    requests.delete(hostname + '/image/{}'.format(img_id))
+
+
+def test_job_events(hostname, large_file):
+    """
+    Test that a job's status changes are streamed as Server-Sent Events until it finishes
+
+    :param hostname: The hostname under test (this fixture is automatically injected by pytest)
+    :param large_file: A large-ish filename (this fixture is automatically injected by pytest)
+    """
+    img_id = _upload(hostname, large_file)
+
+    resp = requests.put(hostname + '/image/{}'.format(img_id), data={'action': 'crop', 'box': '0,0,50,50'})
+    job_id = resp.json()['job_id']
+
+    resp = requests.get(hostname + '/job/{}/events'.format(job_id), stream=True, timeout=10)
+    assert resp.headers['content-type'].startswith('text/event-stream')
+
+    statuses = [json.loads(line[len('data: '):])['status'] for line in resp.iter_lines() if line.startswith('data: ')]
+    assert statuses[-1] == 'done'
+
+    # Clean up the data
+    requests.delete(hostname + '/image/{}'.format(img_id))
+
+
+@pytest.fixture
+def callback_server(monkeypatch):
+    """
+    A local server that records the callbacks POSTed to it, which callbacks are allowed to reach
+
+    :param monkeypatch: Allows callbacks to the loopback address (this fixture is automatically injected by pytest)
+    :return: The server's URL and a Queue of the calls it received
+    """
+    calls = Queue()
+
+    class CallbackHandler(BaseHTTPRequestHandler):
+        def do_POST(self):
+            calls.put(json.loads(self.rfile.read(int(self.headers['Content-Length']))))
+            self.send_response(204)
+            self.end_headers()
+
+        def log_message(self, *args):
+            pass
+
+    server = HTTPServer(('127.0.0.1', 0), CallbackHandler)
+    t = threading.Thread(target=server.serve_forever)
+    t.daemon = True
+    t.start()
+    monkeypatch.setattr(notify, 'CALLBACK_ALLOWED_HOSTS', ('127.0.0.1',))
+    yield 'http://127.0.0.1:{}/done'.format(server.server_port), calls
+    server.shutdown()
+
+
+def test_job_callback(hostname, large_file, callback_server):
+    """
+    Test that a job's callback URL is called once the job finishes
+
+    :param hostname: The hostname under test (this fixture is automatically injected by pytest)
+    :param large_file: A large-ish filename (this fixture is automatically injected by pytest)
+    :param callback_server: Records the callbacks (this fixture is automatically injected by pytest)
+    """
+    url, calls = callback_server
+    img_id = _upload(hostname, large_file)
+
+    resp = requests.put(hostname + '/image/{}'.format(img_id),
+                        data={'action': 'transcode', 'extension': 'png', 'callback': url})
+    job_id = resp.json()['job_id']
+
+    assert calls.get(timeout=10) == {'job_id': job_id, 'status': 'done'}
+
+    # Callbacks must be URLs of public hosts
+    for callback in ('file:///etc/passwd', 'http://169.254.169.254/latest/meta-data', 'http://localhost:6379/',
+                     'http://10.1.2.3/', 'http://[::1]/', 'http://[::ffff:192.168.0.1]/'):
+        resp = requests.put(hostname + '/image/{}'.format(img_id),
+                            data={'action': 'transcode', 'extension': 'png', 'callback': callback})
+        assert resp.status_code == 400, callback
+
+    # Clean up the data
+    requests.delete(hostname + '/image/{}'.format(img_id))
+
+
+def test_abandoned_callbacks_are_requeued(callback_server):
+    """
+    Test that a callback whose thread died while calling it is called once its visibility timeout passes
+
+    :param callback_server: Records the callbacks (this fixture is automatically injected by pytest)
+    """
+    url, calls = callback_server
+    job_id = 'job-abandoned-{}'.format(uuid.uuid4())
+    payload = json.dumps({'job_id': job_id, 'status': 'done', 'url': url})
+
+    # As left by a thread that took the callback and died
+    app.store.lpush(notify.CALLBACKS_PROCESSING, payload)
+    app.store.zadd(notify.CALLBACK_DEADLINES, time.time() - 1, payload)
+
+    assert notify.requeue_callbacks() == 1
+    assert calls.get(timeout=10) == {'job_id': job_id, 'status': 'done'}
+    polling.poll(lambda: payload not in app.store.lrange(notify.CALLBACKS_PROCESSING, 0, -1), timeout=5, step=0.1)
+    assert notify.requeue_callbacks() == 0
+
+
+def test_missed_updates_are_caught_up(hostname, monkeypatch):
+    """
+    Test that requests waiting on a job see it finish even when its status update is never published to them
+
+    :param hostname: The hostname under test (this fixture is automatically injected by pytest)
+    :param monkeypatch: Patches how often the job's status is read again (this fixture is automatically injected by
+                        pytest)
+    """
+    monkeypatch.setattr(app, 'SSE_KEEPALIVE', 0.2)
+    job_id = jobs.new_id(app.store.incr(jobs.COUNTER))
+    jobs.create(app.store.pipeline(), job_id, 'no-such-image', 'resize', status='queued').execute()
+
+    # Finish the job behind the subscription's back
+    threading.Timer(0.5, lambda: app.store.hset(jobs.key(job_id), 'status', 'done')).start()
+    resp = requests.get(hostname + '/job/{}'.format(job_id), params={'wait': 10}, timeout=5)
+    assert resp.json()['status'] == 'done'
+
+    app.store.hset(jobs.key(job_id), 'status', 'queued')
+    threading.Timer(0.5, lambda: app.store.hset(jobs.key(job_id), 'status', 'done')).start()
+    resp = requests.get(hostname + '/job/{}/events'.format(job_id), stream=True, timeout=5)
+    statuses = [json.loads(line[len('data: '):])['status'] for line in resp.iter_lines() if line.startswith('data: ')]
+    assert statuses == ['queued', 'done']
+
+    app.store.delete(jobs.key(job_id))
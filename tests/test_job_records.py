@@ -0,0 +1,63 @@
+import uuid
+
+import requests
+
+import app
+import jobs
+import migrate
+
+
+def test_finished_jobs_expire(hostname, large_file):
+    """
+    Test that the records of finished jobs expire, and that expired jobs are told apart from ones that never existed
+
+    :param hostname: The hostname under test (this fixture is automatically injected by pytest)
+    :param large_file: A large-ish filename (this fixture is automatically injected by pytest)
+    """
+    with open(large_file, 'r') as f:
+        resp = requests.post(hostname + '/images',
+                             data={'user_id': 'test-user-{}'.format(uuid.uuid4())},
+                             files={'file': ('bridge.jpeg', f)})
+    img_id = resp.json()['id']
+
+    resp = requests.put(hostname + '/image/{}'.format(img_id), data={'action': 'resize', 'size': '50,50'})
+    job_id = resp.json()['job_id']
+    resp = requests.get(hostname + '/job/{}'.format(job_id), params={'wait': 10})
+    assert resp.json()['status'] == 'done'
+    assert 0 < app.store.ttl(jobs.key(job_id)) <= jobs.JOB_TTL
+
+    # As if the record had expired
+    app.store.delete(jobs.key(job_id))
+    resp = requests.get(hostname + '/job/{}'.format(job_id))
+    assert resp.status_code == 200
+    assert resp.json()['status'] == jobs.EXPIRED
+
+    resp = requests.get(hostname + '/job/{}'.format(jobs.new_id(app.store.incr(jobs.COUNTER))))
+    assert resp.status_code == 404
+
+    # Clean up the data
+    requests.delete(hostname + '/image/{}'.format(img_id))
+
+
+def test_sweep_legacy_jobs():
+    """
+    Test that jobs from before job records are moved into records that expire, whether or not they finished
+    """
+    legacy = {}
+    for status in ('done', 'queued', 'processing', 'error: Could not open the image'):
+        job_id = 'job-{}'.format(uuid.uuid4())
+        app.store.set(job_id, status)
+        app.store.set('{}.sequence'.format(job_id), 3)
+        app.store.hmset('{}.timings'.format(job_id), {'queued': 1.0, 'started': 2.0})
+        legacy[job_id] = status
+
+    assert migrate.sweep_legacy_jobs() >= len(legacy)
+    for job_id, status in legacy.items():
+        record = app.store.hgetall(jobs.key(job_id))
+        assert dict(record, **jobs.status_fields(status)) == record
+        assert (record['sequence'], record['queued'], record['started']) == ('3', '1.0', '2.0')
+        assert 0 < app.store.ttl(jobs.key(job_id)) <= jobs.JOB_TTL
+        assert not any(app.store.exists(key) for key in (job_id, job_id + '.sequence', job_id + '.timings'))
+
+    assert migrate.sweep_legacy_jobs() == 0
+    app.store.delete(*[jobs.key(job_id) for job_id in legacy])
@@ -3,6 +3,9 @@ import requests
 import uuid
 import time
 
+import app
+import jobs
+
 
 def test_job_states(hostname, large_file):
     """
@@ -60,3 +63,79 @@ def wait_for_job_done(url):
 
     assert finished, \
         'The resize job never completed but should have within the allotted time. Last status was "{}"'.format(status)
+
+
+def test_job_record(hostname, large_file):
+    """
+    Test that a job reports its action and image along with its status, and that unknown jobs are not found
+
+    :param hostname: The hostname under test (this fixture is automatically injected by pytest)
+    :param large_file: A large-ish filename (this fixture is automatically injected by pytest)
+    """
+    with open(large_file, 'r') as f:
+        resp = requests.post(hostname + '/images',
+                             data={'user_id': 'test-user-{}'.format(uuid.uuid4())},
+                             files={'file': ('bridge.jpeg', f)})
+
+    img_id = resp.json()['id']
+
+    resp = requests.put(hostname + '/image/{}'.format(img_id), data={'action': 'transcode', 'extension': 'png'})
+    resp = requests.get(hostname + '/job/{}'.format(resp.json()['job_id']), params={'wait': 10})
+    job = resp.json()
+    assert job['status'] == 'done'
+    assert job['action'] == 'transcode'
+    assert job['img_id'] == img_id
+    assert job['sequence'] == 1
+    assert job['error'] is None
+
+    assert requests.get(hostname + '/job/job-{}'.format(uuid.uuid4())).status_code == 404
+
+    # Clean up test data and delete the image
+    requests.delete(hostname + '/image/{}'.format(img_id))
+
+
+
+def test_job_sequence(hostname, large_file, monkeypatch):
+    """
+    Test that a job is numbered after the jobs submitted for its image while it was being submitted
+
+    :param hostname: The hostname under test (this fixture is automatically injected by pytest)
+    :param large_file: A large-ish filename (this fixture is automatically injected by pytest)
+    :param monkeypatch: Submits a job in the middle of another (this fixture is automatically injected by pytest)
+    """
+    with open(large_file, 'r') as f:
+        resp = requests.post(hostname + '/images',
+                             data={'user_id': 'test-user-{}'.format(uuid.uuid4())},
+                             files={'file': ('bridge.jpeg', f)})
+
+    img_id = resp.json()['id']
+
+    # Another job is numbered after this one has read the image's sequence, but before it is queued
+    job_params = app._job_params
+    interrupted = []
+
+    def _job_params(*args):
+        if not interrupted:
+            interrupted.append(app.store.incr('images.{img_id}.sequence'.format(img_id=img_id)))
+        return job_params(*args)
+    monkeypatch.setattr(app, '_job_params', _job_params)
+
+    # The job is numbered in the transaction that queues it, not in a write of its own that could be lost
+    transaction = app._transaction
+    numbered = []
+
+    def _transaction(img_ids, attempt):
+        job_id, results = transaction(img_ids, attempt)
+        numbered.append(app.store.hget(jobs.key(job_id), 'sequence'))
+        return job_id, results
+    monkeypatch.setattr(app, '_transaction', _transaction)
+
+    resp = requests.put(hostname + '/image/{}'.format(img_id), data={'action': 'transcode', 'extension': 'png'})
+    job = requests.get(hostname + '/job/{}'.format(resp.json()['job_id']), params={'wait': 10}).json()
+    assert interrupted == [1]
+    assert numbered == ['2']
+    assert job['sequence'] == 2
+    assert app.store.get('images.{img_id}.sequence'.format(img_id=img_id)) == '2'
+
+    # Clean up test data and delete the image
+    requests.delete(hostname + '/image/{}'.format(img_id))
@@ -0,0 +1,73 @@
+import uuid
+from io import BytesIO
+
+import requests
+from PIL import Image, ImageChops, ImageStat
+
+import app
+import migrate
+import transcoder
+
+
+def _upload_legacy(hostname, filename):
+    """
+    Upload an image, then strip it down to the keys images had before their originals and hashes were recorded
+
+    :return: The image's ID and location
+    """
+    with open(filename, 'r') as f:
+        resp = requests.post(hostname + '/images',
+                             data={'user_id': 'test-user-{}'.format(uuid.uuid4())},
+                             files={'file': ('bridge.jpeg', f)})
+    img_id = resp.json()['id']
+    app.store.delete(*['images.{img_id}.{key}'.format(img_id=img_id, key=key) for key in ('original', 'hash', 'bytes')])
+    return img_id, app.store.get('images.{img_id}.location'.format(img_id=img_id))
+
+
+def test_legacy_image_jobs(hostname, unique_file):
+    """
+    Test that the jobs of an image stored before originals were recorded are each rendered from its upload, and that
+    the upload is kept as its original
+
+    :param hostname: The hostname under test (this fixture is automatically injected by pytest)
+    :param unique_file: A large-ish file never uploaded before (this fixture is automatically injected by pytest)
+    """
+    img_id, location = _upload_legacy(hostname, unique_file)
+
+    steps = [('crop', {'box': [100, 100, 900, 500]}), ('resize', {'size': [200, 100]})]
+    for action, params in steps:
+        data = {'action': action}
+        data.update((name, ','.join(str(v) for v in value)) for name, value in params.items())
+        resp = requests.put(hostname + '/image/{}'.format(img_id), data=data)
+        resp = requests.get(hostname + '/job/{}'.format(resp.json()['job_id']), params={'wait': 10})
+        assert resp.json()['status'] == 'done'
+
+    image = requests.get(hostname + '/image/{}'.format(img_id)).json()
+    assert image['original'] == location
+
+    with open(unique_file, 'rb') as f:
+        expected, timings = transcoder.render(f.read(), steps, '.jpeg')
+    expected = Image.open(BytesIO(expected)).convert('RGB')
+    served = Image.open(BytesIO(requests.get(hostname + '/serve/{}'.format(img_id)).content)).convert('RGB')
+    assert served.size == expected.size
+    assert max(ImageStat.Stat(ImageChops.difference(served, expected)).mean) < 2
+
+    # Clean up the data
+    requests.delete(hostname + '/image/{}'.format(img_id))
+
+
+def test_backfill_originals(hostname, large_file):
+    """
+    Test that the migration records the location of legacy images without steps as their original
+
+    :param hostname: The hostname under test (this fixture is automatically injected by pytest)
+    :param large_file: A large-ish filename (this fixture is automatically injected by pytest)
+    """
+    img_id, location = _upload_legacy(hostname, large_file)
+
+    assert migrate.backfill_originals() >= 1
+    assert app.store.get('images.{img_id}.original'.format(img_id=img_id)) == location
+    assert migrate.backfill_originals() == 0
+
+    # Clean up the data
+    requests.delete(hostname + '/image/{}'.format(img_id))
@@ -0,0 +1,39 @@
+import uuid
+
+import requests
+
+
+def test_list_user_images(hostname, large_file):
+    """
+    Test that a user's images can be listed page by page, newest first
+
+    :param hostname: The hostname under test (this fixture is automatically injected by pytest)
+    :param large_file: A large-ish filename (this fixture is automatically injected by pytest)
+    """
+    user_id = 'test-user-{}'.format(uuid.uuid4())
+
+    img_ids = []
+    for _ in range(3):
+        with open(large_file, 'r') as f:
+            resp = requests.post(hostname + '/images', data={'user_id': user_id}, files={'file': ('bridge.jpeg', f)})
+        img_ids.insert(0, resp.json()['id'])
+
+    # Walk through the images two at a time
+    resp = requests.get(hostname + '/user/{}/images'.format(user_id), params={'limit': 2})
+    assert resp.status_code == 200
+    assert resp.json()['ids'] == img_ids[:2]
+    assert resp.json()['next_cursor']
+
+    resp = requests.get(hostname + '/user/{}/images'.format(user_id),
+                        params={'limit': 2, 'cursor': resp.json()['next_cursor']})
+    assert resp.json()['ids'] == img_ids[2:]
+    assert resp.json()['next_cursor'] is None
+
+    # Deleted images drop out of the listing
+    requests.delete(hostname + '/image/{}'.format(img_ids[0]))
+    resp = requests.get(hostname + '/user/{}/images'.format(user_id))
+    assert resp.json()['ids'] == img_ids[1:]
+
+    # Clean up test data and delete the images
+    for img_id in img_ids[1:]:
+        requests.delete(hostname + '/image/{}'.format(img_id))
@@ -0,0 +1,114 @@
+import uuid
+
+import requests
+from redis.client import StrictRedis
+
+import metrics
+
+
+def test_job_timings_and_metrics(hostname, unique_file):
+    """
+    Test that jobs record when they reached each stage, and that the stages show up in the metrics
+
+    :param hostname: The hostname under test (this fixture is automatically injected by pytest)
+    :param unique_file: A large-ish file never uploaded before (this fixture is automatically injected by pytest)
+    """
+    with open(unique_file, 'r') as f:
+        resp = requests.post(hostname + '/images',
+                             data={'user_id': 'test-user-{}'.format(uuid.uuid4())},
+                             files={'file': ('bridge.jpeg', f)})
+
+    img_id = resp.json()['id']
+
+    resp = requests.put(hostname + '/image/{}'.format(img_id), data={'action': 'resize', 'size': '64,48'})
+    resp = requests.get(hostname + '/job/{}'.format(resp.json()['job_id']), params={'wait': 10})
+    assert resp.json()['status'] == 'done'
+
+    timings = resp.json()['timings']
+    stages = ['queued', 'started', 'fetched', 'read', 'decoded', 'transformed', 'encoded', 'written', 'finished']
+    assert set(stages) <= set(timings)
+    assert [timings[stage] for stage in stages] == sorted(timings[stage] for stage in stages)
+
+    resp = requests.get(hostname + '/metrics')
+    assert resp.status_code == 200
+    assert resp.headers['content-type'].startswith('text/plain')
+    assert '# TYPE transcoder_stage_seconds histogram' in resp.text
+    assert 'transcoder_stage_seconds_count{action="resize",format="jpeg",stage="decode"}' in resp.text
+    assert 'transcoder_queue_depth{priority="default"}' in resp.text
+    assert 'transcoder_jobs_total{action="resize",status="done"}' in resp.text
+
+    # A job served from the derivative cache records its own stages
+    with open(unique_file, 'r') as f:
+        resp = requests.post(hostname + '/images',
+                             data={'user_id': 'test-user-{}'.format(uuid.uuid4())},
+                             files={'file': ('bridge.jpeg', f)})
+    copy_id = resp.json()['id']
+    resp = requests.put(hostname + '/image/{}'.format(copy_id), data={'action': 'resize', 'size': '64,48'})
+    resp = requests.get(hostname + '/job/{}'.format(resp.json()['job_id']), params={'wait': 10})
+    assert resp.json()['status'] == 'done'
+
+    timings = resp.json()['timings']
+    stages = ['queued', 'started', 'fetched', 'cached', 'finished']
+    assert set(timings) == set(stages)
+    assert [timings[stage] for stage in stages] == sorted(timings[stage] for stage in stages)
+
+    resp = requests.get(hostname + '/metrics')
+    assert 'transcoder_stage_seconds_count{action="resize",format="jpeg",stage="cache"}' in resp.text
+    requests.delete(hostname + '/image/{}'.format(copy_id))
+
+    # Clean up the data
+    requests.delete(hostname + '/image/{}'.format(img_id))
+
+
+class _Connection(object):
+    """
+    A Redis connection that answers each command with the next of a list of replies
+    """
+    retry_on_timeout = False
+
+    def __init__(self, replies):
+        self.replies = list(replies)
+
+    def send_command(self, *args):
+        pass
+
+    def send_packed_command(self, command):
+        pass
+
+    def pack_commands(self, commands):
+        return ''
+
+    def read_response(self):
+        return self.replies.pop(0)
+
+    def disconnect(self):
+        pass
+
+
+class _ConnectionPool(object):
+    def __init__(self, connection):
+        self.connection = connection
+
+    def get_connection(self, command_name, *keys, **options):
+        return self.connection
+
+    def release(self, connection):
+        pass
+
+
+def test_watch_transaction_round_trips():
+    """
+    Test that a transaction counts a round trip for its WATCH, each read made while watching, and its execution
+    """
+    connection = _Connection(['OK', '1', 'OK', 'QUEUED', 'QUEUED', ['OK', 2], 'OK'])
+    pipe = metrics.CountingPipeline(_ConnectionPool(connection), StrictRedis.RESPONSE_CALLBACKS, True, None)
+
+    metrics.reset_round_trips()
+    pipe.watch('counter')
+    value = int(pipe.get('counter'))
+    pipe.multi()
+    pipe.set('previous', value)
+    pipe.incr('counter')
+    assert pipe.execute() == [True, 2]
+    assert metrics.round_trips() == 3
+    assert not connection.replies
@@ -0,0 +1,99 @@
+import uuid
+
+import requests
+
+import app
+import transcoder
+
+
+def test_priority(hostname, large_file):
+    """
+    Test that jobs can be queued in a priority class, and that unknown classes are rejected
+
+    :param hostname: The hostname under test (this fixture is automatically injected by pytest)
+    :param large_file: A large-ish filename (this fixture is automatically injected by pytest)
+    """
+    with open(large_file, 'r') as f:
+        resp = requests.post(hostname + '/images',
+                             data={'user_id': 'test-user-{}'.format(uuid.uuid4())},
+                             files={'file': ('bridge.jpeg', f)})
+
+    img_id = resp.json()['id']
+
+    resp = requests.put(hostname + '/image/{}'.format(img_id),
+                        data={'action': 'resize', 'size': '50,50', 'priority': 'interactive'})
+    resp = requests.get(hostname + '/job/{}'.format(resp.json()['job_id']), params={'wait': 10})
+    assert resp.json()['status'] == 'done'
+
+    resp = requests.put(hostname + '/image/{}'.format(img_id),
+                        data={'action': 'crop', 'box': '0,0,20,20', 'priority': 'bulk'})
+    resp = requests.get(hostname + '/job/{}'.format(resp.json()['job_id']), params={'wait': 10})
+    assert resp.json()['status'] == 'done'
+
+    resp = requests.put(hostname + '/image/{}'.format(img_id),
+                        data={'action': 'resize', 'size': '50,50', 'priority': 'urgent'})
+    assert resp.status_code == 400
+    assert resp.json()['description'].startswith('Invalid priority')
+
+    # Clean up the data
+    requests.delete(hostname + '/image/{}'.format(img_id))
+
+
+def test_priority_order():
+    """
+    Test that workers take jobs from the most urgent priority class first, whatever order they were queued in
+    """
+    queue = transcoder.LaneQueue('test.queue.{}'.format(uuid.uuid4()), lanes=4)
+    queued = [('resize', {'img_id': 'img-{}'.format(priority), 'job_id': 'job-{}'.format(priority),
+                          'size': [50, 50], 'priority': priority}) for priority in ('bulk', 'default', 'interactive')]
+    for job in queued:
+        queue.put(job)
+
+    taken = []
+    for _ in queued:
+        job = tuple(queue.get(block=False))
+        taken.append(job[1]['priority'])
+        queue.ack(job)
+    assert taken == ['interactive', 'default', 'bulk']
+
+
+def test_admission(hostname, unique_file):
+    """
+    Test that jobs are turned away with a Retry-After while their priority class is full, singly and in batches
+
+    :param hostname: The hostname under test (this fixture is automatically injected by pytest)
+    :param unique_file: A large-ish file never uploaded before (this fixture is automatically injected by pytest)
+    """
+    with open(unique_file, 'r') as f:
+        resp = requests.post(hostname + '/images',
+                             data={'user_id': 'test-user-{}'.format(uuid.uuid4())},
+                             files={'file': ('bridge.jpeg', f)})
+
+    img_id = resp.json()['id']
+    job = {'action': 'resize', 'size': '50,50', 'priority': 'bulk'}
+
+    for field, limit, status_code in (('bulk.depth', app.MAX_QUEUE_DEPTH['bulk'], 503),
+                                      ('bulk.cost', app.MAX_QUEUE_COST['bulk'], 429)):
+        # Fill the class up to its limit, as if that many jobs were queued
+        transcoder.store.hincrbyfloat(transcoder.queue.load, field, limit)
+        try:
+            resp = requests.put(hostname + '/image/{}'.format(img_id), data=job)
+            assert resp.status_code == status_code
+            assert resp.headers['retry-after'] == str(app.RETRY_AFTER)
+
+            resp = requests.post(hostname + '/batches', json={'jobs': [dict(job, img_id=img_id)] * 2})
+            assert resp.status_code == status_code
+            assert resp.headers['retry-after'] == str(app.RETRY_AFTER)
+        finally:
+            transcoder.store.hincrbyfloat(transcoder.queue.load, field, -limit)
+
+    # None of the jobs turned away were queued, and the class takes jobs again once it has room
+    assert requests.get(hostname + '/image/{}'.format(img_id)).json()['actions'] == ['upload']
+    resp = requests.post(hostname + '/batches', json={'jobs': [dict(job, img_id=img_id)] * 2})
+    assert resp.status_code == 200
+    for job_id in resp.json()['job_ids']:
+        resp = requests.get(hostname + '/job/{}'.format(job_id), params={'wait': 10})
+        assert resp.json()['status'] == 'done'
+
+    # Clean up the data
+    requests.delete(hostname + '/image/{}'.format(img_id))
@@ -0,0 +1,55 @@
+import uuid
+
+import requests
+
+
+def test_output_profile(hostname, unique_file):
+    """
+    Test transcoding to WebP with an output profile, and that the job reports the bytes it saved
+
+    :param hostname: The hostname under test (this fixture is automatically injected by pytest)
+    :param unique_file: A large-ish file never uploaded before (this fixture is automatically injected by pytest)
+    """
+    with open(unique_file, 'r') as f:
+        resp = requests.post(hostname + '/images',
+                             data={'user_id': 'test-user-{}'.format(uuid.uuid4())},
+                             files={'file': ('bridge.jpeg', f)})
+
+    img_id = resp.json()['id']
+
+    resp = requests.put(hostname + '/image/{}'.format(img_id),
+                        data={'action': 'transcode', 'extension': 'webp', 'profile': 'nonexistent'})
+    assert resp.status_code == 400
+    assert resp.json()['description'].startswith('Invalid profile')
+
+    resp = requests.put(hostname + '/image/{}'.format(img_id),
+                        data={'action': 'transcode', 'extension': 'webp', 'profile': 'web-small'})
+    resp = requests.get(hostname + '/job/{}'.format(resp.json()['job_id']), params={'wait': 10})
+    job = resp.json()
+    assert job['status'] == 'done'
+    assert job['output_bytes'] > 0
+    assert job['bytes_saved'] > 0
+
+    download = requests.get(hostname + '/serve/{}'.format(img_id))
+    assert download.headers['content-type'] == 'image/webp'
+    assert len(download.content) == job['output_bytes']
+
+    resp = requests.get(hostname + '/metrics')
+    assert 'transcoder_output_bytes_total{profile="web-small"}' in resp.text
+
+    # A job served from the derivative cache reports the same sizes
+    with open(unique_file, 'r') as f:
+        resp = requests.post(hostname + '/images',
+                             data={'user_id': 'test-user-{}'.format(uuid.uuid4())},
+                             files={'file': ('bridge.jpeg', f)})
+    copy_id = resp.json()['id']
+    resp = requests.put(hostname + '/image/{}'.format(copy_id),
+                        data={'action': 'transcode', 'extension': 'webp', 'profile': 'web-small'})
+    resp = requests.get(hostname + '/job/{}'.format(resp.json()['job_id']), params={'wait': 10})
+    cached = resp.json()
+    assert cached['status'] == 'done'
+    assert (cached['output_bytes'], cached['bytes_saved']) == (job['output_bytes'], job['bytes_saved'])
+    requests.delete(hostname + '/image/{}'.format(copy_id))
+
+    # Clean up the data
+    requests.delete(hostname + '/image/{}'.format(img_id))
@@ -0,0 +1,64 @@
+from io import BytesIO
+
+from PIL import Image
+
+import transcoder
+
+
+def test_draft_decode_picks_reduced_scale(large_file, monkeypatch):
+    """
+    Test that JPEGs being downscaled are decoded at the smallest scale that keeps REDUCE_FACTOR times the target size,
+    and that the result is the size asked for all the same
+
+    :param large_file: A large-ish filename (this fixture is automatically injected by pytest)
+    :param monkeypatch: Patches the reduce factor (this fixture is automatically injected by pytest)
+    """
+    with open(large_file, 'rb') as f:
+        data = f.read()
+    width, height = Image.open(BytesIO(data)).size
+    steps = [('resize', {'size': [100, 48]})]
+
+    # 1/8 scale keeps at least twice the target size, so that is what the decoder picks
+    image, remaining = transcoder._decode(Image.open(BytesIO(data)), steps)
+    assert remaining == steps
+    assert image.size == ((width + 7) // 8, (height + 7) // 8)
+    assert transcoder.footprint(BytesIO(data), steps) == image.size[0] * image.size[1] + 100 * 48
+
+    # A larger target needs a larger scale
+    image = transcoder._decode(Image.open(BytesIO(data)), [('resize', {'size': [400, 192]})])[0]
+    assert image.size == ((width + 1) // 2, (height + 1) // 2)
+
+    output, timings = transcoder.render(data, steps, '.jpeg')
+    assert Image.open(BytesIO(output)).size == (100, 48)
+
+    # Without a reduce factor, or for formats that cannot be decoded at a reduced scale, the full image is decoded
+    monkeypatch.setattr(transcoder, 'REDUCE_FACTOR', 0)
+    assert transcoder._decode(Image.open(BytesIO(data)), steps)[0].size == (width, height)
+
+    monkeypatch.setattr(transcoder, 'REDUCE_FACTOR', 2)
+    png = BytesIO()
+    Image.open(BytesIO(data)).save(png, 'PNG')
+    png.seek(0)
+    assert transcoder._decode(Image.open(png), steps)[0].size == (width, height)
+
+
+def test_reduced_scale_keeps_both_sides(large_file):
+    """
+    Test that the decoder's scale keeps both sides at least REDUCE_FACTOR times the target's, for targets of other
+    shapes than the image, and is the largest that does
+
+    :param large_file: A large-ish filename (this fixture is automatically injected by pytest)
+    """
+    with open(large_file, 'rb') as f:
+        data = f.read()
+    width, height = Image.open(BytesIO(data)).size
+
+    for size in ([400, 20], [20, 200], [240, 115], [600, 10], [900, 450]):
+        image = transcoder._reduce(Image.open(BytesIO(data)), tuple(size))
+        scale = int(round(float(width) / image.size[0]))
+        assert image.size == (-(-width // scale), -(-height // scale)), size
+        assert image.size[0] >= size[0] * transcoder.REDUCE_FACTOR, size
+        assert image.size[1] >= size[1] * transcoder.REDUCE_FACTOR, size
+        if scale < 8:
+            assert (-(-width // (scale * 2)) < size[0] * transcoder.REDUCE_FACTOR or
+                    -(-height // (scale * 2)) < size[1] * transcoder.REDUCE_FACTOR), size
@@ -0,0 +1,70 @@
+import uuid
+from io import BytesIO
+
+import requests
+from PIL import Image
+
+
+def test_renditions(hostname, unique_file):
+    """
+    Test rendering a set of sizes of an image in one job, each of which is then served as a variant
+
+    :param hostname: The hostname under test (this fixture is automatically injected by pytest)
+    :param unique_file: A large-ish file never uploaded before (this fixture is automatically injected by pytest)
+    """
+    with open(unique_file, 'r') as f:
+        resp = requests.post(hostname + '/images',
+                             data={'user_id': 'test-user-{}'.format(uuid.uuid4())},
+                             files={'file': ('bridge.jpeg', f)})
+
+    img_id = resp.json()['id']
+    location = requests.get(hostname + '/image/{}'.format(img_id)).json()['location']
+
+    for bad_renditions in ('', '800', '800x600,0x10', '400x300.gif'):
+        resp = requests.put(hostname + '/image/{}'.format(img_id),
+                            data={'action': 'renditions', 'renditions': bad_renditions})
+        assert resp.status_code == 400, 'Request should have failed but did not with: {}'.format(bad_renditions)
+
+    resp = requests.put(hostname + '/image/{}'.format(img_id),
+                        data={'action': 'renditions', 'renditions': '800x600,400x300.webp,100x75',
+                              'profile': 'web-fast'})
+    resp = requests.get(hostname + '/job/{}'.format(resp.json()['job_id']), params={'wait': 10})
+    job = resp.json()
+    assert job['status'] == 'done'
+    assert job['output_bytes'] > 0
+
+    # The image itself is left as it was, with the renditions among its variants
+    image = requests.get(hostname + '/image/{}'.format(img_id)).json()
+    assert image['location'] == location
+    assert len(image['variants']) == 3
+
+    for params, size, content_type in (({'size': '800,600'}, (800, 600), 'image/jpeg'),
+                                       ({'size': '400,300', 'format': 'webp'}, (400, 300), 'image/webp'),
+                                       ({'size': '100,75'}, (100, 75), 'image/jpeg')):
+        params['profile'] = 'web-fast'
+        download = requests.get(hostname + '/serve/{}'.format(img_id), params=params)
+        assert download.headers['content-type'] == content_type
+        assert Image.open(BytesIO(download.content)).size == size
+
+    # Every rendition was served as rendered by the job, rather than generated again
+    image = requests.get(hostname + '/image/{}'.format(img_id)).json()
+    assert len(image['variants']) == 3
+
+    # A job whose renditions are all cached reports the same sizes
+    with open(unique_file, 'r') as f:
+        resp = requests.post(hostname + '/images',
+                             data={'user_id': 'test-user-{}'.format(uuid.uuid4())},
+                             files={'file': ('bridge.jpeg', f)})
+    copy_id = resp.json()['id']
+    resp = requests.put(hostname + '/image/{}'.format(copy_id),
+                        data={'action': 'renditions', 'renditions': '800x600,400x300.webp,100x75',
+                              'profile': 'web-fast'})
+    resp = requests.get(hostname + '/job/{}'.format(resp.json()['job_id']), params={'wait': 10})
+    cached = resp.json()
+    assert cached['status'] == 'done'
+    assert (cached['output_bytes'], cached['bytes_saved']) == (job['output_bytes'], job['bytes_saved'])
+    assert len(requests.get(hostname + '/image/{}'.format(copy_id)).json()['variants']) == 3
+    requests.delete(hostname + '/image/{}'.format(copy_id))
+
+    # Clean up the data
+    requests.delete(hostname + '/image/{}'.format(img_id))
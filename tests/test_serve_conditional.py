@@ -0,0 +1,46 @@
+import uuid
+
+import requests
+
+
+def test_serve_conditional(hostname, large_file):
+    """
+    Test that served images carry an ETag and honor conditional and range requests
+
+    :param hostname: The hostname under test (this fixture is automatically injected by pytest)
+    :param large_file: A large-ish filename (this fixture is automatically injected by pytest)
+    """
+    with open(large_file, 'r') as f:
+        resp = requests.post(hostname + '/images',
+                             data={'user_id': 'test-user-{}'.format(uuid.uuid4())},
+                             files={'file': ('bridge.jpeg', f)})
+
+    img_id = resp.json()['id']
+
+    download = requests.get(hostname + '/serve/{}'.format(img_id))
+    etag = download.headers['etag']
+    assert etag
+    assert download.headers['accept-ranges'] == 'bytes'
+
+    # A client that already has the image gets a 304 with no body
+    download = requests.get(hostname + '/serve/{}'.format(img_id), headers={'If-None-Match': etag})
+    assert download.status_code == 304
+    assert not download.content
+
+    # Only the ETag decides whether the client's copy is current, since files are shared between images
+    download = requests.get(hostname + '/serve/{}'.format(img_id),
+                            headers={'If-Modified-Since': 'Fri, 01 Jan 2100 00:00:00 GMT'})
+    assert download.status_code == 200
+    assert 'last-modified' not in download.headers
+
+    # Byte ranges are served as partial content
+    download = requests.get(hostname + '/serve/{}'.format(img_id), headers={'Range': 'bytes=0-99'})
+    assert download.status_code == 206
+    assert len(download.content) == 100
+    assert download.headers['content-range'].startswith('bytes 0-99/')
+
+    with open(large_file, 'rb') as f:
+        assert download.content == f.read(100)
+
+    # Clean up the data
+    requests.delete(hostname + '/image/{}'.format(img_id))
@@ -0,0 +1,39 @@
+import uuid
+
+import requests
+
+import app
+
+
+def test_serve_rejects_invalid_sizes_and_boxes(hostname, large_file):
+    """
+    Test that sizes and boxes that cannot be rendered are rejected before any variant is generated
+
+    :param hostname: The hostname under test (this fixture is automatically injected by pytest)
+    :param large_file: A large-ish filename (this fixture is automatically injected by pytest)
+    """
+    with open(large_file, 'r') as f:
+        resp = requests.post(hostname + '/images',
+                             data={'user_id': 'test-user-{}'.format(uuid.uuid4())},
+                             files={'file': ('bridge.jpeg', f)})
+
+    img_id = resp.json()['id']
+    width, height = [int(v) for v in app.store.get('images.{img_id}.dimensions'.format(img_id=img_id)).split(',')]
+
+    big = app.MAX_DIMENSION + 1
+    for params in ({'size': '0,0'}, {'size': '-5,10'}, {'size': '{},{}'.format(big, big)},
+                   {'box': '10,10,10,50'}, {'box': '50,10,10,50'}, {'box': '-1,0,10,10'},
+                   {'box': '0,0,{},10'.format(width + 1)}, {'box': '0,0,10,{}'.format(height + 1)}):
+        resp = requests.get(hostname + '/serve/{}'.format(img_id), params=params)
+        assert resp.status_code == 400, params
+
+    assert not app.store.hlen('images.{img_id}.variants'.format(img_id=img_id))
+    resp = requests.put(hostname + '/image/{}'.format(img_id), data={'action': 'resize', 'size': '0,10'})
+    assert resp.status_code == 400
+
+    # The whole image is a valid box
+    resp = requests.get(hostname + '/serve/{}'.format(img_id), params={'box': '0,0,{},{}'.format(width, height)})
+    assert resp.status_code == 200
+
+    # Clean up the data
+    requests.delete(hostname + '/image/{}'.format(img_id))
@@ -0,0 +1,43 @@
+import uuid
+
+import requests
+
+
+def test_serve_variant(hostname, large_file):
+    """
+    Test that variants requested through /serve are generated on demand without modifying the original
+
+    :param hostname: The hostname under test (this fixture is automatically injected by pytest)
+    :param large_file: A large-ish filename (this fixture is automatically injected by pytest)
+    """
+    with open(large_file, 'r') as f:
+        resp = requests.post(hostname + '/images',
+                             data={'user_id': 'test-user-{}'.format(uuid.uuid4())},
+                             files={'file': ('bridge.jpeg', f)})
+
+    img_id = resp.json()['id']
+
+    # Get the original size
+    download = requests.get(hostname + '/serve/{}'.format(img_id))
+    original_size = download.headers['content-length']
+
+    # Request a thumbnail variant in another format
+    download = requests.get(hostname + '/serve/{}'.format(img_id), params={'size': '100,100', 'format': 'png'})
+    assert download.status_code == 200
+    assert download.headers['content-type'] == 'image/png'
+
+    # The variant is kept, and the image itself is untouched
+    resp = requests.get(hostname + '/image/{}'.format(img_id))
+    assert resp.json()['variants'] == ['resize:100,100;transcode:png']
+    assert resp.json()['location'] == resp.json()['original']
+
+    download = requests.get(hostname + '/serve/{}'.format(img_id))
+    assert download.headers['content-length'] == original_size
+    assert download.headers['content-type'] == 'image/jpeg'
+
+    # Invalid variant parameters are rejected
+    download = requests.get(hostname + '/serve/{}'.format(img_id), params={'box': '50'})
+    assert download.status_code == 400
+
+    # Clean up the data
+    requests.delete(hostname + '/image/{}'.format(img_id))
@@ -0,0 +1,94 @@
+import os
+
+import pytest
+
+import storage
+
+
+def test_local_storage_shards_files(tmpdir):
+    """
+    Test that files are spread over subdirectories by the hash of their key, and can be copied, moved and deleted
+
+    :param tmpdir: A temporary directory (this fixture is automatically injected by pytest)
+    """
+    backend = storage.LocalStorage(str(tmpdir))
+    backend.put('blobs/a.png', b'a')
+    backend.put('blobs/b.png', b'b')
+
+    path = backend.path('blobs/a.png')
+    assert path != backend.path('blobs/b.png')
+    assert os.path.relpath(path, str(tmpdir)).split(os.sep)[2:] == ['blobs', 'a.png']
+    assert backend.read('blobs/a.png') == b'a'
+    assert backend.size('blobs/a.png') == 1
+
+    backend.copy('blobs/a.png', 'variants/x/a.png')
+    assert backend.read('variants/x/a.png') == b'a'
+    assert backend.rename('blobs/a.png', 'blobs/c.png')
+    assert not backend.exists('blobs/a.png')
+    assert not backend.rename('blobs/a.png', 'blobs/d.png')
+
+    backend.delete('blobs/c.png')
+    backend.delete('blobs/c.png')
+    assert not backend.exists('blobs/c.png')
+
+
+def test_read_cache_evicts_least_recently_used(tmpdir):
+    """
+    Test that the read cache fetches files once, and drops the least recently used ones once it is full
+
+    :param tmpdir: A temporary directory (this fixture is automatically injected by pytest)
+    """
+    remote = storage.LocalStorage(str(tmpdir.join('remote')))
+    for name in 'abc':
+        remote.put(name, name * 10)
+
+    cache = storage.ReadCache(remote, str(tmpdir.join('cache')), max_bytes=25)
+    assert cache.read('a') == 'a' * 10
+    assert cache.read('b') == 'b' * 10
+
+    # The cached copy is used, even once the original is gone
+    remote.delete('a')
+    assert cache.read('a') == 'a' * 10
+
+    # "b" is the least recently used, so it makes room for "c"
+    cache.read('c')
+    assert cache.local.exists('a') and cache.local.exists('c')
+    assert not cache.local.exists('b')
+
+    # A restarted cache picks up the files already on disk
+    cache = storage.ReadCache(remote, str(tmpdir.join('cache')), max_bytes=25)
+    assert cache._bytes == 20
+
+
+def test_s3_storage(monkeypatch):
+    """
+    Test the object store backend against moto's stand-in for S3
+
+    :param monkeypatch: Patches the environment (this fixture is automatically injected by pytest)
+    """
+    pytest.importorskip('boto3')
+    moto = pytest.importorskip('moto')
+    monkeypatch.setenv('AWS_ACCESS_KEY_ID', 'testing')
+    monkeypatch.setenv('AWS_SECRET_ACCESS_KEY', 'testing')
+
+    with moto.mock_s3():
+        backend = storage.S3Storage('images', prefix='test/', region_name='us-east-1')
+        backend.client.create_bucket(Bucket='images')
+
+        backend.put('blobs/a.png', b'a')
+        assert backend.exists('blobs/a.png')
+        assert backend.size('blobs/a.png') == 1
+        assert backend.read('blobs/a.png') == b'a'
+        with open(backend.local_path('blobs/a.png'), 'rb') as f:
+            assert f.read() == b'a'
+
+        backend.copy('blobs/a.png', 'variants/x/a.png')
+        assert backend.read('variants/x/a.png') == b'a'
+        assert backend.rename('blobs/a.png', 'blobs/b.png')
+        assert not backend.exists('blobs/a.png')
+        assert not backend.rename('blobs/a.png', 'blobs/c.png')
+
+        backend.delete('blobs/b.png')
+        assert not backend.exists('blobs/b.png')
+        with pytest.raises(IOError):
+            backend.read('blobs/b.png')
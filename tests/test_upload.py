@@ -1,5 +1,15 @@
-import requests
+import os
 import uuid
+import hashlib
+from io import BytesIO
+
+import pytest
+import requests
+from PIL import Image
+from werkzeug.exceptions import RequestEntityTooLarge
+
+import storage
+import uploads
 
 
 def test_upload(hostname, large_file):
@@ -22,3 +32,71 @@ def test_upload(hostname, large_file):
 
     # Clean up test data and delete the image
     requests.delete(hostname + '/image/{}'.format(data['id']))
+
+
+def test_upload_shares_blob(hostname, unique_file):
+    """
+    Test that images uploaded with the same content share one blob, which is kept until the last of them is deleted
+
+    :param hostname: The hostname under test (this fixture is automatically injected by pytest)
+    :param unique_file: A large-ish file never uploaded before (this fixture is automatically injected by pytest)
+    """
+    img_ids = []
+    for _ in xrange(2):
+        with open(unique_file, 'r') as f:
+            resp = requests.post(hostname + '/images',
+                                 data={'user_id': 'test-user-{}'.format(uuid.uuid4())},
+                                 files={'file': ('bridge.jpeg', f)})
+        img_ids.append(resp.json()['id'])
+
+    originals = set(requests.get(hostname + '/image/{}'.format(img_id)).json()['original'] for img_id in img_ids)
+    assert len(originals) == 1
+    original = originals.pop()
+    assert original.startswith(uploads.BLOB_PREFIX)
+
+    with open(unique_file, 'rb') as f:
+        refs = 'blobs.{}.refs'.format(hashlib.sha1(f.read()).hexdigest())
+    assert uploads.store.get(refs) == '2'
+
+    requests.delete(hostname + '/image/{}'.format(img_ids[0]))
+    assert uploads.store.get(refs) == '1'
+    assert storage.backend.exists(original)
+
+    requests.delete(hostname + '/image/{}'.format(img_ids[1]))
+    assert uploads.store.get(refs) is None
+    assert not storage.backend.exists(original)
+
+
+def test_upload_rejected(hostname):
+    """
+    Test that uploads which are empty (400) or not an image of a supported format (415) are turned away
+
+    :param hostname: The hostname under test (this fixture is automatically injected by pytest)
+    """
+    gif = BytesIO()
+    Image.new('RGB', (10, 10)).save(gif, 'GIF')
+
+    for content, status_code in ((b'', 400), (b'hello world' * 100, 415), (gif.getvalue(), 415)):
+        resp = requests.post(hostname + '/images',
+                             data={'user_id': 'test-user-{}'.format(uuid.uuid4())},
+                             files={'file': ('bridge.jpeg', content)})
+        assert resp.status_code == status_code, 'Upload should have failed but did not: {}'.format(content[:20])
+
+
+def test_upload_too_large(large_file, monkeypatch):
+    """
+    Test that an upload is turned away with a 413 as soon as it grows past the limit, and its file removed
+
+    :param large_file: A large-ish filename (this fixture is automatically injected by pytest)
+    :param monkeypatch: Patches the upload limit (this fixture is automatically injected by pytest)
+    """
+    monkeypatch.setattr(uploads, 'MAX_UPLOAD_BYTES', 64 * 1024)
+    upload = uploads.UploadFile('bridge.jpeg')
+    with open(large_file, 'rb') as f:
+        with pytest.raises(RequestEntityTooLarge) as e:
+            for chunk in iter(lambda: f.read(16 * 1024), b''):
+                upload.write(chunk)
+
+    assert e.value.code == 413
+    assert upload.size <= 80 * 1024
+    assert not os.path.exists(upload.path)
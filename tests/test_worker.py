@@ -0,0 +1,385 @@
+import os
+import time
+import uuid
+import threading
+from io import BytesIO
+
+from PIL import Image
+
+from redis import ConnectionError
+
+import transcoder
+
+
+def test_lost_worker_jobs_are_requeued():
+    """
+    Test that the jobs and lanes of a worker whose heartbeat has lapsed are taken back by the other workers
+    """
+    name = 'test.queue.{}'.format(uuid.uuid4())
+    lost = transcoder.LaneQueue(name, lanes=2, worker_id='lost-worker')
+    alive = transcoder.LaneQueue(name, lanes=2, worker_id='alive-worker')
+
+    job = ('resize', {'img_id': 'img-1', 'job_id': 'job-1', 'size': [50, 50]})
+    lost.put(job)
+    lost.heartbeat(timeout=-1)
+    assert tuple(lost.get(block=False)) == job
+
+    # The job is held by the lost worker until its heartbeat is checked
+    alive.heartbeat()
+    assert alive.alive() == 1
+    assert alive.empty()
+
+    assert alive.requeue_lost() == ['lost-worker']
+    assert alive.requeue_lost() == []
+    assert tuple(alive.get(block=False)) == job
+
+    alive.ack(job)
+    alive.leave()
+    assert alive.alive() == 0
+    assert not transcoder.store.exists('{}.workers.alive-worker'.format(name))
+
+
+def test_held_jobs_are_renewed():
+    """
+    Test that a worker renews the lease and deadline of a job it holds, so that it is not taken back however long the
+    job waits
+    """
+    name = 'test.queue.{}'.format(uuid.uuid4())
+    queue = transcoder.LaneQueue(name, lanes=1, visibility_timeout=1, worker_id='slow-worker')
+    other = transcoder.LaneQueue(name, lanes=1, visibility_timeout=1, worker_id='other-worker')
+
+    job = ('resize', {'img_id': 'img-1', 'job_id': 'job-1', 'size': [50, 50]})
+    queue.put(job)
+    assert tuple(queue.get(block=False)) == job
+
+    lane = queue.classes[transcoder.DEFAULT_PRIORITY][0]
+    queue.visibility_timeout = 60
+    queue.renew()
+    assert transcoder.store.ttl(queue._lease(0)) > 1
+    assert transcoder.store.zscore(lane.deadlines, lane._encode(job)) > time.time() + 1
+
+    # Once the job is taken back, renewing leaves it to whoever has it now
+    assert lane.requeue(lane._encode(job))
+    transcoder.store.delete(queue._lease(0))
+    queue.renew()
+    assert transcoder.store.zscore(lane.deadlines, lane._encode(job)) is None
+    assert tuple(other.get(block=False)) == job
+    other.ack(job)
+    transcoder.store.delete(queue._taken('slow-worker'))
+
+
+def test_staged_worker_survives_take_errors(monkeypatch):
+    """
+    Test that a staged worker keeps taking jobs after taking one fails, e.g. while Redis is unreachable
+
+    :param monkeypatch: Patches the queue (this fixture is automatically injected by pytest)
+    """
+    take = transcoder._take
+    test_thread = threading.current_thread()
+    task = transcoder._Task([('resize', {'img_id': 'img-1', 'job_id': 'job-1', 'size': [50, 50]})])
+    attempts = []
+
+    def flaky_take(timeout=100):
+        # Other workers running in this process take jobs as usual
+        if threading.current_thread() is not test_thread:
+            return take(timeout)
+        attempts.append(time.time())
+        if len(attempts) == 1:
+            raise ConnectionError('Error 111 connecting to localhost:6379. Connection refused.')
+        return task
+
+    monkeypatch.setattr(transcoder, '_take', flaky_take)
+    monkeypatch.setattr(transcoder, 'TAKE_RETRY_DELAY', 0.01)
+    worker = transcoder.StagedWorker()
+    assert worker._take() is task
+    assert len(attempts) == 2
+    assert worker._tasks == 1
+
+    # Once stopping, it takes nothing more
+    worker._stopping.set()
+    assert worker._take() is None
+
+
+def test_staged_worker_heartbeat_survives_errors(monkeypatch):
+    """
+    Test that a staged worker keeps beating its heartbeat after a beat fails, so that its jobs are not handed out again
+    while it is still working on them
+
+    :param monkeypatch: Patches the queue (this fixture is automatically injected by pytest)
+    """
+    heartbeat = transcoder.queue.heartbeat
+    beats = []
+
+    def flaky_heartbeat(*args, **kwargs):
+        if threading.current_thread() is not beating:
+            return heartbeat(*args, **kwargs)
+        beats.append(time.time())
+        if len(beats) == 1:
+            raise ConnectionError('Error 111 connecting to localhost:6379. Connection refused.')
+        return heartbeat(*args, **kwargs)
+
+    worker = transcoder.StagedWorker()
+    beating = threading.Thread(target=worker._beat)
+    monkeypatch.setattr(transcoder.queue, 'heartbeat', flaky_heartbeat)
+    monkeypatch.setattr(transcoder, 'HEARTBEAT_INTERVAL', 0.01)
+    beating.start()
+    deadline = time.time() + 5
+    while len(beats) < 3 and time.time() < deadline:
+        time.sleep(0.01)
+    worker._stopped.set()
+    beating.join()
+    assert len(beats) >= 3
+
+
+def test_autoscaler_observes_render_time(monkeypatch):
+    """
+    Test that the autoscaler is told how long the executor took to render a task, without the wait for the pixel
+    budget before it
+
+    :param monkeypatch: Patches the budget and the executor (this fixture is automatically injected by pytest)
+    """
+    test_thread = threading.current_thread()
+    acquire, run = transcoder.budget.acquire, transcoder.executor.run
+
+    def slow_acquire(pixels):
+        if threading.current_thread() is test_thread:
+            time.sleep(0.5)
+        return acquire(pixels)
+
+    def quick_run(func, *args):
+        if threading.current_thread() is not test_thread:
+            return run(func, *args)
+        time.sleep(0.1)
+        return 'output', {}
+
+    class Autoscaler(object):
+        size = 1
+        observed = []
+
+        def observe(self, seconds, jobs=1):
+            self.observed.append((seconds, jobs))
+
+    monkeypatch.setattr(transcoder.budget, 'acquire', slow_acquire)
+    monkeypatch.setattr(transcoder.executor, 'run', quick_run)
+    task = transcoder._Task([('resize', {'img_id': 'img-1', 'job_id': 'job-{}'.format(n), 'size': [50, 50]})
+                             for n in (1, 2)])
+    task.source, task.steps, task.dest = 'source', [('resize', {'size': [50, 50]})], 'variants/img-1/resized.jpeg'
+
+    worker = transcoder.StagedWorker(autoscaler=Autoscaler())
+    worker._render(task)
+    assert task.output == 'output'
+    [(seconds, jobs)] = worker.autoscaler.observed
+    assert 0.1 <= seconds < 0.4
+    assert jobs == 2
+
+
+def test_process_executor_resizes_without_forking():
+    """
+    Test that resizing a process executor changes how many of the processes it forked up front it uses, rather than
+    forking new ones from a process that is running threads
+    """
+    executor = transcoder.ProcessExecutor(1, 3)
+    try:
+        pids = sorted(process.pid for process in executor._pool._pool)
+        assert len(pids) == 3
+
+        executor.resize(2)
+        assert executor.processes == 2
+        executor.resize(8)
+        assert executor.processes == 3
+        assert executor.run(pow, 2, 10) == 1024
+        assert sorted(process.pid for process in executor._pool._pool) == pids
+    finally:
+        executor.close()
+
+
+def test_jobs_for_one_image_are_fused():
+    """
+    Test that the jobs queued right behind a job for the same image are taken along with it, up to the next job for
+    another image, and that renditions jobs are never fused
+    """
+    name = 'test.queue.{}'.format(uuid.uuid4())
+    queue = transcoder.LaneQueue(name, lanes=1, worker_id='fusing-worker')
+
+    jobs = [('resize', {'img_id': 'img-1', 'job_id': 'job-1', 'size': [50, 50]}),
+            ('crop', {'img_id': 'img-1', 'job_id': 'job-2', 'box': [0, 0, 20, 20]}),
+            ('resize', {'img_id': 'img-2', 'job_id': 'job-3', 'size': [50, 50]}),
+            ('renditions', {'img_id': 'img-2', 'job_id': 'job-4'}),
+            ('resize', {'img_id': 'img-2', 'job_id': 'job-5', 'size': [50, 50]})]
+    for job in jobs:
+        queue.put(job)
+
+    # Both of the first image's jobs make up one task
+    job = tuple(queue.get(block=False))
+    assert job == jobs[0]
+    task = transcoder._Task([job] + [tuple(fused) for fused in queue.following(job)])
+    assert task.jobs == jobs[:2]
+    assert task.job_ids == ['job-1', 'job-2']
+    assert task.img_id == 'img-1'
+    queue.ack(*task.jobs)
+
+    # The second image's resize stops at its renditions job, which is taken on its own
+    for expected in ([jobs[2]], [jobs[3]], [jobs[4]]):
+        job = tuple(queue.get(block=False))
+        fused = [job] + [tuple(following) for following in queue.following(job)]
+        assert fused == expected
+        queue.ack(*fused)
+
+    assert queue.empty()
+    transcoder.store.delete(queue._taken('fusing-worker'))
+
+
+def test_pixel_budget():
+    """
+    Test that pixels are taken from the budget until it is exhausted, that taking more waits until enough are given
+    back, and that an image larger than the whole budget is let through once nothing else holds any
+    """
+    budget = transcoder.PixelBudget('test.budget.{}'.format(uuid.uuid4()), 100, poll=0.01)
+
+    first = budget.acquire(60)
+    second = budget.acquire(40)
+    assert budget.held(budget.holds(transcoder.store.pipeline()).execute()[0]) == 100
+
+    # The budget is exhausted, so the next image waits until pixels are given back
+    tokens = []
+    waiting = threading.Thread(target=lambda: tokens.append(budget.acquire(50)))
+    waiting.start()
+    waiting.join(0.2)
+    assert waiting.is_alive()
+
+    budget.release(first)
+    waiting.join(2)
+    assert not waiting.is_alive()
+    assert budget.held(budget.holds(transcoder.store.pipeline()).execute()[0]) == 90
+
+    # An image larger than the budget waits for everything to be given back
+    waiting = threading.Thread(target=lambda: tokens.append(budget.acquire(500)))
+    waiting.start()
+    budget.release(second)
+    waiting.join(0.2)
+    assert waiting.is_alive()
+    budget.release(tokens[0])
+    waiting.join(2)
+    assert not waiting.is_alive()
+
+    budget.release(tokens[1])
+    assert transcoder.store.zcard(budget.name) == 0
+
+
+def test_pixel_budget_holds_lapse():
+    """
+    Test that pixels that are never given back are given back once their hold lapses, and that a budget without a limit
+    holds nothing
+    """
+    budget = transcoder.PixelBudget('test.budget.{}'.format(uuid.uuid4()), 100, timeout=-1)
+    budget.acquire(100)
+    budget.timeout = 60
+    token = budget.acquire(100)
+    assert transcoder.store.zcard(budget.name) == 1
+    budget.release(token)
+
+    unlimited = transcoder.PixelBudget('test.budget.{}'.format(uuid.uuid4()), 0)
+    assert unlimited.acquire(10 ** 9) is None
+    unlimited.release(None)
+    assert not transcoder.store.exists(unlimited.name)
+
+
+def test_process_executor(large_file):
+    """
+    Test that a process executor renders images in its own processes, as many at once as it uses, and passes back
+    their errors
+
+    :param large_file: A large-ish filename (this fixture is automatically injected by pytest)
+    """
+    with open(large_file, 'rb') as f:
+        data = f.read()
+
+    executor = transcoder.ProcessExecutor(2)
+    try:
+        assert executor.run(os.getpid) != os.getpid()
+
+        output, timings = executor.run(transcoder.render, data, [('resize', {'size': [64, 48]})], '.jpeg')
+        assert Image.open(BytesIO(output)).size == (64, 48)
+        assert 'decoded' in timings
+
+        try:
+            executor.run(int, 'not a number')
+            assert False, 'The error was not passed back'
+        except ValueError:
+            pass
+
+        # Two processes sleep at once; once resized to one, they take turns
+        for processes, low, high in ((2, 0.3, 0.55), (1, 0.6, 1)):
+            executor.resize(processes)
+            threads = [threading.Thread(target=executor.run, args=(time.sleep, 0.3)) for _ in xrange(2)]
+            start = time.time()
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            assert low <= time.time() - start < high, processes
+    finally:
+        executor.close()
+    assert not any(process.is_alive() for process in executor._pool._pool)
+
+
+def test_abandoned_jobs_are_requeued():
+    """
+    Test that a job that is not acknowledged within its visibility timeout is put back on the queue, once, and that a
+    job taken without a deadline is given one
+    """
+    queue = transcoder.RedisQueue('test.queue.{}'.format(uuid.uuid4()), visibility_timeout=0.2)
+    job = ('resize', {'img_id': 'img-1', 'job_id': 'job-1', 'size': [50, 50]})
+    queue.put(job)
+    assert tuple(queue.get(block=False)) == job
+
+    queue.requeue_abandoned()
+    assert queue.empty()
+    time.sleep(0.3)
+    queue.requeue_abandoned()
+    queue.requeue_abandoned()
+    assert queue.qsize() == 1
+
+    # Taken again, by a worker that died before it could set its deadline
+    transcoder.store.rpoplpush(queue.name, queue.processing)
+    queue.requeue_abandoned()
+    assert queue.empty()
+    assert transcoder.store.zscore(queue.deadlines, queue._encode(job)) > time.time()
+
+    # Acknowledged jobs are left alone, however long they took
+    time.sleep(0.3)
+    queue.ack(job)
+    queue.requeue_abandoned()
+    assert queue.empty()
+    assert transcoder.store.llen(queue.processing) == 0
+
+
+def test_jobs_are_requeued_once_their_lease_expires():
+    """
+    Test that a job whose worker stops renewing it is taken by another worker once its lane's lease and the job's
+    visibility timeout have both lapsed
+    """
+    name = 'test.queue.{}'.format(uuid.uuid4())
+    stuck = transcoder.LaneQueue(name, lanes=1, visibility_timeout=1, worker_id='stuck-worker')
+    other = transcoder.LaneQueue(name, lanes=1, visibility_timeout=1, worker_id='other-worker')
+
+    job = ('resize', {'img_id': 'img-1', 'job_id': 'job-1', 'size': [50, 50]})
+    stuck.put(job)
+    assert tuple(stuck.get(block=False)) == job
+
+    # The lane is leased to the stuck worker until its lease expires
+    other.requeue_abandoned()
+    try:
+        other.get(block=False)
+        assert False, 'The job was taken from a leased lane'
+    except transcoder.Empty:
+        pass
+
+    time.sleep(1.2)
+    other._next_requeue = 0
+    other.requeue_abandoned()
+    assert tuple(other.get(block=False)) == job
+    other.ack(job)
+    assert other.empty()
+
+    transcoder.store.delete(stuck._taken('stuck-worker'), other._taken('other-worker'))
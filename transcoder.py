@@ -1,20 +1,169 @@
 """
 The transcoder is the core functionality of the app. It does the heavy-lifting of performing the jobs and
 transcoding image formats. You can push jobs to the transcoder workers using the queue in this module.
+
+The queue lives in Redis so jobs survive restarts and can be consumed by workers on other machines. Jobs are sharded
+into lanes by image ID; a worker must hold a lane's lease to take jobs from it, so the jobs for any one image run one
+at a time and in the order they were submitted, while different images are processed in parallel:
+
+    transcoder.queue.{priority}.{n}             --  List of pending jobs in lane n of a priority class (pushed on the
+                                                    left, taken from the right)
+    transcoder.queue.{priority}.{n}.processing  --  List of jobs a worker has taken from the lane but not yet
+                                                    acknowledged
+    transcoder.queue.{priority}.{n}.deadlines   --  Sorted set of taken jobs scored by when they are considered
+                                                    abandoned
+    transcoder.queue.{n}.lease                  --  Token of the worker currently consuming lane n, in every class
+    transcoder.queue.signal                     --  List that is pushed to whenever a job is queued, to wake up idle
+                                                    workers
+    transcoder.queue.load                       --  Hash of the number ("{priority}.depth") and estimated cost
+                                                    ("{priority}.cost") of the jobs queued in each priority class
+    transcoder.queue.workers                    --  Sorted set of the worker processes, scored by when their heartbeat
+                                                    lapses
+    transcoder.queue.workers.{worker_id}        --  Hash of the jobs a worker process has taken, each mapped to the lane
+                                                    it was taken from
+    transcoder.inflight                         --  Hash of the number of jobs each worker is processing
+    transcoder.pool                             --  Hash of the pool size of each worker process: the number of jobs
+                                                    it renders at once
+    transcoder.budget                           --  Sorted set of the pixels held by the workers, as "{token}:{pixels}",
+                                                    scored by when each hold lapses
+
+Worker processes beat a heartbeat while they run. When a worker's heartbeat lapses, the other workers put the jobs it
+had taken back on the queue and free its lanes, without waiting out the visibility timeout. Run workers with
+worker.py; a worker sent SIGTERM stops taking jobs and exits once it has finished the ones it holds.
 """
 import os
+import json
+import time
+import uuid
+import zlib
 import errno
-import logging
+import hashlib
+import random
+import signal
+import socket
 import threading
+import logging
+import multiprocessing
+from io import BytesIO
 from Queue import Queue, Empty
+from functools import partial
 
 from PIL import Image
-from redis import StrictRedis
+from redis import WatchError
+
+import cache
+import jobs
+import metrics
+import storage
+import uploads
 
 _log = logging.getLogger(__name__)
 
-queue = Queue()
-store = StrictRedis()
+store = metrics.CountingRedis()
+
+# Seconds a worker may hold a job before it is considered abandoned and put back on the queue
+VISIBILITY_TIMEOUT = 300
+
+# Number of lanes the queue is sharded into; this caps how many images can be processed at once
+LANE_COUNT = 64
+
+# Priority classes of jobs, most urgent first. Workers take a job from a less urgent class only when the more urgent
+# ones have none that can be started.
+PRIORITIES = ('interactive', 'default', 'bulk')
+DEFAULT_PRIORITY = 'default'
+
+# Minimum number of seconds between scans for abandoned jobs
+REQUEUE_INTERVAL = 10
+
+# Seconds between a worker process's heartbeats, and after its last heartbeat when its jobs are taken back
+HEARTBEAT_INTERVAL = 5
+HEARTBEAT_TIMEOUT = 30
+
+# Seconds a staged worker waits for a job before checking whether it has been told to stop, and before it tries again
+# when taking a job failed (e.g. while Redis is unreachable)
+TAKE_TIMEOUT = 5
+TAKE_RETRY_DELAY = 1
+
+# Seconds between the pool size decisions of autoscaled workers
+SCALE_INTERVAL = 2
+
+# Number of operations an image's current variant may be rendered with from its original. Past this, the variant
+# becomes the image's original, so that its jobs do not replay an ever longer history.
+MAX_STEPS = 8
+
+# Number of variants kept for each image; past this, variants other than its current one are removed to make room
+MAX_VARIANTS = 64
+
+# Maximum number of consecutive jobs for one image that are fused into a single decode/encode pass
+FUSE_LIMIT = 16
+
+# Jobs for these actions are not fused with the jobs around them: they render from the image without changing it
+UNFUSED_ACTIONS = ('renditions',)
+
+# Number of jobs the staged worker reads ahead of the image work, and lets wait to be written
+PREFETCH = 2
+
+# Identifies the workers of this process in the metrics
+WORKER_ID = '{}:{}'.format(socket.gethostname(), os.getpid())
+INFLIGHT = 'transcoder.inflight'
+POOL = 'transcoder.pool'
+
+# The stages of a job, each named after the time it ends at: it waits on the queue from when it was "queued" until it
+# is "started", then reads the image's state from Redis until "fetched", and so on. Jobs served from the derivative
+# cache go from "fetched" to "cached" instead of through the rest.
+STAGES = (
+    ('wait', 'queued', 'started'),
+    ('redis', 'started', 'fetched'),
+    ('cache', 'fetched', 'cached'),
+    ('read', 'fetched', 'read'),
+    ('budget', 'read', 'budgeted'),
+    ('decode', 'budgeted', 'decoded'),
+    ('transform', 'decoded', 'transformed'),
+    ('encode', 'transformed', 'encoded'),
+    ('write', 'encoded', 'written'),
+)
+
+metrics.describe('transcoder_stage_seconds', 'histogram', 'Seconds jobs spent in each stage, by action and format')
+metrics.describe('transcoder_jobs_total', 'counter', 'Jobs finished, by action and status')
+metrics.describe('transcoder_image_truncation_errors_total', 'counter', 'Images that could not be decoded')
+metrics.describe('transcoder_source_bytes_total', 'counter', 'Bytes of the sources rendered from, by output profile')
+metrics.describe('transcoder_output_bytes_total', 'counter', 'Bytes of the images rendered, by output profile')
+metrics.describe('transcoder_pool_resizes_total', 'counter', 'Pool size decisions of autoscaled workers, by direction')
+
+# Derived variants of the images are stored under keys starting with this; the originals are never modified
+VARIANT_PREFIX = 'variants/'
+
+# Most pixels that the workers of all processes and machines may hold decoded at once (about 3 bytes each for RGB),
+# counting both the decoded images and their largest intermediate results; set it to 0 for no limit
+PIXEL_BUDGET = 100 * 10 ** 6
+
+# Before downscaling, JPEGs are decoded at a reduced scale, but never to less than this many times the target size,
+# which leaves the final high-quality resize enough pixels to work with. Raise it for better output quality; set it to
+# 0 to always decode the full image.
+REDUCE_FACTOR = 2
+
+# Output profiles: the encoder settings results are saved with, for each format, and whether the source's metadata
+# (EXIF and ICC profile) is stripped from them or kept. Jobs without a profile get Pillow's defaults.
+PROFILES = {
+    'web-fast': {
+        'JPEG': {'quality': 80, 'subsampling': 2},
+        'PNG': {'compress_level': 1},
+        'WEBP': {'quality': 80, 'method': 0},
+        'strip': True,
+    },
+    'web-small': {
+        'JPEG': {'quality': 70, 'subsampling': 2, 'optimize': True, 'progressive': True},
+        'PNG': {'optimize': True},
+        'WEBP': {'quality': 70, 'method': 6},
+        'strip': True,
+    },
+    'archive': {
+        'JPEG': {'quality': 95, 'subsampling': 0},
+        'PNG': {'compress_level': 9},
+        'WEBP': {'lossless': True},
+        'strip': False,
+    },
+}
 
 
 def _makedirpath(dest):
@@ -28,29 +177,323 @@ def _makedirpath(dest):
             raise
 
 
-def transcode(src, dest):
+def _unlink(path):
+    try:
+        os.unlink(path)
+    except OSError, e:
+        if e.errno == errno.ENOENT:
+            pass
+        else:
+            raise
+
+
+def _reduce(image, size):
     """
-    Transcode an image file from a source to a destination file. This will remove the source file
+    Have the JPEG decoder scale a freshly opened image down by up to 8x as it decodes, instead of decoding pixels that
+    the resize would throw away
+
+    :type size: tuple
+    :param size: The size the image is going to be resized to
+    """
+    if not REDUCE_FACTOR or image.format != 'JPEG':
+        return image
+
+    # The largest scale the decoder supports that keeps both sides at least REDUCE_FACTOR times the target's
+    width, height = image.size
+    for scale in (8, 4, 2, 1):
+        if -(-width // scale) >= size[0] * REDUCE_FACTOR and -(-height // scale) >= size[1] * REDUCE_FACTOR:
+            break
+    if scale > 1:
+        # Pillow picks the scale from how many times the requested size fits into the image (on either side in some
+        # versions, on both in others), which is exactly this scale for this size in either case
+        image.draft(image.mode, (width // scale, height // scale))
+    return image
+
+
+# Bytes per pixel of the raw modes whose rows _band can find without being told their stride
+_RAW_BYTES = {'L': 1, 'P': 1, 'RGB': 3, 'BGR': 3, 'RGBA': 4, 'RGBX': 4, 'BGRX': 4, 'CMYK': 4}
+
+
+def _band(image, box):
+    """
+    Have a freshly opened image that is stored uncompressed (e.g. BMP, PPM or uncompressed TIFF) decode only the band
+    of rows that a crop keeps, instead of the whole image
+
+    :type box: tuple
+    :param box: The box the image is going to be cropped to
+    :return: The box relative to the band, or None if the whole image has to be decoded
+    """
+    if len(image.tile) != 1:
+        return None
+    decoder, extent, offset, args = image.tile[0]
+    width, height = image.size
+    if decoder != 'raw' or extent != (0, 0, width, height) or not isinstance(args, tuple) or len(args) != 3:
+        return None
+
+    rawmode, stride, orientation = args
+    stride = stride or width * _RAW_BYTES.get(rawmode, 0)
+    top, bottom = max(box[1], 0), min(box[3], height)
+    if not stride or orientation not in (1, -1) or not 0 <= top < bottom:
+        return None
+
+    # Rows are stored top to bottom, or bottom to top when the orientation is -1
+    first = top if orientation == 1 else height - bottom
+    image.tile = [(decoder, (0, 0, width, bottom - top), offset + first * stride, (rawmode, stride, orientation))]
+    if hasattr(image, '_size'):
+        # Newer Pillows keep the size read-only, behind _size
+        image._size = (width, bottom - top)
+    else:
+        image.size = (width, bottom - top)
+    return box[0], box[1] - top, box[2], box[3] - top
+
+
+def _prepare(image, steps):
+    """
+    Set up a freshly opened image to be decoded at a reduced scale, or only in part, where the actions allow
+
+    :return: Tuple of the image and the actions to apply to it once decoded
+    """
+    if steps and steps[0][0] == 'resize':
+        image = _reduce(image, tuple(steps[0][1]['size']))
+    elif steps and steps[0][0] == 'crop':
+        box = _band(image, tuple(steps[0][1]['box']))
+        if box:
+            steps = [('crop', dict(steps[0][1], box=box))] + list(steps[1:])
+    return image, steps
+
+
+def _decode(image, steps):
+    """
+    Decode a freshly opened image, at a reduced scale or only in part where the actions allow
+
+    :return: Tuple of the image and the actions to apply to it
+    """
+    image, steps = _prepare(image, steps)
+    image.load()
+    return image, steps
+
+
+def footprint(src, steps):
+    """
+    Estimate the most pixels held in memory at once while applying a sequence of actions to an image: those decoded,
+    plus those of the largest intermediate result. Only the image's header is read.
+
+    :param src: Source file, or a file object
+    :type steps: list
+    :param steps: List of (action, params) pairs to apply in order
     """
     try:
-        image = Image.open(src)
+        image = _prepare(Image.open(src), steps)[0]
+    except IOError:
+        # Images that cannot be opened fail without decoding anything
+        return 0
+
+    width, height = image.size
+    largest = 0
+    for action, params in steps:
+        if action == 'resize':
+            largest = max(largest, params['size'][0] * params['size'][1])
+        elif action == 'crop':
+            box = params['box']
+            largest = max(largest, abs(box[2] - box[0]) * abs(box[3] - box[1]))
+    return width * height + largest
+
+
+def _apply(image, steps):
+    """
+    Apply a sequence of actions to a decoded image
+    """
+    for action, params in steps:
+        if action == 'resize':
+            image = image.resize(tuple(params['size']), Image.ANTIALIAS)
+        elif action == 'crop':
+            image = image.crop(tuple(params['box']))
+    return image
 
+
+def _profile(steps):
+    """
+    The output profile of a sequence of actions: that of the last one
+    """
+    return steps[-1][1].get('profile') if steps else None
+
+
+def _save(image, f, image_format, profile=None):
+    """
+    Encode an image with the settings of an output profile
+
+    :param profile: One of PROFILES, or None for Pillow's defaults
+    """
+    settings = PROFILES.get(profile, {})
+    options = dict(settings.get(image_format, {}))
+    if settings.get('strip'):
+        # Some encoders (e.g. PNG's) carry the source's metadata over unless it is taken out
+        image.info.pop('icc_profile', None)
+        image.info.pop('exif', None)
+    elif 'strip' in settings:
+        for key in ('icc_profile', 'exif'):
+            if image.info.get(key):
+                options[key] = image.info[key]
+    image.save(f, image_format, **options)
+
+
+def process(src, dest, steps):
+    """
+    Apply a sequence of actions to an image, decoding the source once and encoding the result once. The output format
+    is taken from the destination's extension.
+
+    :param src: Source file
+    :param dest: Destination file
+    :type steps: list
+    :param steps: List of (action, params) pairs to apply in order, e.g. [('crop', {'box': (0, 0, 50, 50)})]; the last
+        one's "profile", if any, is the output profile
+    :return: Whether the destination was written
+    """
+    try:
+        image = _apply(*_decode(Image.open(src), steps))
+
+        # Write to a temporary file first so the destination is replaced atomically
         _makedirpath(dest)
-        image.save(dest)
+        base, ext = os.path.splitext(dest)
+        tmp = '{}.tmp-{}{}'.format(base, uuid.uuid4(), ext)
+        Image.init()
+        with open(tmp, 'wb') as f:
+            _save(image, f, Image.EXTENSION[ext.lower()], _profile(steps))
+        os.rename(tmp, dest)
+        return True
+    except IOError:
+        _log.warn('Image truncation error')
+        return False
+
+
+def render(data, steps, extension):
+    """
+    Apply a sequence of actions to an image held in memory. This does no I/O, so that it can run in a pool of processes
+    while other threads read and write the files.
+
+    :param data: The encoded source image
+    :type steps: list
+    :param steps: List of (action, params) pairs to apply in order; the last one's "profile", if any, is the output
+        profile
+    :param extension: Extension of the output format, e.g. ".png"
+    :return: Tuple of the encoded result, or None if the source could not be decoded, and the times at which it was
+        "decoded", "transformed" and "encoded"
+    """
+    timings = {}
+    profile = _profile(steps)
+    try:
+        image, steps = _decode(Image.open(BytesIO(data)), steps)
+        timings['decoded'] = time.time()
+        image = _apply(image, steps)
+        timings['transformed'] = time.time()
+
+        Image.init()
+        output = BytesIO()
+        _save(image, output, Image.EXTENSION[extension.lower()], profile)
+        timings['encoded'] = time.time()
+        return output.getvalue(), timings
+    except IOError:
+        _log.warn('Image truncation error')
+        return None, timings
+
+
+def rendition_steps(applied, size, extension=None, profile=None):
+    """
+    The steps of a rendition of an image: those applied to it so far, then a resize and, if it changes format, a
+    transcode; these are the steps /serve takes for its "size" and "format" parameters
+
+    :param applied: List of [action, params] pairs applied to the original so far
+    :param size: Width and height of the rendition
+    :param extension: Extension of the rendition's format, e.g. "webp", or None for the image's own
+    :param profile: The output profile, one of PROFILES
+    """
+    operations = [('resize', {'size': list(size)})]
+    if extension:
+        operations.append(('transcode', {'extension': extension}))
+    if profile:
+        operations[-1][1]['profile'] = profile
+    return list(applied) + cache.operations(operations)
+
+
+def image_size(dimensions, steps):
+    """
+    The width and height of an image after a sequence of actions, or None if its dimensions were never recorded
+
+    :param dimensions: The original's width and height, delimited by a comma as they are stored in Redis
+    :param steps: List of [action, params] pairs applied to the original
+    """
+    if not dimensions:
+        return None
+    size = tuple(int(v) for v in dimensions.split(','))
+    for action, params in steps:
+        if action == 'resize':
+            size = tuple(params['size'])
+        elif action == 'crop':
+            box = params['box']
+            size = (abs(box[2] - box[0]), abs(box[3] - box[1]))
+    return size
+
+
+def render_renditions(data, steps, renditions):
+    """
+    Render several sizes of an image from a single decode. The image is decoded once, at a reduced scale that still
+    suits the largest rendition, and each rendition is resized from the smallest one rendered before it that is at
+    least as large, rather than from the full image.
+
+    :param data: The encoded source image
+    :type steps: list
+    :param steps: List of (action, params) pairs applied to the image before it is resized
+    :type renditions: list
+    :param renditions: List of (size, extension, profile) triples, e.g. ((800, 600), ".webp", None)
+    :return: Tuple of the encoded renditions in the same order, or None if the source could not be decoded, and the
+        times at which it was "decoded", "transformed" and "encoded"
+    """
+    timings = {}
+    order = sorted(xrange(len(renditions)), key=lambda i: renditions[i][0][0] * renditions[i][0][1], reverse=True)
+    largest = tuple(renditions[order[0]][0])
+    try:
+        image, steps = _decode(Image.open(BytesIO(data)), list(steps) + [('resize', {'size': largest})])
+        timings['decoded'] = time.time()
+        base = _apply(image, steps[:-1])
+
+        images = [None] * len(renditions)
+        rendered = []
+        for i in order:
+            size = tuple(renditions[i][0])
+            source = base
+            for image in rendered:
+                if image.size[0] >= size[0] and image.size[1] >= size[1]:
+                    source = image
+            images[i] = source.resize(size, Image.ANTIALIAS)
+            rendered.append(images[i])
+        timings['transformed'] = time.time()
+
+        Image.init()
+        outputs = []
+        for image, (size, extension, profile) in zip(images, renditions):
+            output = BytesIO()
+            _save(image, output, Image.EXTENSION[extension.lower()], profile)
+            outputs.append(output.getvalue())
+        timings['encoded'] = time.time()
+        return outputs, timings
     except IOError:
         _log.warn('Image truncation error')
+        return None, timings
+
+
+def transcode(src, dest, profile=None):
+    """
+    Transcode an image file from a source to a destination file. This will remove the source file
+
+    :param profile: The output profile, one of PROFILES
+    """
+    process(src, dest, [('transcode', {'profile': profile})])
 
     if src != dest:
-        try:
-            os.unlink(src)
-        except OSError, e:
-            if e.errno == errno.ENOENT:
-                pass
-            else:
-                raise
+        _unlink(src)
 
 
-def resize(src, dest, size):
+def resize(src, dest, size, profile=None):
     """
     Resize an image and save the resized image to the new destination. Size is described by a
 
@@ -58,18 +501,12 @@ def resize(src, dest, size):
     :param dest: Destination file
     :type size: tuple
     :param size: A tuple of x and y (in pixels) of the new size, e.g. (200, 548)
+    :param profile: The output profile, one of PROFILES
     """
-    try:
-        image = Image.open(src)
-
-        _makedirpath(dest)
-        image = image.resize(size, Image.ANTIALIAS)
-        image.save(dest)
-    except IOError:
-        _log.warn('Image truncation error')
+    process(src, dest, [('resize', {'size': size, 'profile': profile})])
 
 
-def crop(src, dest, box):
+def crop(src, dest, box, profile=None):
     """
     Crop the image to points described by the box
 
@@ -77,59 +514,1214 @@ def crop(src, dest, box):
     :param dest: Destination file
     :type box: tuple
     :param box: Tuple of the new bounding box for the image, e.g. (200, 50, 90, 80)
+    :param profile: The output profile, one of PROFILES
+    """
+    process(src, dest, [('crop', {'box': box, 'profile': profile})])
+
+
+def destination(action, src, params):
+    """
+    The file a job writes to, given the image's current location
+
+    :param action: One of "transcode", "resize" or "crop"
+    :param src: The current location of the image
+    :type params: dict
+    :param params: The job params; transcode jobs must include the "extension" to transcode to
+    """
+    if action == 'transcode':
+        base, ext = os.path.splitext(src)
+        return '.'.join([base, params['extension']])
+    return src
+
+
+def variant(img_id, original, steps):
+    """
+    The name and file of an image variant. The name describes the operations applied to the original, e.g.
+    "crop:0,0,50,50;transcode:png"; the original itself is named "original".
+
+    :param img_id: The image ID
+    :param original: Location of the original image
+    :type steps: list
+    :param steps: List of [action, params] pairs applied to the original, as from cache.operations()
+    :return: Tuple of the variant's name and location
+    """
+    def describe(value):
+        if isinstance(value, (list, tuple)):
+            return ','.join(str(v) for v in value)
+        return str(value)
+
+    name = ';'.join('{}:{}'.format(action, ':'.join(describe(params[key]) for key in sorted(params)))
+                    for action, params in steps) or 'original'
+
+    dest = original
+    for action, params in steps:
+        dest = destination(action, dest, params)
+    ext = os.path.splitext(dest)[1]
+
+    return name, '{}{}/{}{}'.format(VARIANT_PREFIX, img_id, hashlib.sha1(name).hexdigest(), ext)
+
+
+def perform(src, dest, steps, src_hash=None):
+    """
+    Apply a sequence of actions to an image in a single pass, or take the result from the derivative cache. This only
+    takes plain job params so that it can be shipped to another process
+
+    :param src: Storage key of the original image
+    :param dest: Storage key the result is written to
+    :type steps: list
+    :param steps: List of (action, params) pairs as they were put on the queue
+    :param src_hash: Content hash of the source image, if known; the cache is skipped without it
+    :return: Content hash of the resulting image
     """
+    cache_key = cache.key(src_hash, steps, os.path.splitext(dest)[1]) if src_hash else None
+    cached = cache.get(cache_key) if cache_key else None
+    if cached and cache.link(cached[0], dest):
+        path, content_hash, size = cached
+        return content_hash
+
+    data = storage.backend.read(src)
+    token = budget.acquire(footprint(BytesIO(data), steps))
     try:
-        image = Image.open(src)
+        output = render(data, steps, os.path.splitext(dest)[1])[0]
+    finally:
+        budget.release(token)
 
-        _makedirpath(dest)
-        image = image.crop(box)
-        image.save(dest)
-    except IOError:
-        _log.warn('Image truncation error')
+    if output is None:
+        metrics.increment(store.pipeline(transaction=False), 'transcoder_image_truncation_errors_total',
+                          source='perform').execute()
+        return None
 
+    storage.backend.put(dest, output)
+    content_hash = hashlib.sha1(output).hexdigest()
+    if cache_key:
+        cache.put(cache_key, dest, content_hash, len(output))
+    return content_hash
 
-def worker():
+
+class PixelBudget(object):
     """
-    Initiate the asset processing and start delegating the background jobs
+    A budget of pixels shared by the workers of every process and machine. Workers take the pixels an image needs from
+    it before decoding the image, waiting until there are enough, and give them back once it is encoded, so that
+    together they never hold more decoded pixels than the budget. An image that needs more than the whole budget is
+    let through whenever nothing else holds any. Pixels that are not given back, e.g. by a worker that crashed, are
+    given back once their hold lapses.
+    """
+
+    def __init__(self, name, limit, timeout=VISIBILITY_TIMEOUT, poll=0.05):
+        """
+        :param limit: Pixels in the budget; 0 for no limit
+        :param timeout: Seconds until a hold lapses
+        :param poll: Seconds to wait before first checking again for enough pixels; this doubles up to a second
+        """
+        self.name = name
+        self.limit = limit
+        self.timeout = timeout
+        self.poll = poll
+
+    def holds(self, pipe, now=None):
+        """
+        Read the holds that have not lapsed; pass the result to held()
+
+        :param pipe: The pipeline to read the holds with; it is left to the caller to execute
+        """
+        pipe.zrangebyscore(self.name, now or time.time(), '+inf')
+        return pipe
+
+    @staticmethod
+    def held(holds):
+        """
+        The number of pixels held, as read by holds()
+        """
+        return sum(int(hold.rsplit(':', 1)[1]) for hold in holds)
+
+    def acquire(self, pixels):
+        """
+        Take pixels from the budget, waiting until there are enough
 
-    :type queue: JobQueue
+        :return: A token to give them back with, or None if the budget has no limit
+        """
+        if not self.limit:
+            return None
+
+        token = '{}:{}'.format(uuid.uuid4().hex, pixels)
+        delay = self.poll
+        while True:
+            now = time.time()
+            pipe = store.pipeline()
+            try:
+                pipe.watch(self.name)
+                held = self.held(pipe.zrangebyscore(self.name, now, '+inf'))
+                if not held or held + pixels <= self.limit:
+                    pipe.multi()
+                    pipe.zremrangebyscore(self.name, '-inf', now)
+                    pipe.zadd(self.name, now + self.timeout, token)
+                    pipe.execute()
+                    return token
+            except WatchError:
+                # Another worker took or gave back pixels in the meantime; look again straight away
+                continue
+            finally:
+                pipe.reset()
+
+            time.sleep(delay)
+            delay = min(delay * 2, 1)
+
+    def release(self, token):
+        if token is not None:
+            store.zrem(self.name, token)
+
+
+budget = PixelBudget('transcoder.budget', PIXEL_BUDGET)
+
+
+class ThreadExecutor(object):
     """
-    while True:
+    Executes jobs directly on the worker thread that pulled them off the queue
+    """
+
+    processes = 1
+
+    def run(self, func, *args):
+        return func(*args)
+
+    def resize(self, processes):
+        pass
+
+    def close(self):
+        pass
+
+
+def _ignore_signals():
+    # The pool's processes are left to finish what they are given; the worker stops them once it has drained
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+
+class ProcessExecutor(object):
+    """
+    Executes jobs in a pool of worker processes so the image work is not serialized on the GIL. Only the job params
+    cross the process boundary; each process opens and decodes the image itself.
+
+    The processes are all forked when the executor is made, which must be before the process starts any threads: a
+    process forked while other threads hold locks (such as the logging module's) can deadlock on them. Resizing the
+    executor changes how many of its processes are used at once, rather than forking more.
+    """
+
+    def __init__(self, processes=None, max_processes=None):
+        """
+        :param processes: Number of processes to use at once, at first; by default, one per CPU
+        :param max_processes: The most processes resize() can grow to, which are all forked now; by default, as many
+                              as are used at first
+        """
+        self.processes = processes or multiprocessing.cpu_count()
+        self.max_processes = max(max_processes or 0, self.processes)
+        self._pool = multiprocessing.Pool(self.max_processes, _ignore_signals)
+        self._limit = _Limit(self.processes)
+
+    def run(self, func, *args):
+        with self._limit:
+            return self._pool.apply_async(func, args).get()
+
+    def resize(self, processes):
+        """
+        Change how many processes are used at once, up to max_processes; the jobs running on the others finish first
+        """
+        self.processes = min(processes, self.max_processes)
+        self._limit.resize(self.processes)
+
+    def close(self):
+        """
+        Stop the pool's processes once they have finished their work
+        """
+        self._pool.close()
+        self._pool.join()
+
+
+# The executor the workers hand their jobs to; swap in a ProcessExecutor to use all cores
+executor = ThreadExecutor()
+
+
+class RedisQueue(object):
+    """
+    A durable job queue kept in Redis lists. Taking a job atomically moves it onto a processing list, where it stays
+    until the worker acknowledges it; jobs that are not acknowledged within the visibility timeout are put back on
+    the queue for another worker to pick up.
+    """
+
+    def __init__(self, name, visibility_timeout=VISIBILITY_TIMEOUT):
+        self.name = name
+        self.processing = '{}.processing'.format(name)
+        self.deadlines = '{}.deadlines'.format(name)
+        self.visibility_timeout = visibility_timeout
+
+    @staticmethod
+    def _encode(job):
+        return json.dumps(job, sort_keys=True)
+
+    def put(self, job):
+        store.lpush(self.name, self._encode(job))
+
+    def get(self, block=True, timeout=None, owner=None):
+        """
+        Take the oldest job off the queue; raises Empty if there is none (within the timeout, if blocking)
+
+        :param owner: Key of a hash to record the job in, mapped to the name of this queue, along with its deadline
+        """
+        if block:
+            payload = store.brpoplpush(self.name, self.processing, timeout=int(timeout or 0))
+        else:
+            payload = store.rpoplpush(self.name, self.processing)
+
+        if payload is None:
+            raise Empty
+
+        pipe = store.pipeline()
+        pipe.zadd(self.deadlines, time.time() + self.visibility_timeout, payload)
+        if owner:
+            pipe.hset(owner, payload, self.name)
+        pipe.execute()
+        return json.loads(payload)
+
+    def ack(self, job, pipe=None):
+        """
+        Acknowledge a job taken with get() so that it is never handed out again
+
+        :param pipe: A pipeline to acknowledge the job with; it is left to the caller to execute
+        """
+        payload = self._encode(job)
+        execute = pipe is None
+        pipe = store.pipeline() if execute else pipe
+        pipe.lrem(self.processing, 1, payload)
+        pipe.zrem(self.deadlines, payload)
+        if execute:
+            pipe.execute()
+
+    def requeue_abandoned(self):
+        """
+        Put jobs whose visibility timeout has passed back at the front of the queue
+        """
+        now = time.time()
+
+        # A worker that died between taking a job and setting its deadline leaves a job with no deadline
+        taken = store.lrange(self.processing, 0, -1)
+        if taken:
+            pipe = store.pipeline()
+            for payload in taken:
+                pipe.zscore(self.deadlines, payload)
+            for payload, deadline in zip(taken, pipe.execute()):
+                if deadline is None:
+                    store.zadd(self.deadlines, now + self.visibility_timeout, payload)
+
+        for payload in store.zrangebyscore(self.deadlines, 0, now):
+            self.requeue(payload)
+
+    def requeue(self, payload):
+        """
+        Put a job that was taken back at the front of the queue, unless it has been acknowledged or requeued already
+
+        :return: Whether the job was requeued
+        """
+        # Only the worker that removes the deadline gets to requeue the job
+        if not store.zrem(self.deadlines, payload):
+            return False
+
+        pipe = store.pipeline()
+        pipe.lrem(self.processing, 1, payload)
+        pipe.rpush(self.name, payload)
+        removed, _ = pipe.execute()
+        if not removed:
+            # The job was acknowledged in the meantime
+            store.lrem(self.name, -1, payload)
+            return False
+        _log.warn('Requeued abandoned job {}'.format(payload))
+        return True
+
+    def qsize(self):
+        return store.llen(self.name)
+
+    def empty(self):
+        return self.qsize() == 0
+
+
+class LaneQueue(object):
+    """
+    A job queue sharded into lanes by image ID. Each lane is a RedisQueue that only the worker holding the lane's
+    lease may take jobs from, so the jobs of a single image are never processed concurrently or out of order.
+
+    Every priority class has its own set of lanes, sharing the leases; workers take jobs from the most urgent class
+    that has any. The number and estimated cost of the jobs queued in each class are kept up to date, so producers
+    can be turned away when a class is full.
+
+    The jobs taken through the queue are recorded under its worker ID until they are acknowledged, so that they can be
+    taken back if the worker's heartbeat lapses.
+    """
+
+    def __init__(self, name, lanes=LANE_COUNT, visibility_timeout=VISIBILITY_TIMEOUT, priorities=PRIORITIES,
+                 worker_id=WORKER_ID):
+        self.name = name
+        self.signal = '{}.signal'.format(name)
+        self.load = '{}.load'.format(name)
+        self.workers = '{}.workers'.format(name)
+        self.worker_id = worker_id
+        self.visibility_timeout = visibility_timeout
+        self.priorities = priorities
+        self.classes = dict((priority, [RedisQueue('{}.{}.{}'.format(name, priority, n), visibility_timeout)
+                                        for n in xrange(lanes)]) for priority in priorities)
+        self.lane_count = lanes
+        self._tokens = {}
+        self._next_requeue = 0
+
+    def lane(self, img_id):
+        """
+        The index of the lane that all jobs for an image go through
+        """
+        return zlib.crc32(img_id.encode('utf-8')) % self.lane_count
+
+    def _queue(self, job):
+        return self.classes[job[1].get('priority', DEFAULT_PRIORITY)][self.lane(job[1]['img_id'])]
+
+    def _lease(self, n):
+        return '{}.{}.lease'.format(self.name, n)
+
+    def _taken(self, worker_id):
+        return '{}.{}'.format(self.workers, worker_id)
+
+    def _acquire(self, n):
+        # Leases name the worker holding them, so they can be freed if it is lost
+        token = '{}/{}'.format(self.worker_id, uuid.uuid4())
+        if store.set(self._lease(n), token, ex=self.visibility_timeout, nx=True):
+            self._tokens[n] = token
+            return True
+        return False
+
+    def _release(self, n):
+        self._free(n, self._tokens.pop(n, None))
+
+    def _free(self, n, token):
+        """
+        Give up a lane's lease if it is still held with a token
+        """
+        pipe = store.pipeline()
         try:
-            job = queue.get(timeout=100)
-        except Empty:
-            _log.debug('Found nothing to process')
-            continue
+            pipe.watch(self._lease(n))
+            if pipe.get(self._lease(n)) == token:
+                pipe.multi()
+                pipe.delete(self._lease(n))
+                pipe.execute()
+        finally:
+            pipe.reset()
+
+        # Another job may have been queued on this lane while we held it
+        self._wake(store.pipeline()).execute()
+
+    def _wake(self, pipe):
+        pipe.lpush(self.signal, 1)
+        pipe.ltrim(self.signal, 0, self.lane_count - 1)
+        return pipe
 
+    def put(self, job, pipe=None):
+        """
+        Queue a job on its image's lane in the job's priority class
+
+        :param pipe: A pipeline to queue the job with; it is left to the caller to execute
+        """
         action, params = job
+        priority = params.get('priority', DEFAULT_PRIORITY)
+        execute = pipe is None
+        pipe = store.pipeline() if execute else pipe
+        pipe.lpush(self._queue(job).name, RedisQueue._encode(job))
+        pipe.hincrby(self.load, '{}.depth'.format(priority), 1)
+        pipe.hincrbyfloat(self.load, '{}.cost'.format(priority), params.get('cost', 0))
+        self._wake(pipe)
+        if execute:
+            pipe.execute()
+
+    def get(self, block=True, timeout=None):
+        """
+        Take the next job from any lane that is not leased by another worker, most urgent class first; raises Empty if
+        there is none (within the timeout, if blocking). The lane stays leased to this worker until the job is
+        acknowledged.
+        """
+        deadline = time.time() + (timeout or 0)
+        while True:
+            # Start at a random lane so that busy lanes do not starve the others
+            offset = random.randrange(self.lane_count)
+            order = [(priority, n) for priority in self.priorities
+                     for n in range(offset, self.lane_count) + range(offset)]
+            pipe = store.pipeline()
+            for priority, n in order:
+                pipe.llen(self.classes[priority][n].name)
+            for (priority, n), depth in zip(order, pipe.execute()):
+                if not depth or not self._acquire(n):
+                    continue
+                try:
+                    return self.classes[priority][n].get(block=False, owner=self._taken(self.worker_id))
+                except Empty:
+                    self._release(n)
+
+            remaining = deadline - time.time()
+            if not block or remaining <= 0:
+                raise Empty
+            store.brpop(self.signal, timeout=max(1, int(remaining)))
+
+    def following(self, job, limit=FUSE_LIMIT):
+        """
+        Take the jobs queued directly behind a job for the same image. This must only be called while holding the job's
+        lane, so nothing else can take jobs from it in the meantime.
+        """
+        img_id = job[1]['img_id']
+        lane = self._queue(job)
+
+        jobs = []
+        while len(jobs) < limit and job[0] not in UNFUSED_ACTIONS:
+            payload = store.lindex(lane.name, -1)
+            if payload is None:
+                break
+            action, params = json.loads(payload)
+            if params['img_id'] != img_id or action in UNFUSED_ACTIONS:
+                break
+            jobs.append(lane.get(block=False, owner=self._taken(self.worker_id)))
+        return jobs
+
+    def ack(self, *jobs, **kwargs):
+        """
+        Acknowledge jobs taken with get() or following(), and free their lanes
 
-        src = params.get('src')
-        dest = params.get('dest')
-        job_id = params.get('job_id')
-        img_id = params.get('img_id')
+        :param pipe: A pipeline to acknowledge the jobs with, along with whatever else the caller added to it; it is
+                     executed before the lanes are freed
+        """
+        pipe = kwargs.pop('pipe', None) or store.pipeline()
+        lanes = set()
+        for job in jobs:
+            priority = job[1].get('priority', DEFAULT_PRIORITY)
+            self._queue(job).ack(job, pipe)
+            pipe.hdel(self._taken(self.worker_id), RedisQueue._encode(job))
+            pipe.hincrby(self.load, '{}.depth'.format(priority), -1)
+            pipe.hincrbyfloat(self.load, '{}.cost'.format(priority), -job[1].get('cost', 0))
+            lanes.add(self.lane(job[1]['img_id']))
+        pipe.execute()
+        for n in lanes:
+            self._release(n)
 
-        store.set(job_id, 'processing')
+    def backlog(self, load):
+        """
+        The number and estimated cost of the jobs queued in each priority class
 
-        # Only try to process one image at a time
-        lock = threading.Lock()
-        lock.acquire()
+        :param load: The hash stored under self.load
+        :return: {priority: (depth, cost)}
+        """
+        load = load or {}
+        return dict((priority, (int(load.get('{}.depth'.format(priority), 0)),
+                                float(load.get('{}.cost'.format(priority), 0)))) for priority in self.priorities)
+
+    def heartbeat(self, timeout=HEARTBEAT_TIMEOUT):
+        """
+        Register the worker as alive for the next `timeout` seconds
+        """
+        store.zadd(self.workers, time.time() + timeout, self.worker_id)
+
+    def renew(self):
+        """
+        Extend the leases of the lanes the worker holds, and the deadlines of the jobs it has taken, by another
+        visibility timeout, so that jobs which wait long for the pixel budget are not taken back while it holds them.
+        Leases and jobs that have been taken back in the meantime are left to whoever has them now.
+        """
+        tokens = self._tokens.items()
+        pipe = store.pipeline()
         try:
-            if action == 'transcode':
-                transcode(src, dest)
-            elif action == 'resize':
-                resize(src, dest, params.get('size'))
-            elif action == 'crop':
-                crop(src, dest, params.get('box'))
-
-            # Update the new destination and job status
-            store.set('images.{img_id}.location'.format(img_id=img_id), dest)
-            store.set(job_id, 'done')
-
-        except Exception, e:
-            _log.warn('Error in job {}: {}'.format(job_id, e))
-            store.set(job_id, 'error: {}'.format(e))
-            raise
+            while True:
+                taken = store.hgetall(self._taken(self.worker_id)).items()
+                leases = [self._lease(n) for n, token in tokens]
+                deadlines = ['{}.deadlines'.format(name) for payload, name in taken]
+                if not leases and not deadlines:
+                    return
+
+                pipe.watch(*set(leases + deadlines))
+                current = pipe.mget(*leases) if leases else []
+                scores = [pipe.zscore(key, payload) for key, (payload, name) in zip(deadlines, taken)]
+
+                pipe.multi()
+                for lease, (n, token), held in zip(leases, tokens, current):
+                    if held == token:
+                        pipe.expire(lease, self.visibility_timeout)
+                deadline = time.time() + self.visibility_timeout
+                for key, (payload, name), score in zip(deadlines, taken, scores):
+                    if score is not None:
+                        pipe.zadd(key, deadline, payload)
+                try:
+                    pipe.execute()
+                    return
+                except WatchError:
+                    continue
+        finally:
+            pipe.reset()
+
+    def leave(self):
+        """
+        Deregister the worker once it has stopped, with no jobs left
+        """
+        pipe = store.pipeline()
+        pipe.zrem(self.workers, self.worker_id)
+        pipe.delete(self._taken(self.worker_id))
+        pipe.hdel(POOL, self.worker_id)
+        pipe.execute()
+
+    def alive(self, now=None):
+        """
+        The number of workers whose heartbeat has not lapsed
+        """
+        return store.zcount(self.workers, now or time.time(), '+inf')
+
+    def requeue_lost(self, now=None):
+        """
+        Put the jobs taken by workers whose heartbeat has lapsed back at the front of their lanes, and free the lanes
+        they held
+
+        :return: IDs of the lost workers
+        """
+        lost = []
+        lanes = dict((lane.name, lane) for priority in self.priorities for lane in self.classes[priority])
+        for worker_id in store.zrangebyscore(self.workers, 0, now or time.time()):
+            # Only the worker that removes the lost one gets to take its jobs back
+            if not store.zrem(self.workers, worker_id):
+                continue
+            lost.append(worker_id)
+
+            requeued = 0
+            for payload, name in store.hgetall(self._taken(worker_id)).items():
+                if name in lanes and lanes[name].requeue(payload):
+                    requeued += 1
+
+            leases = store.mget(*[self._lease(n) for n in xrange(self.lane_count)])
+            for n, token in enumerate(leases):
+                if token and token.startswith('{}/'.format(worker_id)):
+                    self._free(n, token)
 
+            pipe = store.pipeline()
+            pipe.delete(self._taken(worker_id))
+            pipe.hdel(INFLIGHT, worker_id)
+            pipe.hdel(POOL, worker_id)
+            self._wake(pipe).execute()
+            _log.warn('Worker {} was lost; requeued {} of its jobs'.format(worker_id, requeued))
+        return lost
+
+    def requeue_abandoned(self):
+        if time.time() < self._next_requeue:
+            return
+        self._next_requeue = time.time() + REQUEUE_INTERVAL
+        self.requeue_lost()
+        for priority in self.priorities:
+            for lane in self.classes[priority]:
+                lane.requeue_abandoned()
+
+    def qsize(self):
+        pipe = store.pipeline()
+        for priority in self.priorities:
+            for lane in self.classes[priority]:
+                pipe.llen(lane.name)
+        return sum(pipe.execute())
+
+    def empty(self):
+        return self.qsize() == 0
+
+
+queue = LaneQueue('transcoder.queue')
+
+
+def _set_status(pipe, tasks, status):
+    for action, params in tasks:
+        jobs.set_status(pipe, params.get('job_id'), status, params.get('callback'))
+    return pipe
+
+
+class _Task(object):
+    """
+    A group of fused jobs for one image on its way through the worker's stages
+    """
+
+    def __init__(self, jobs):
+        self.jobs = jobs
+        self.job_ids = [params.get('job_id') for action, params in jobs]
+        self.img_id = jobs[0][1].get('img_id')
+
+        # Set once the jobs have failed
+        self.status = None
+
+        self.steps = self.name = self.dest = self.cache_key = None
+        self.original = None
+        self.renditions = None
+        self.source = None
+        self.source_bytes = None
+        self.output = None
+        self.output_bytes = None
+        self.content_hash = None
+
+        # Pixels the image work holds at most, from the budget
+        self.pixels = 0
+
+        # Seconds the executor took to render the image, if it was rendered
+        self.render_seconds = None
+
+        # Stage -> time it ended at, shared by the jobs
+        self.timings = {}
+        self.truncated = False
+
+    def mark(self, stage):
+        self.timings[stage] = time.time()
+
+
+class _Rendition(object):
+    """
+    One of the variants a renditions job generates
+    """
+
+    def __init__(self, size, steps, name, dest):
+        self.size = size
+        self.steps = steps
+        self.name = name
+        self.dest = dest
+        self.cache_key = None
+        self.output = None
+        self.output_bytes = None
+        self.content_hash = None
+
+
+def _take(timeout=100):
+    """
+    Take the next job off the queue, with the jobs queued right behind it for the same image fused into a single pass
+
+    :return: A _Task, or None if no job came in within the timeout
+    """
+    queue.requeue_abandoned()
+    try:
+        job = queue.get(timeout=timeout)
+    except Empty:
+        _log.debug('Found nothing to process')
+        return None
+    return _Task([job] + queue.following(job))
+
+
+def _fetch(task):
+    """
+    Mark a task's jobs as processing and read the original it is rendered from, unless the result is cached
+    """
+    img_id = task.img_id
+    task.mark('started')
+    pipe = _set_status(store.pipeline(), task.jobs, 'processing')
+    pipe.hincrby(INFLIGHT, WORKER_ID, len(task.jobs))
+    pipe.mget('images.{img_id}.location'.format(img_id=img_id),
+              'images.{img_id}.original'.format(img_id=img_id),
+              'images.{img_id}.hash'.format(img_id=img_id),
+              'images.{img_id}.steps'.format(img_id=img_id),
+              'images.{img_id}.bytes'.format(img_id=img_id))
+    location, original, src_hash, applied, source_bytes = pipe.execute()[-1]
+    metrics.record_round_trips('worker.fetch')
+    task.mark('fetched')
+
+    # Render the new variant from the untouched original, with all of the image's operations so far
+    original = original or location
+    if not original:
+        # The image was deleted while its jobs were queued
+        task.status = 'error: image {} no longer exists'.format(img_id)
+        return
+    task.original = original
+
+    # Images stored before their size was recorded have it looked up
+    task.source_bytes = int(source_bytes) if source_bytes else None
+    task.steps = json.loads(applied or '[]')
+    if task.jobs[0][0] == 'renditions':
+        if _fetch_renditions(task, original, src_hash):
+            task.mark('cached')
+            if task.source_bytes is None:
+                task.source_bytes = storage.backend.size(original)
+            return
+    else:
+        task.steps += cache.operations(task.jobs)
+        task.name, task.dest = variant(img_id, original, task.steps)
+
+        if src_hash:
+            task.cache_key = cache.key(src_hash, task.steps, os.path.splitext(task.dest)[1])
+            cached = cache.get(task.cache_key)
+            if cached and cache.link(cached[0], task.dest):
+                path, task.content_hash, task.output_bytes = cached
+                task.mark('cached')
+                if task.source_bytes is None:
+                    task.source_bytes = storage.backend.size(original)
+                return
+
+    task.source = storage.backend.read(original)
+    task.source_bytes = len(task.source)
+    if task.renditions is None:
+        task.pixels = footprint(BytesIO(task.source), task.steps)
+    else:
+        # The renditions are all held until they are encoded
+        sizes = sorted((r.size for r in task.renditions if not r.content_hash), key=lambda size: size[0] * size[1])
+        task.pixels = footprint(BytesIO(task.source), task.steps + [('resize', {'size': sizes[-1]})])
+        task.pixels += sum(width * height for width, height in sizes[:-1])
+    task.mark('read')
+
+
+def _fetch_renditions(task, original, src_hash):
+    """
+    Work out the variants a renditions task generates from its image's current steps, linking those that are cached
+    into place
+
+    :return: Whether every one of them was cached
+    """
+    params = task.jobs[0][1]
+    task.renditions = []
+    for width, height, extension in params['renditions']:
+        steps = rendition_steps(task.steps, (width, height), extension, params.get('profile'))
+        rendition = _Rendition((width, height), steps, *variant(task.img_id, original, steps))
+        if src_hash:
+            rendition.cache_key = cache.key(src_hash, steps, os.path.splitext(rendition.dest)[1])
+            cached = cache.get(rendition.cache_key)
+            if cached and cache.link(cached[0], rendition.dest):
+                path, rendition.content_hash, rendition.output_bytes = cached
+        task.renditions.append(rendition)
+    return all(rendition.content_hash for rendition in task.renditions)
+
+
+def _render(task):
+    """
+    Have the executor decode, transform and encode a task's image, once the pixel budget allows
+    """
+    if task.source is not None:
+        token = budget.acquire(task.pixels)
+        try:
+            task.mark('budgeted')
+            if task.renditions is None:
+                task.output, timings = executor.run(render, task.source, task.steps, os.path.splitext(task.dest)[1])
+                task.truncated = task.output is None
+            else:
+                pending = [r for r in task.renditions if not r.content_hash]
+                outputs, timings = executor.run(render_renditions, task.source, task.steps, [
+                    (r.size, os.path.splitext(r.dest)[1], _profile(r.steps)) for r in pending])
+                for rendition, output in zip(pending, outputs or []):
+                    rendition.output = output
+                task.truncated = outputs is None
+            task.render_seconds = time.time() - task.timings['budgeted']
         finally:
-            lock.release()
+            budget.release(token)
+        task.timings.update(timings)
+        task.source = None
+
+
+def _finish(task):
+    """
+    Write a task's result, point its image at the new variant (or, for renditions, add them to its variants), record
+    the jobs' status and acknowledge them
+    """
+    img_id = task.img_id
+    pipe = store.pipeline()
+    discarded = None
+    try:
+        if task.renditions is not None:
+            _finish_renditions(pipe, task)
+
+        elif task.output is not None and task.status is None:
+            task.content_hash = _write(task.dest, task.output, task.cache_key)
+            task.output_bytes = len(task.output)
+            task.mark('written')
+
+        if task.renditions is None and task.content_hash and task.status is None:
+            if len(task.steps) > MAX_STEPS:
+                discarded = _snapshot(pipe, task)
+            else:
+                # Point the image at its new variant. Images stored before originals were recorded have their location
+                # kept as the original first, so that later jobs are not rendered from this variant.
+                pipe.setnx('images.{img_id}.original'.format(img_id=img_id), task.original)
+                pipe.set('images.{img_id}.location'.format(img_id=img_id), task.dest)
+                pipe.set('images.{img_id}.steps'.format(img_id=img_id), json.dumps(task.steps))
+                pipe.hset('images.{img_id}.variants'.format(img_id=img_id), task.name, task.dest)
+
+    finally:
+        _set_status(pipe, task.jobs, task.status or 'done')
+        _record_timings(pipe, task)
+        _record_bytes(pipe, task)
+        pipe.hincrby(INFLIGHT, WORKER_ID, -len(task.jobs))
+        pipe.decr('images.{img_id}.pending'.format(img_id=img_id), len(task.jobs))
+        pipe.hlen('images.{img_id}.variants'.format(img_id=img_id))
+        variants = pipe.execute()[-1]
+        queue.ack(*task.jobs)
+        metrics.record_round_trips('worker.finish')
+
+    if discarded:
+        _discard(*discarded)
+    if variants > MAX_VARIANTS:
+        trim_variants(img_id, task.dest)
+
+
+def _snapshot(pipe, task):
+    """
+    Make a task's variant the original of its image, with no steps applied, in place of the original it was rendered
+    from and the variants of that. It is left to the caller to execute the pipeline.
+
+    :return: The previous original, its content hash and its variants, to be discarded with _discard once the pipeline
+             is executed
+    """
+    img_id = task.img_id
+    src_hash, dimensions = store.mget('images.{img_id}.hash'.format(img_id=img_id),
+                                      'images.{img_id}.dimensions'.format(img_id=img_id))
+    variants = store.hvals('images.{img_id}.variants'.format(img_id=img_id))
+
+    pipe.set('images.{img_id}.original'.format(img_id=img_id), task.dest)
+    pipe.set('images.{img_id}.location'.format(img_id=img_id), task.dest)
+    pipe.set('images.{img_id}.steps'.format(img_id=img_id), json.dumps([]))
+    pipe.set('images.{img_id}.hash'.format(img_id=img_id), task.content_hash)
+    pipe.set('images.{img_id}.bytes'.format(img_id=img_id), task.output_bytes)
+    if dimensions:
+        pipe.set('images.{img_id}.dimensions'.format(img_id=img_id),
+                 '{},{}'.format(*image_size(dimensions, task.steps)))
+    pipe.delete('images.{img_id}.variants'.format(img_id=img_id))
+    return task.original, src_hash, [key for key in variants if key != task.dest]
+
+
+def _discard(original, src_hash, variants):
+    """
+    Remove the files of an image's previous original and its variants once a snapshot has replaced them. Uploads are
+    shared by the images with the same content, so only the image's reference to them is dropped.
+    """
+    if original.startswith(uploads.BLOB_PREFIX):
+        uploads.release(src_hash, original)
+    else:
+        storage.backend.delete(original)
+    for key in variants:
+        storage.backend.delete(key)
+
+
+def trim_variants(img_id, *keep):
+    """
+    Remove variants of an image, other than those to keep, until it has no more than MAX_VARIANTS. The variants have
+    no order, so arbitrary ones are removed; they are generated again when they are next asked for.
+
+    :param keep: Storage keys of the variants that must stay, e.g. the image's current one
+    :return: The number of variants removed
+    """
+    variants = store.hgetall('images.{img_id}.variants'.format(img_id=img_id))
+    excess = [name for name, key in variants.items() if key not in keep][:max(0, len(variants) - MAX_VARIANTS)]
+    if excess:
+        store.hdel('images.{img_id}.variants'.format(img_id=img_id), *excess)
+        for name in excess:
+            storage.backend.delete(variants[name])
+    return len(excess)
+
+
+def _write(key, output, cache_key=None):
+    """
+    Store a rendered image, and add it to the derivative cache under its cache key
+
+    :return: The image's content hash
+    """
+    storage.backend.put(key, output)
+    content_hash = hashlib.sha1(output).hexdigest()
+    if cache_key:
+        cache.put(cache_key, key, content_hash, len(output))
+    return content_hash
+
+
+def _finish_renditions(pipe, task):
+    """
+    Write the renditions a task rendered and add all of its renditions to the image's variants, leaving the image
+    itself as it was. It is left to the caller to execute the pipeline.
+    """
+    if task.status is not None:
+        return pipe
+
+    written = False
+    for rendition in task.renditions:
+        if rendition.output is not None:
+            rendition.content_hash = _write(rendition.dest, rendition.output, rendition.cache_key)
+            rendition.output_bytes = len(rendition.output)
+            written = True
+        if rendition.content_hash:
+            pipe.hset('images.{img_id}.variants'.format(img_id=task.img_id), rendition.name, rendition.dest)
+    if written:
+        task.mark('written')
+    return pipe
+
+
+def record_timings(pipe, fused, timings, dest, failed=False):
+    """
+    Store the times at which fused jobs reached each stage, and add the time they spent in them to the metrics.
+    Queue waits are observed for each job; the other stages, which fused jobs go through together, once, as the
+    combination of the jobs' actions (e.g. "crop+resize"). It is left to the caller to execute the pipeline.
+
+    :param fused: List of (action, params) of the jobs
+    :param timings: {stage: time} that the jobs reached each stage at, from "started" until "finished"
+    :param dest: Where the jobs' result is written, for the format label
+    :param failed: Whether the jobs failed
+    """
+    extension = os.path.splitext(dest or '')[1].lstrip('.') or 'none'
+    actions = []
+    for action, params in fused:
+        if action not in actions:
+            actions.append(action)
+
+    for stage, start, end in STAGES:
+        if stage != 'wait' and start in timings and end in timings:
+            metrics.observe(pipe, 'transcoder_stage_seconds', max(0.0, timings[end] - timings[start]),
+                            stage=stage, action='+'.join(actions), format=extension)
+
+    for action, params in fused:
+        job_timings = dict(timings, queued=params.get('queued', timings['started']))
+        pipe.hmset(jobs.key(params.get('job_id')), job_timings)
+        metrics.observe(pipe, 'transcoder_stage_seconds', max(0.0, job_timings['started'] - job_timings['queued']),
+                        stage='wait', action=action, format=extension)
+        metrics.increment(pipe, 'transcoder_jobs_total', action=action, status='error' if failed else 'done')
+    return pipe
+
+
+def _record_timings(pipe, task):
+    """
+    Record the timings of a task's jobs with record_timings, and whether its image could not be decoded
+    """
+    task.mark('finished')
+    record_timings(pipe, task.jobs, task.timings, task.dest, failed=task.status is not None)
+    if task.truncated:
+        metrics.increment(pipe, 'transcoder_image_truncation_errors_total', source='worker')
+    return pipe
+
+
+def _record_bytes(pipe, task):
+    """
+    Store the size of a task's result, and how much smaller it is than the source, whether it was rendered or taken
+    from the cache. Add the sizes of both to the metrics if it was rendered (where the bytes saved are the difference,
+    since counters cannot go down).
+    """
+    if task.status is not None:
+        return pipe
+
+    if task.renditions is not None:
+        outputs = [r.output for r in task.renditions if r.output is not None]
+        sizes = [r.output_bytes for r in task.renditions]
+        output_bytes = sum(sizes) if None not in sizes else None
+    else:
+        outputs = [task.output] if task.output is not None else []
+        output_bytes = task.output_bytes
+    if output_bytes is None or task.source_bytes is None:
+        return pipe
+
+    saved = task.source_bytes - output_bytes
+    for action, params in task.jobs:
+        pipe.hmset(jobs.key(params.get('job_id')), {'output_bytes': output_bytes, 'bytes_saved': saved})
+
+    if outputs:
+        # The last job's profile is that of the output. Only the renditions rendered now count towards the metrics.
+        profile = task.jobs[-1][1].get('profile') or 'default'
+        metrics.increment(pipe, 'transcoder_source_bytes_total', task.source_bytes, profile=profile)
+        metrics.increment(pipe, 'transcoder_output_bytes_total', sum(len(output) for output in outputs),
+                          profile=profile)
+    return pipe
+
+
+def _run_stage(stage, task):
+    """
+    Run a stage of a task, recording the error if it fails
+    """
+    try:
+        if task.status is None or stage is _finish:
+            stage(task)
+    except Exception, e:
+        _log.warn('Error in jobs {}: {}'.format(', '.join(task.job_ids), e))
+        if task.status is None:
+            task.status = 'error: {}'.format(e)
+    return task
+
+
+def worker():
+    """
+    Initiate the asset processing and start delegating the background jobs, one job at a time
+    """
+    while True:
+        task = _take()
+        if task:
+            for stage in (_fetch, _render, _finish):
+                _run_stage(stage, task)
+
+
+class _Limit(object):
+    """
+    A semaphore whose number of slots can be changed while threads hold them
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self.active = 0
+        self._cond = threading.Condition()
+
+    def resize(self, size):
+        with self._cond:
+            self.size = size
+            self._cond.notify_all()
+
+    def __enter__(self):
+        with self._cond:
+            while self.active >= self.size:
+                self._cond.wait()
+            self.active += 1
+
+    def __exit__(self, *exc_info):
+        with self._cond:
+            self.active -= 1
+            self._cond.notify()
+
+
+class StagedWorker(object):
+    """
+    Processes jobs in stages connected by bounded queues, so that the I/O of some jobs overlaps with the image work of
+    others: fetcher threads take jobs off the queue, update their status and read their originals into memory; render
+    threads hand the images to the executor to decode, transform and encode, as many at once as the pool's size (one
+    per executor process); and writer threads write the results, update Redis and acknowledge the jobs. The fetchers
+    read up to `prefetch` jobs ahead of the executor, which holds those jobs' lanes until they are finished.
+
+    With an autoscaler, the pool is resized every SCALE_INTERVAL seconds for the load on the queue, along with the
+    executor; otherwise it is as large as the executor.
+
+    While it runs, the worker beats the queue's heartbeat and renews the leases and deadlines of the jobs it holds,
+    however long they wait for the pixel budget; drain() stops it once the jobs it has taken are finished.
+    """
+
+    def __init__(self, fetchers=1, writers=1, prefetch=PREFETCH, autoscaler=None):
+        """
+        :type autoscaler: autoscale.Autoscaler
+        """
+        self.fetchers = fetchers
+        self.writers = writers
+        self.autoscaler = autoscaler
+        self.pool = _Limit(autoscaler.size if autoscaler else executor.processes)
+        self._fetched = Queue(prefetch)
+        self._rendered = Queue(prefetch)
+        self._stopping = threading.Event()
+        self._stopped = threading.Event()
+        self._threads = {}
+
+        # Tasks taken off the queue and not yet finished
+        self._tasks = 0
+        self._lock = threading.Lock()
+
+    def _count(self, tasks):
+        with self._lock:
+            self._tasks += tasks
+
+    def _take(self):
+        """
+        The next task, or None once the worker is stopping
+        """
+        while not self._stopping.is_set():
+            try:
+                task = _take(timeout=TAKE_TIMEOUT)
+            except Exception, e:
+                _log.warn('Could not take a job: {}'.format(e))
+                self._stopping.wait(TAKE_RETRY_DELAY)
+                continue
+            if task is not None:
+                self._count(1)
+                return task
+        return None
+
+    def _render(self, task):
+        """
+        Render a task in a slot of the pool, timing the executor's work (but not the wait for the pixel budget) for the
+        autoscaler
+        """
+        with self.pool:
+            _run_stage(_render, task)
+            if self.autoscaler and task.render_seconds is not None:
+                self.autoscaler.observe(task.render_seconds, len(task.jobs))
+
+    def _finish(self, task):
+        _run_stage(_finish, task)
+        self._count(-1)
+
+    def _scale(self):
+        """
+        Resize the pool for the load on the queue until the worker stops, recording each decision in the metrics
+        """
+        while not self._stopped.wait(SCALE_INTERVAL):
+            try:
+                pipe = store.pipeline(transaction=False)
+                pipe.hgetall(queue.load)
+                pipe.zcount(queue.workers, time.time(), '+inf')
+                load, workers = pipe.execute()
+
+                depth = sum(depth for depth, cost in queue.backlog(load).values())
+                size, direction = self.autoscaler.decide(depth, self._tasks, workers)
+                if direction:
+                    _log.info('Resizing the pool to {} for {} queued jobs'.format(size, depth))
+                    executor.resize(size)
+                    self.pool.resize(size)
+
+                pipe = store.pipeline(transaction=False)
+                pipe.hset(POOL, WORKER_ID, size)
+                if direction:
+                    metrics.increment(pipe, 'transcoder_pool_resizes_total', direction=direction)
+                pipe.execute()
+            except Exception, e:
+                _log.warn('Could not resize the pool: {}'.format(e))
+
+    def _run(self, take, stage, output=None):
+        while True:
+            task = take()
+            if task is None:
+                return
+            stage(task)
+            if output is not None:
+                output.put(task)
+
+    def _beat(self):
+        """
+        Beat the heartbeat and renew the jobs held until the worker stops. Errors are logged and the next beat tried as
+        usual, since a heartbeat that lapses while the worker is still running gets its jobs handed out again.
+        """
+        delay = 0
+        while not self._stopped.wait(delay):
+            delay = HEARTBEAT_INTERVAL
+            try:
+                queue.heartbeat()
+                queue.renew()
+            except Exception, e:
+                _log.warn('Could not beat the heartbeat: {}'.format(e))
+
+    def _start(self, name, count, target, *args):
+        self._threads[name] = []
+        for _ in xrange(count):
+            t = threading.Thread(target=target, args=args)
+            t.daemon = True
+            t.start()
+            self._threads[name].append(t)
+
+    def _stop(self, name, inbox):
+        """
+        Tell the threads of a stage to stop after the tasks already in their queue, and wait for them to
+        """
+        for _ in self._threads[name]:
+            inbox.put(None)
+        for t in self._threads[name]:
+            t.join()
+
+    def start(self):
+        self._start('heartbeat', 1, self._beat)
+        if self.autoscaler:
+            self._start('scale', 1, self._scale)
+        self._start('fetch', self.fetchers, self._run, self._take, partial(_run_stage, _fetch), self._fetched)
+        renderers = self.autoscaler.maximum if self.autoscaler else self.pool.size
+        self._start('render', renderers, self._run, self._fetched.get, self._render, self._rendered)
+        self._start('finish', self.writers, self._run, self._rendered.get, self._finish)
+
+    def drain(self):
+        """
+        Stop taking jobs, and return once the jobs already taken have been finished and the worker has deregistered
+        """
+        self._stopping.set()
+        for t in self._threads['fetch']:
+            t.join()
+
+        # Each stage is told to stop once the stage before it has handed over its last task
+        self._stop('render', self._fetched)
+        self._stop('finish', self._rendered)
 
+        self._stopped.set()
+        for t in self._threads['heartbeat'] + self._threads.get('scale', []):
+            t.join()
+        queue.leave()
@@ -0,0 +1,211 @@
+"""
+Streaming uploads. Werkzeug hands the chunks of an uploaded file to an UploadFile as they arrive; each chunk is written
+straight to disk in UPLOAD_DIR while the content hash is computed and the image header is sniffed, so an upload is
+never buffered in memory or copied, and files that are not images are rejected before the rest of the body has been
+read.
+
+Uploads are then moved into storage and deduplicated by their content: every image with the same bytes shares one blob,
+stored under a key starting with BLOB_PREFIX, which is reference counted in Redis under this key:
+
+    blobs.{hash}.refs       --  Number of images using the blob with this content hash
+"""
+import os
+import uuid
+import errno
+import hashlib
+import logging
+from io import BytesIO
+
+from flask import Request
+from PIL import Image
+from redis import WatchError
+from werkzeug.exceptions import BadRequest, RequestEntityTooLarge, UnsupportedMediaType
+from werkzeug.utils import secure_filename
+
+import metrics
+import storage
+
+_log = logging.getLogger(__name__)
+
+store = metrics.CountingRedis()
+
+UPLOAD_DIR = '/tmp'
+BLOB_PREFIX = 'blobs/'
+
+# Uploads larger than this are rejected; requests that declare a larger Content-Length are rejected up front
+MAX_UPLOAD_BYTES = 64 * 1024 * 1024
+
+# If PIL cannot make out the image format and dimensions from this many bytes, the upload is not an image we support
+SNIFF_BYTES = 256 * 1024
+
+# PIL formats that may be uploaded, and the extension their blobs are stored with
+FORMATS = ('JPEG', 'PNG', 'BMP')
+EXTENSIONS = {'JPEG': '.jpeg', 'PNG': '.png', 'BMP': '.bmp'}
+
+
+class UploadFile(object):
+    """
+    A file that werkzeug streams an upload into. Unless the upload is finished, the file is removed when closed.
+    """
+
+    def __init__(self, filename):
+        self.path = os.path.join(UPLOAD_DIR, secure_filename(str(uuid.uuid4()) + os.path.splitext(filename or '')[-1]))
+        self.size = 0
+        self.format = None
+        self.dimensions = None
+        self.finished = False
+        self._file = open(self.path, 'w+b')
+        self._digest = hashlib.sha1()
+        self._head = b''
+
+    def _reject(self, exception):
+        self.close()
+        raise exception
+
+    def _sniff(self, final=False):
+        try:
+            # Opening an image is lazy; this only reads the header
+            image = Image.open(BytesIO(self._head))
+        except IOError:
+            if final or len(self._head) >= SNIFF_BYTES:
+                self._reject(UnsupportedMediaType('The uploaded file is not a supported image'))
+            return
+
+        if image.format not in FORMATS:
+            self._reject(UnsupportedMediaType('Images must be one of: {}'.format(', '.join(FORMATS))))
+
+        self.format = image.format
+        self.dimensions = image.size
+        self._head = None
+
+    def write(self, chunk):
+        self.size += len(chunk)
+        if self.size > MAX_UPLOAD_BYTES:
+            self._reject(RequestEntityTooLarge())
+
+        self._digest.update(chunk)
+        if self.format is None:
+            self._head += chunk
+            self._sniff()
+
+        self._file.write(chunk)
+
+    def read(self, *args):
+        return self._file.read(*args)
+
+    def readline(self, *args):
+        return self._file.readline(*args)
+
+    def seek(self, *args):
+        return self._file.seek(*args)
+
+    def tell(self):
+        return self._file.tell()
+
+    def hexdigest(self):
+        return self._digest.hexdigest()
+
+    def finish(self):
+        """
+        Check that a complete image was uploaded and keep the file
+        """
+        if not self.size:
+            self._reject(BadRequest('The uploaded file is empty'))
+        if self.format is None:
+            self._sniff(final=True)
+
+        self._file.close()
+        self.finished = True
+
+    def close(self):
+        if not self._file.closed:
+            self._file.close()
+        if not self.finished:
+            try:
+                os.unlink(self.path)
+            except OSError as e:
+                if e.errno != errno.ENOENT:
+                    raise
+
+
+def _blob_key(content_hash, image_format):
+    return BLOB_PREFIX + content_hash + EXTENSIONS[image_format]
+
+
+def _refs(content_hash):
+    return 'blobs.{}.refs'.format(content_hash)
+
+
+def keep(upload):
+    """
+    Store a finished upload as the blob for its content, or drop it if an identical blob already exists
+
+    :type upload: UploadFile
+    :return: Storage key of the blob
+    """
+    key = _blob_key(upload.hexdigest(), upload.format)
+    store.incr(_refs(upload.hexdigest()))
+
+    if storage.backend.exists(key):
+        os.unlink(upload.path)
+    else:
+        storage.backend.put_file(key, upload.path)
+
+    return key
+
+
+def release(content_hash, key):
+    """
+    Drop an image's reference to a blob, removing the blob once no image uses it
+    """
+    refs = _refs(content_hash)
+    pipe = store.pipeline()
+    try:
+        while True:
+            pipe.watch(refs)
+            if int(pipe.get(refs) or 0) > 1:
+                pipe.multi()
+                pipe.decr(refs)
+                try:
+                    pipe.execute()
+                    return
+                except WatchError:
+                    continue
+
+            # Take the blob out of place before dropping the last reference, so that an upload of the same content
+            # that comes in meanwhile puts its own copy back rather than losing it
+            doomed = '{}.deleting-{}'.format(key, uuid.uuid4())
+            if not storage.backend.rename(key, doomed):
+                doomed = None
+
+            pipe.multi()
+            pipe.delete(refs)
+            try:
+                pipe.execute()
+            except WatchError:
+                # The blob was referenced again in the meantime; put it back, unless an upload already has
+                if doomed:
+                    if storage.backend.exists(key):
+                        storage.backend.delete(doomed)
+                    else:
+                        storage.backend.rename(doomed, key)
+                continue
+
+            if doomed:
+                storage.backend.delete(doomed)
+            return
+    finally:
+        pipe.reset()
+
+
+class UploadRequest(Request):
+    """
+    A request that streams uploaded files into UploadFiles
+    """
+
+    @property
+    def max_content_length(self):
+        return MAX_UPLOAD_BYTES
+
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        return UploadFile(filename)
@@ -0,0 +1,101 @@
+"""
+The standalone worker process. The app only queues jobs, so run as many of these as the queue needs, on any machines
+that can reach Redis and the storage backend:
+
+    python worker.py --processes 4
+
+A worker renders jobs in up to --processes processes at once. With --min-processes, it grows and shrinks the number
+it uses between the two to keep the time jobs wait on the queue under --target-wait seconds (see autoscale.py), and
+reports each pool's size in the /metrics endpoint as transcoder_pool_size. All --processes are started up front, so
+the pool never forks once the worker's threads are running.
+
+Each worker registers a heartbeat in Redis while it runs (see transcoder.py), which the /metrics endpoint counts as
+transcoder_workers. On SIGTERM or SIGINT a worker stops taking jobs, finishes the ones it has taken and exits; a second
+signal stops it at once. The jobs of a worker that dies without draining are queued again by the other workers once its
+heartbeat lapses.
+"""
+import signal
+import logging
+import argparse
+import threading
+import multiprocessing
+
+import autoscale
+import notify
+import transcoder
+
+_log = logging.getLogger(__name__)
+
+# Number of threads the worker reads originals and writes results with (each), and calls callback URLs with
+IO_THREAD_COUNT = 2
+CALLBACK_THREAD_COUNT = 2
+
+
+def run(processes, io_threads=IO_THREAD_COUNT, callback_threads=CALLBACK_THREAD_COUNT, min_processes=None,
+        target_wait=autoscale.TARGET_WAIT):
+    """
+    Process jobs until the process is sent SIGTERM or SIGINT, then drain
+
+    :param processes: Processes to render jobs in, or the most to autoscale to
+    :param min_processes: The fewest processes to autoscale to, or None for a pool of a fixed size
+    """
+    stopping = threading.Event()
+
+    def stop(signum, frame):
+        _log.info('Received signal {}; finishing the jobs in progress'.format(signum))
+        stopping.set()
+        signal.signal(signum, signal.SIG_DFL)
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+
+    autoscaler = None
+    if min_processes is not None and min_processes < processes:
+        autoscaler = autoscale.Autoscaler(min_processes, processes, target_wait)
+
+    # The executor forks all of its processes now, before any threads start
+    transcoder.executor = transcoder.ProcessExecutor(autoscaler.size if autoscaler else processes, processes)
+    worker = transcoder.StagedWorker(fetchers=io_threads, writers=io_threads, autoscaler=autoscaler)
+    worker.start()
+
+    callbacks = []
+    for _ in xrange(callback_threads):
+        t = threading.Thread(target=notify.deliver_callbacks, args=(stopping,))
+        t.daemon = True
+        t.start()
+        callbacks.append(t)
+    _log.info('Worker {} started with {} processes'.format(transcoder.WORKER_ID, processes))
+
+    # Signals are only handled on the main thread, and not while it blocks without a timeout
+    while not stopping.wait(1):
+        pass
+
+    worker.drain()
+    transcoder.executor.close()
+    for t in callbacks:
+        t.join()
+    _log.info('Worker {} drained'.format(transcoder.WORKER_ID))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Process the jobs queued by the image service')
+    parser.add_argument('--processes', type=int, default=multiprocessing.cpu_count(),
+                        help='Processes to transcode in, or the most to autoscale to (default: one per CPU)')
+    parser.add_argument('--min-processes', type=int,
+                        help='Autoscale the processes from this many, up to --processes')
+    parser.add_argument('--target-wait', type=float, default=autoscale.TARGET_WAIT,
+                        help='Seconds that autoscaling keeps jobs waiting on the queue under (default: %(default)s)')
+    parser.add_argument('--io-threads', type=int, default=IO_THREAD_COUNT,
+                        help='Threads to read originals and write results with, each')
+    parser.add_argument('--callback-threads', type=int, default=CALLBACK_THREAD_COUNT,
+                        help='Threads to call the callback URLs of finished jobs with')
+    args = parser.parse_args()
+    if args.min_processes is not None and not 1 <= args.min_processes <= args.processes:
+        parser.error('--min-processes must be between 1 and --processes')
+
+    logging.basicConfig(level=logging.INFO)
+    run(args.processes, args.io_threads, args.callback_threads, args.min_processes, args.target_wait)
+
+
+if __name__ == '__main__':
+    main()